@@ -0,0 +1,250 @@
+#!/usr/bin/env python
+
+"""
+Generate deterministic, genome-scale inputs for the benchmarks.
+
+Writes to --outdir:
+
+ refGene.txt             UCSC refGene table (with bin and exonFrames columns)
+ refGene.bed             the same transcripts in the bed format read by
+                         create_files and summarize_assay
+ probes.txt              vendor probe file (chrom, start, stop, annotation, strand)
+ assay.bed               merged, annotated probes, as written by create_files
+ genes.txt               preferred transcripts (Gene, RefSeq)
+ refgene_summary.txt     a per-refgene summary table, for xlsxmaker
+
+Genes are laid out without overlapping one another, so filter_refgene
+accepts the full preferred transcript list; isoforms of a gene share
+its transcription start. The same --seed and sizes always produce the
+same files.
+
+usage:
+
+ python benchmarks/generate.py [--size {small,full}] [--probes N] [--outdir DIR]
+"""
+
+import argparse
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root)
+
+# hg19 chromosome lengths
+CHROMOSOMES = [
+    ('1', 249250621), ('2', 243199373), ('3', 198022430), ('4', 191154276),
+    ('5', 180915260), ('6', 171115067), ('7', 159138663), ('8', 146364022),
+    ('9', 141213431), ('10', 135534747), ('11', 135006516), ('12', 133851895),
+    ('13', 115169878), ('14', 107349540), ('15', 102531392), ('16', 90354753),
+    ('17', 81195210), ('18', 78077248), ('19', 59128983), ('20', 63025520),
+    ('21', 48129895), ('22', 51304566), ('X', 155270560), ('Y', 59373566),
+]
+
+# number of genes, probes and preferred transcripts
+SIZES = {
+    'small': (2000, 100000, 1000),
+    'full': (25000, 1000000, 20000),
+}
+
+PROBE_LENGTH = 120
+
+
+def ucsc_bin(start, end):
+    """Return the UCSC binning scheme bin for a feature"""
+
+    offsets = [512 + 64 + 8 + 1, 64 + 8 + 1, 8 + 1, 1, 0]
+    start, end = start >> 17, (end - 1) >> 17
+    for offset in offsets:
+        if start == end:
+            return offset + start
+        start, end = start >> 3, end >> 3
+    raise ValueError('feature {}-{} is too large to bin'.format(start, end))
+
+
+def joined(values):
+    return ''.join('{},'.format(v) for v in values)
+
+
+def make_transcript(rng, start, length):
+    """Return exon starts and ends for a transcript at `start` spanning `length` bases"""
+
+    # a few very long genes, like TTN, have hundreds of exons
+    count = rng.integers(60, 364) if rng.random() < 0.01 else rng.geometric(1 / 10.0)
+    count = int(max(min(count, length // 200), 1))
+    exon_lengths = rng.integers(60, 200, count)
+    introns = rng.dirichlet(np.ones(count - 1)) * (length - exon_lengths.sum()) if count > 1 else []
+    introns = np.floor(introns).astype(np.int64)
+    steps = np.concatenate(([0], np.cumsum(exon_lengths[:-1] + introns)))
+    exon_starts = start + steps
+    exon_ends = exon_starts + exon_lengths
+    exon_ends[-1] = start + length
+    return exon_starts, exon_ends
+
+
+def write_refgene(rng, ngenes, outdir):
+    """Write refGene.txt, returning a DataFrame of the transcripts"""
+
+    total = sum(length for __, length in CHROMOSOMES)
+    records = []
+    gene = 0
+    accession = 1
+    for chrom, chrom_length in CHROMOSOMES:
+        count = max(int(round(ngenes * chrom_length / float(total))), 1)
+        spans = np.minimum(rng.lognormal(10, 1.2, count).astype(np.int64) + 1000, 2000000)
+        gaps = rng.exponential(max(chrom_length - spans.sum(), count) / float(count + 1), count).astype(np.int64)
+        starts = 10000 + np.cumsum(gaps + np.concatenate(([0], spans[:-1])))
+        for start, span in zip(starts.tolist(), spans.tolist()):
+            if start + span >= chrom_length or gene >= ngenes:
+                break
+            name2 = 'G{}'.format(gene)
+            strand = '+' if rng.random() < 0.5 else '-'
+            for isoform in range(int(rng.integers(1, 5))):
+                length = span if isoform == 0 else int(span * rng.uniform(0.5, 1))
+                exon_starts, exon_ends = make_transcript(rng, start, length)
+                coding = rng.random() < 0.85
+                if coding:
+                    cds_start = int(exon_starts[0] + (exon_ends[0] - exon_starts[0]) // 2)
+                    cds_end = int(exon_starts[-1] + (exon_ends[-1] - exon_starts[-1]) // 2)
+                    frames = (np.concatenate(([0], np.cumsum(exon_ends - exon_starts)[:-1])) % 3).tolist()
+                else:
+                    cds_start = cds_end = start + length
+                    frames = [-1] * len(exon_starts)
+                records.append({
+                    'bin': ucsc_bin(start, start + length),
+                    'name': '{}_{}'.format('NM' if coding else 'NR', accession),
+                    'chrom': chrom, 'strand': strand,
+                    'txStart': start, 'txEnd': start + length,
+                    'cdsStart': cds_start, 'cdsEnd': cds_end,
+                    'exonCount': len(exon_starts),
+                    'exonStarts': joined(exon_starts.tolist()),
+                    'exonEnds': joined(exon_ends.tolist()),
+                    'score': 0, 'name2': name2,
+                    'cdsStartStat': 'cmpl' if coding else 'none',
+                    'cdsEndStat': 'cmpl' if coding else 'none',
+                    'exonFrames': joined(frames),
+                })
+                accession += 1
+            gene += 1
+
+    refgene = pd.DataFrame.from_records(records)
+    with open(os.path.join(outdir, 'refGene.txt'), 'w') as f:
+        f.write('#' + '\t'.join(refgene.columns) + '\n')
+        refgene.to_csv(f, sep='\t', header=False, index=False)
+    bed_columns = ['chrom', 'txStart', 'txEnd', 'name2', 'name', 'strand', 'exonCount', 'exonStarts', 'exonEnds']
+    refgene.to_csv(os.path.join(outdir, 'refGene.bed'), columns=bed_columns, sep='\t', header=False, index=False)
+    return refgene
+
+
+def write_probes(rng, refgene, nprobes, outdir):
+    """Tile probes across the exons of randomly chosen genes, with a few
+    intergenic probes, until there are `nprobes`"""
+
+    counts = refgene['exonCount'].values
+    exon_starts = np.concatenate([np.array(s.rstrip(',').split(','), dtype=np.int64) for s in refgene['exonStarts']])
+    exon_ends = np.concatenate([np.array(s.rstrip(',').split(','), dtype=np.int64) for s in refgene['exonEnds']])
+    exon_rows = np.repeat(np.arange(len(refgene)), counts)
+
+    step = PROBE_LENGTH // 2
+    tiles = (exon_ends - exon_starts + PROBE_LENGTH) // step
+    order = rng.permutation(len(exon_starts))
+    take = order[:np.searchsorted(np.cumsum(tiles[order]), int(nprobes * 0.95)) + 1]
+    take.sort()
+    tile_count = tiles[take]
+    probe_exon = np.repeat(take, tile_count)
+    tile = np.arange(tile_count.sum()) - np.repeat(np.cumsum(tile_count) - tile_count, tile_count)
+    starts = exon_starts[probe_exon] - PROBE_LENGTH // 2 + tile * step
+    chroms = refgene['chrom'].values[exon_rows[probe_exon]]
+    genes = refgene['name2'].values[exon_rows[probe_exon]]
+
+    # intergenic and off-target probes fill the remainder
+    extra = max(nprobes - len(starts), 0)
+    lengths = dict(CHROMOSOMES)
+    extra_chroms = np.array([c for c, __ in CHROMOSOMES], dtype=object)[rng.integers(0, len(CHROMOSOMES), extra)]
+    extra_starts = (rng.random(extra) * (np.array([lengths[c] for c in extra_chroms]) - 1000)).astype(np.int64)
+
+    probes = pd.DataFrame({
+        'chrom': np.concatenate((chroms, extra_chroms))[:nprobes],
+        'start': np.concatenate((starts, extra_starts))[:nprobes],
+        'gene': np.concatenate((genes, np.full(extra, 'intergenic', dtype=object)))[:nprobes],
+    })
+    probes['stop'] = probes['start'] + PROBE_LENGTH
+    ids = pd.Series(np.arange(len(probes)) + 14000000).astype(str)
+    probes['annotation'] = ('275744_' + ids + '_' + probes['gene'] + '_chr' + probes['chrom'] + ':' +
+                            probes['start'].astype(str) + '-' + probes['stop'].astype(str) + '_1')
+    probes['strand'] = np.where(rng.random(len(probes)) < 0.5, '+', '-')
+    probes.to_csv(os.path.join(outdir, 'probes.txt'), columns=['chrom', 'start', 'stop', 'annotation', 'strand'],
+                  sep='\t', header=False, index=False)
+    return probes
+
+
+def write_assay(probes, outdir):
+    """Merge and annotate the probes, as create_files does"""
+
+    from ngs_capture_qc.subcommands.create_files import annotate_probes
+    annotated = annotate_probes(probes[['chrom', 'start', 'stop']], os.path.join(outdir, 'refGene.bed'))
+    annotated.to_csv(os.path.join(outdir, 'assay.bed'), columns=['chrom', 'start', 'stop', 'gene'],
+                     header=False, index=False, sep='\t')
+
+
+def write_genes(rng, refgene, ngenes, outdir):
+    """Pick a preferred transcript for `ngenes` genes; some RefSeqs carry a version"""
+
+    first = refgene.drop_duplicates('name2')
+    chosen = first.iloc[np.sort(rng.choice(len(first), min(ngenes, len(first)), replace=False))]
+    versions = rng.integers(1, 6, len(chosen))
+    refseqs = [name if v == 1 else '{}.{}'.format(name, v) for name, v in zip(chosen['name'], versions)]
+    pd.DataFrame({'Gene': chosen['name2'].values, 'RefSeq': refseqs}).to_csv(
+        os.path.join(outdir, 'genes.txt'), sep='\t', index=False)
+    return chosen
+
+
+def write_summary(rng, chosen, outdir):
+    """Write a table shaped like summarize_assay's per-refgene summary"""
+
+    lengths = (chosen['txEnd'] - chosen['txStart']).values
+    covered = (lengths * rng.random(len(chosen))).astype(np.int64)
+    exons = chosen['exonCount'].values
+    pd.DataFrame({
+        'gene': chosen['name2'].values, 'refgene': chosen['name'].values,
+        'total_bases_targeted': covered, 'length_of_gene': lengths,
+        'fraction_of_gene_covered': np.round(covered / lengths.astype(float), 3),
+        'exons_with_any_coverage': (exons * rng.random(len(chosen))).astype(np.int64),
+        'total_exons_in_gene': exons,
+    }).to_csv(os.path.join(outdir, 'refgene_summary.txt'), sep='\t', index=False)
+
+
+def generate(outdir, ngenes, nprobes, npreferred, seed=0):
+    if not os.path.isdir(outdir):
+        os.makedirs(outdir)
+    rng = np.random.default_rng(seed)
+    refgene = write_refgene(rng, ngenes, outdir)
+    probes = write_probes(rng, refgene, nprobes, outdir)
+    write_assay(probes, outdir)
+    chosen = write_genes(rng, refgene, npreferred, outdir)
+    write_summary(rng, chosen, outdir)
+    return refgene, probes
+
+
+def main(arguments):
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--outdir', default=os.path.join(root, 'benchmarks', 'data'))
+    parser.add_argument('--size', choices=sorted(SIZES), default='full')
+    parser.add_argument('--genes', type=int, help='Number of genes in refGene (overrides --size)')
+    parser.add_argument('--probes', type=int, help='Number of probes (overrides --size)')
+    parser.add_argument('--preferred', type=int, help='Number of preferred transcripts (overrides --size)')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(arguments)
+
+    ngenes, nprobes, npreferred = SIZES[args.size]
+    refgene, probes = generate(args.outdir, args.genes or ngenes, args.probes or nprobes,
+                               args.preferred or npreferred, args.seed)
+    print('wrote {} transcripts and {} probes to {}'.format(len(refgene), len(probes), args.outdir))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
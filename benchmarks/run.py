@@ -0,0 +1,323 @@
+#!/usr/bin/env python
+
+"""
+Time and memory-profile capqc subcommands and core functions on the
+inputs written by benchmarks/generate.py.
+
+Each benchmark runs in a fresh interpreter: its inputs are loaded
+first, then only the benchmarked call is timed. Results (wall and CPU
+seconds, peak RSS, rows processed and rows per second) are written as
+JSON to --output, by default benchmarks/results/<git describe>.json,
+so that runs on different commits can be compared with --compare.
+
+usage:
+
+ python benchmarks/generate.py --size full
+ python benchmarks/run.py [--only NAME [NAME ...]] [--repeat N] [--compare BASELINE.json]
+
+Exits with an error if --compare is given and any benchmark is more
+than --tolerance times slower than the baseline.
+"""
+
+import argparse
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from collections import OrderedDict
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root)
+
+
+def count_lines(path):
+    with open(path, 'rb') as f:
+        return sum(1 for __ in f)
+
+
+def capqc(*argv):
+    """Return a function running `capqc argv` in this process"""
+
+    def run():
+        from ngs_capture_qc.scripts.main import main
+        status = main(['-q'] + list(argv))
+        if status:
+            raise SystemExit(status)
+    return run
+
+
+# Each benchmark takes the data and a scratch directory, loads its
+# inputs, and returns the function to time and the number of rows it
+# processes.
+
+def bench_check_probe_format(data, work):
+    import pandas as pd
+    from ngs_capture_qc.utils import check_probe_format
+    probes = pd.read_csv(data('probes.txt'), delimiter='\t', header=None)
+    return lambda: check_probe_format(probes), len(probes)
+
+
+def bench_merge_probes(data, work):
+    import pandas as pd
+    from ngs_capture_qc.utils import check_probe_format
+    from ngs_capture_qc.subcommands.create_files import merge_probes
+    probes = check_probe_format(pd.read_csv(data('probes.txt'), delimiter='\t', header=None))
+    return lambda: merge_probes(probes), len(probes)
+
+
+def bench_annotate_merged(data, work):
+    import pandas as pd
+    from ngs_capture_qc.subcommands.create_files import annotate_merged
+    merged = pd.read_csv(data('assay.bed'), sep='\t', header=None, usecols=[0, 1, 2],
+                         names=['chrom', 'start', 'stop'], dtype={'chrom': str})
+    return lambda: annotate_merged(merged, data('refGene.bed')), len(merged)
+
+
+def bench_write_annotated_bed(data, work, bedtools):
+    from ngs_capture_qc.subcommands.create_files import write_annotated_bed
+    merged = os.path.join(work, 'merged.bed')
+    with open(data('assay.bed')) as f, open(merged, 'w') as out:
+        out.writelines('\t'.join(line.split('\t')[:3]) + '\n' for line in f)
+    return (lambda: write_annotated_bed(merged, bedtools, data('refGene.bed'), os.path.join(work, 'anno.bed')),
+            count_lines(merged))
+
+
+def bench_from_table(data, work):
+    from ngs_capture_qc.utils import GenomeIntervalTree
+    return lambda: GenomeIntervalTree.from_table(data('refGene.txt'), mode='exons'), count_lines(data('refGene.txt'))
+
+
+def bench_array_from_table(data, work):
+    import numpy as np
+    from ngs_capture_qc.utils import GenomeIntervalArray
+    assay = np.loadtxt(data('assay.bed'), dtype=str, usecols=(0, 1, 2), ndmin=2)
+
+    def run():
+        intervals = GenomeIntervalArray.from_table(data('refGene.txt'), mode='exons')
+        for chrom in np.unique(assay[:, 0]):
+            rows = assay[:, 0] == chrom
+            intervals.overlap_many(chrom, assay[rows, 1].astype(int), assay[rows, 2].astype(int))
+    return run, count_lines(data('refGene.txt'))
+
+
+def bench_exon_tracker_insert(data, work):
+    from ngs_capture_qc.subcommands.summarize_assay import (
+        read_assay, refgene_rows, read_refgenes)
+    from ngs_capture_qc.intervals import intersect
+    from ngs_capture_qc.utils import RefGeneTable
+    table = RefGeneTable.read(data('refGene.bed'), format='bed')
+    rows = refgene_rows(table)
+    refgenes = read_refgenes(table, rows)
+    __, chroms, starts, ends = read_assay(data('assay.bed'))
+    pairs = []
+    for probe_index, row_index in intersect(chroms, starts, ends, rows[0], rows[1], rows[2]):
+        pairs.extend((rows[3][r], int(starts[p]), int(ends[p]))
+                     for p, r in zip(probe_index.tolist(), row_index.tolist()) if rows[3][r] in refgenes)
+
+    def run():
+        for refgene, start, end in pairs:
+            refgenes[refgene]['exonTracker'].insert(start, end)
+    return run, len(pairs)
+
+
+def bench_write_workbook(data, work):
+    from xlsxwriter import Workbook
+    from ngs_capture_qc.subcommands.xlsxmaker import write_workbook
+
+    def run():
+        book = Workbook(os.path.join(work, 'summary.xlsx'))
+        write_workbook('refgene_summary', book, data('refgene_summary.txt'))
+        book.close()
+    return run, count_lines(data('refgene_summary.txt'))
+
+
+def bench_refgene_to_bed(data, work):
+    return capqc('refgene_to_bed', data('refGene.txt'), os.path.join(work, 'refGene.bed')), \
+        count_lines(data('refGene.txt'))
+
+
+def bench_parse_refgene_positions(data, work):
+    return capqc('parse_refgene_positions', data('refGene.txt'), os.path.join(work, 'positions.txt')), \
+        count_lines(data('refGene.txt'))
+
+
+def bench_filter_refgene(data, work):
+    return capqc('filter_refgene', data('refGene.txt'), data('genes.txt'), os.path.join(work, 'filtered.txt')), \
+        count_lines(data('refGene.txt'))
+
+
+def bench_create_files(data, work):
+    # create_files reads docs/PicardHeader relative to the working directory
+    os.chdir(root)
+    return capqc('create_files', data('probes.txt'), data('refGene.bed'), work), count_lines(data('probes.txt'))
+
+
+def bench_summarize_assay(data, work):
+    return capqc('summarize_assay', data('assay.bed'), data('genes.txt'), data('refGene.bed'), '--outdir', work), \
+        count_lines(data('assay.bed'))
+
+
+def bench_xlsxmaker(data, work):
+    return capqc('xlsxmaker', '-o', os.path.join(work, 'summary.xlsx'), data('refgene_summary.txt')), \
+        count_lines(data('refgene_summary.txt'))
+
+
+BENCHMARKS = OrderedDict([
+    ('check_probe_format', bench_check_probe_format),
+    ('merge_probes', bench_merge_probes),
+    ('annotate_merged', bench_annotate_merged),
+    ('write_annotated_bed', bench_write_annotated_bed),
+    ('GenomeIntervalTree.from_table', bench_from_table),
+    ('GenomeIntervalArray.overlap_many', bench_array_from_table),
+    ('exonTracker.insert', bench_exon_tracker_insert),
+    ('write_workbook', bench_write_workbook),
+    ('refgene_to_bed', bench_refgene_to_bed),
+    ('parse_refgene_positions', bench_parse_refgene_positions),
+    ('filter_refgene', bench_filter_refgene),
+    ('create_files', bench_create_files),
+    ('summarize_assay', bench_summarize_assay),
+    ('xlsxmaker', bench_xlsxmaker),
+])
+
+# benchmarks that need the path to bedtools
+NEEDS_BEDTOOLS = {'write_annotated_bed'}
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / (1024.0 ** 2 if sys.platform == 'darwin' else 1024.0)
+
+
+def run_one(name, datadir, bedtools):
+    """Run benchmark `name` in this process and return its measurements"""
+
+    work = tempfile.mkdtemp(prefix='capqc-bench-')
+    try:
+        args = (bedtools,) if name in NEEDS_BEDTOOLS else ()
+        func, rows = BENCHMARKS[name](lambda fname: os.path.join(datadir, fname), work, *args)
+        rss_before = peak_rss_mb()
+        wall, cpu = time.perf_counter(), time.process_time()
+        func()
+        wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+    finally:
+        shutil.rmtree(work, ignore_errors=True)
+    return {'wall_seconds': wall, 'cpu_seconds': cpu,
+            'peak_rss_mb': peak_rss_mb(), 'setup_rss_mb': rss_before,
+            'rows': rows, 'rows_per_second': rows / wall if wall else None}
+
+
+def run_isolated(name, datadir, bedtools):
+    """Run benchmark `name` in a fresh interpreter"""
+
+    fd, result = tempfile.mkstemp(suffix='.json')
+    os.close(fd)
+    try:
+        cmd = [sys.executable, os.path.abspath(__file__), '--datadir', datadir, '--child', name, result]
+        if bedtools:
+            cmd += ['--bedtools', bedtools]
+        proc = subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        if proc.returncode:
+            error = proc.stderr.decode(errors='replace').strip().splitlines()
+            return {'error': error[-1] if error else 'exit status {}'.format(proc.returncode)}
+        with open(result) as f:
+            return json.load(f)
+    finally:
+        os.remove(result)
+
+
+def git_describe():
+    try:
+        return subprocess.check_output(['git', 'describe', '--tags', '--always', '--dirty'], cwd=root,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def compare(results, baseline, tolerance):
+    """Print each benchmark's time relative to `baseline`, returning the names that regressed"""
+
+    regressed = []
+    for name, result in results.items():
+        old = baseline['results'].get(name, {})
+        if 'wall_seconds' not in result or 'wall_seconds' not in old:
+            continue
+        ratio = result['wall_seconds'] / old['wall_seconds'] if old['wall_seconds'] else float('inf')
+        flag = ''
+        if ratio > tolerance:
+            regressed.append(name)
+            flag = '  SLOWER'
+        print('{:32s} {:9.3f}s -> {:9.3f}s  x{:.2f}{}'.format(
+            name, old['wall_seconds'], result['wall_seconds'], ratio, flag))
+    return regressed
+
+
+def main(arguments):
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--datadir', default=os.path.join(root, 'benchmarks', 'data'),
+                        help='Directory written by benchmarks/generate.py')
+    parser.add_argument('--only', nargs='+', choices=list(BENCHMARKS), metavar='NAME',
+                        help='Benchmarks to run (default: all). Choices: ' + ', '.join(BENCHMARKS))
+    parser.add_argument('--repeat', type=int, default=1, help='Keep the fastest of N runs')
+    parser.add_argument('--bedtools', help='Path to bedtools, for benchmarks that run it')
+    parser.add_argument('--output', help='JSON results file (default benchmarks/results/<version>.json)')
+    parser.add_argument('--compare', help='JSON results file of a previous run to compare with')
+    parser.add_argument('--tolerance', type=float, default=1.25,
+                        help='Fail --compare if a benchmark is more than this many times slower')
+    parser.add_argument('--child', nargs=2, metavar=('NAME', 'RESULT'), help=argparse.SUPPRESS)
+    args = parser.parse_args(arguments)
+
+    if args.child:
+        name, result = args.child
+        measurement = run_one(name, args.datadir, args.bedtools)
+        with open(result, 'w') as f:
+            json.dump(measurement, f)
+        return 0
+
+    if not os.path.exists(os.path.join(args.datadir, 'refGene.txt')):
+        print('no benchmark data in {}; run benchmarks/generate.py first'.format(args.datadir))
+        return 1
+
+    version = git_describe()
+    results = OrderedDict()
+    for name in args.only or BENCHMARKS:
+        if name in NEEDS_BEDTOOLS and not args.bedtools:
+            results[name] = {'skipped': 'requires --bedtools'}
+            continue
+        runs = [run_isolated(name, args.datadir, args.bedtools) for __ in range(args.repeat)]
+        timed = [r for r in runs if 'wall_seconds' in r]
+        results[name] = min(timed, key=lambda r: r['wall_seconds']) if timed else runs[0]
+        result = results[name]
+        if 'wall_seconds' in result:
+            print('{:32s} {:9.3f}s wall {:9.3f}s cpu {:9.1f}MB peak {:12.0f} rows/s'.format(
+                name, result['wall_seconds'], result['cpu_seconds'], result['peak_rss_mb'],
+                result['rows_per_second'] or 0))
+        else:
+            print('{:32s} {}'.format(name, result['error']))
+
+    output = args.output or os.path.join(root, 'benchmarks', 'results', version + '.json')
+    if not os.path.isdir(os.path.dirname(os.path.abspath(output))):
+        os.makedirs(os.path.dirname(os.path.abspath(output)))
+    with open(output, 'w') as f:
+        json.dump({'version': version, 'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+                   'python': platform.python_version(), 'machine': platform.node(),
+                   'datadir': os.path.abspath(args.datadir), 'results': results}, f, indent=2)
+    print('wrote {}'.format(output))
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressed = compare(results, json.load(f), args.tolerance)
+        if regressed:
+            print('slower than {}: {}'.format(args.compare, ', '.join(regressed)))
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+
+"""
+Time `capqc` startup: `capqc -h` and argument parsing for each
+subcommand, in fresh interpreters.
+
+usage:
+
+ python benchmarks/startup.py [--repeat N] [--max-seconds S]
+
+Exits with an error if the median time for `capqc -h` exceeds
+--max-seconds.
+"""
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SCRIPT = """
+import sys
+from ngs_capture_qc.scripts.main import parse_arguments
+try:
+    parse_arguments(sys.argv[1:])
+except SystemExit:
+    pass
+"""
+
+COMMANDS = [
+    ['-h'],
+    ['cache', 'list'],
+    ['refgene_to_bed', 'refgene', 'outfile'],
+    ['parse_refgene_positions', 'refgene', 'outfile'],
+    ['filter_refgene', 'refgene', 'genes', 'outfile'],
+    ['xlsxmaker', '-o', 'out.xlsx', 'infile'],
+    ['create_files', 'probes', 'refgene_bed', 'outdir'],
+    ['summarize_assay', 'bed', 'genes', 'refgene_bed'],
+]
+
+
+def time_command(argv, repeat):
+    times = []
+    for __ in range(repeat):
+        start = time.perf_counter()
+        subprocess.check_call([sys.executable, '-c', SCRIPT] + argv, cwd=root,
+                              stdout=subprocess.DEVNULL)
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+
+def main(arguments):
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--max-seconds', type=float, default=0.3,
+                        help='Fail if `capqc -h` takes longer than this (median)')
+    args = parser.parse_args(arguments)
+
+    results = [(argv, time_command(argv, args.repeat)) for argv in COMMANDS]
+    for argv, seconds in results:
+        print('{:8.3f}s  capqc {}'.format(seconds, ' '.join(argv)))
+
+    if results[0][1] > args.max_seconds:
+        print('capqc -h took {:.3f}s, more than {:.3f}s'.format(results[0][1], args.max_seconds))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
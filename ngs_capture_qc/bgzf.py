@@ -0,0 +1,233 @@
+"""
+Reading and writing BGZF (blocked gzip) files with a thread pool
+
+BGZF files, as written by ``bgzip``, are a series of gzip members of at
+most 64KB of data each, so the blocks can be compressed and
+decompressed independently. zlib releases the GIL, so this is done on
+a pool of threads. BGZF files are valid gzip files, readable with
+``gzip.open``.
+
+A position in a BGZF file is given by a virtual offset: the offset of
+the compressed block in the file, shifted left 16 bits, plus the
+offset of the position within the uncompressed block.
+"""
+
+import io
+import os
+import struct
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+# gzip header with the BC extra subfield holding the block size
+_HEADER = b'\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00BC\x02\x00'
+_EOF = _HEADER + b'\x1b\x00\x03\x00\x00\x00\x00\x00\x00\x00\x00\x00'
+
+# uncompressed data per block, leaving room for incompressible data
+BLOCK_SIZE = 0xff00
+
+
+def default_threads():
+    return min(os.cpu_count() or 1, 8)
+
+
+def is_bgzf(path):
+    """True if `path` starts with a BGZF block header"""
+
+    with open(path, 'rb') as f:
+        header = f.read(18)
+    return (len(header) == 18 and header[:4] == b'\x1f\x8b\x08\x04' and
+            _block_size(header[10:12], header[12:]) is not None)
+
+
+def _block_size(xlen, extra):
+    """Return the total size of the block from the gzip extra field, or None if it has no BC subfield"""
+
+    xlen, = struct.unpack('<H', xlen)
+    extra = extra[:xlen]
+    pos = 0
+    while pos + 4 <= len(extra):
+        si, slen = extra[pos:pos + 2], struct.unpack('<H', extra[pos + 2:pos + 4])[0]
+        if si == b'BC' and slen == 2:
+            return struct.unpack('<H', extra[pos + 4:pos + 6])[0] + 1
+        pos += 4 + slen
+    return None
+
+
+def read_raw_block(f):
+    """Read the next compressed block from `f`, returning (offset, block), or None at the end of the file"""
+
+    offset = f.tell()
+    header = f.read(12)
+    if not header:
+        return None
+    if len(header) < 12 or header[:4] != b'\x1f\x8b\x08\x04':
+        raise ValueError('invalid BGZF block at offset {}'.format(offset))
+    xlen, = struct.unpack('<H', header[10:12])
+    extra = f.read(xlen)
+    size = _block_size(header[10:12], extra)
+    if size is None:
+        raise ValueError('BGZF block at offset {} has no block size'.format(offset))
+    rest = f.read(size - 12 - xlen)
+    return offset, header + extra + rest
+
+
+def inflate_block(block):
+    """Decompress a complete BGZF block, checking its length and CRC"""
+
+    xlen, = struct.unpack('<H', block[10:12])
+    crc, size = struct.unpack('<II', block[-8:])
+    data = zlib.decompress(block[12 + xlen:-8], -15)
+    if len(data) != size or zlib.crc32(data) & 0xffffffff != crc:
+        raise ValueError('corrupt BGZF block')
+    return data
+
+
+def deflate_block(data, level=6):
+    """Compress up to BLOCK_SIZE bytes of `data` into a BGZF block"""
+
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    cdata = compressor.compress(data) + compressor.flush()
+    return b''.join([_HEADER, struct.pack('<H', len(_HEADER) + 2 + len(cdata) + 8 - 1),
+                     cdata, struct.pack('<II', zlib.crc32(data) & 0xffffffff, len(data))])
+
+
+def iter_blocks(f, offset=0, threads=None, executor=None, end=None):
+    """
+    Yield (offset, data) for each block of the BGZF file object `f`,
+    starting at compressed `offset` and, if given, stopping after the
+    block at compressed offset `end`, decompressing blocks ahead of the
+    reader on `threads` threads. Empty blocks (such as the EOF marker)
+    are skipped.
+    """
+
+    threads = threads or default_threads()
+    own_executor = executor is None
+    if own_executor:
+        executor = ThreadPoolExecutor(threads)
+    pending = deque()
+    try:
+        f.seek(offset)
+        done = False
+        while pending or not done:
+            while not done and len(pending) < threads * 4:
+                raw = read_raw_block(f) if end is None or f.tell() <= end else None
+                if raw is None:
+                    done = True
+                else:
+                    pending.append((raw[0], executor.submit(inflate_block, raw[1])))
+            if pending:
+                offset, future = pending.popleft()
+                data = future.result()
+                if data:
+                    yield offset, data
+    finally:
+        for __, future in pending:
+            future.cancel()
+        if own_executor:
+            executor.shutdown(wait=False)
+
+
+class BgzfReader(io.RawIOBase):
+    """Binary file object decompressing a BGZF file on a thread pool"""
+
+    def __init__(self, path, threads=None):
+        self.fileobj = open(path, 'rb')
+        self.name = path
+        self.threads = threads or default_threads()
+        self.executor = ThreadPoolExecutor(self.threads)
+        self._blocks = None
+        self._buffer = memoryview(b'')
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return False
+
+    def seek_virtual(self, voffset):
+        """Continue reading from virtual offset `voffset`"""
+
+        if self._blocks is not None:
+            self._blocks.close()
+        self._blocks = iter_blocks(self.fileobj, voffset >> 16, self.threads, self.executor)
+        self._buffer = memoryview(b'')
+        within = voffset & 0xffff
+        if within and self._next_block():
+            self._buffer = self._buffer[within:]
+
+    def _next_block(self):
+        if self._blocks is None:
+            self._blocks = iter_blocks(self.fileobj, 0, self.threads, self.executor)
+        for __, data in self._blocks:
+            self._buffer = memoryview(data)
+            return True
+        return False
+
+    def readinto(self, b):
+        if not len(self._buffer) and not self._next_block():
+            return 0
+        n = min(len(b), len(self._buffer))
+        b[:n] = self._buffer[:n]
+        self._buffer = self._buffer[n:]
+        return n
+
+    def close(self):
+        if not self.closed:
+            if self._blocks is not None:
+                self._blocks.close()
+            self.executor.shutdown(wait=True)
+            self.fileobj.close()
+        super(BgzfReader, self).close()
+
+
+class BgzfWriter(io.RawIOBase):
+    """Binary file object writing BGZF, compressing blocks on a thread pool"""
+
+    def __init__(self, path, threads=None, level=6):
+        self.fileobj = open(path, 'wb')
+        self.name = path
+        self.level = level
+        self.threads = threads or default_threads()
+        self.executor = ThreadPoolExecutor(self.threads)
+        self._buffer = bytearray()
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self._buffer.extend(b)
+        # compress a batch of full blocks at once, one per thread
+        batch = BLOCK_SIZE * self.threads * 4
+        if len(self._buffer) >= batch:
+            self._flush_blocks(len(self._buffer) - len(self._buffer) % BLOCK_SIZE)
+        return len(b)
+
+    def _flush_blocks(self, size):
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        chunks = [data[i:i + BLOCK_SIZE] for i in range(0, len(data), BLOCK_SIZE)]
+        for block in self.executor.map(lambda chunk: deflate_block(chunk, self.level), chunks):
+            self.fileobj.write(block)
+
+    def close(self):
+        if not self.closed:
+            self._flush_blocks(len(self._buffer))
+            self.fileobj.write(_EOF)
+            self.executor.shutdown(wait=True)
+            self.fileobj.close()
+        super(BgzfWriter, self).close()
+
+
+def open_bgzf(path, mode='rb', threads=None, **kwargs):
+    """Open a BGZF file for reading or writing, in binary or (with 't' in `mode`) text mode"""
+
+    if 'w' in mode:
+        raw = BgzfWriter(path, threads, kwargs.pop('compresslevel', 6))
+        buffered = io.BufferedWriter(raw, buffer_size=BLOCK_SIZE)
+    else:
+        raw = BgzfReader(path, threads)
+        buffered = io.BufferedReader(raw, buffer_size=BLOCK_SIZE)
+    if 'b' in mode:
+        return buffered
+    return io.TextIOWrapper(buffered, **kwargs)
@@ -0,0 +1,390 @@
+"""
+Persistent on-disk cache of parsed input files
+
+Entries are directories named by the kind of data and the SHA-1 of the
+source file's contents. A small stat file, keyed by the source path,
+size and modification time, maps a source file to its entry so the
+contents only need to be hashed when the file changes. Intermediate
+results, such as those for one chromosome of a run, are stored as
+arrays keyed by the SHA-1 of their input arrays instead. The cache is
+kept under a size cap by evicting the least recently used entries; the
+size is measured once per process and then kept as a running total, so
+the cache is only walked again when the total goes over the cap.
+
+Files downloaded by ``fetch``, such as the UCSC refGene table, are kept
+as entries named by the SHA-1 of their contents, with a file per URL
+pointing to the entry, so they are read from the cache on later runs.
+Nodes without network access can be seeded from a mirror directory.
+
+The location and size cap are taken from the CAPQC_CACHE_DIR and
+CAPQC_CACHE_SIZE environment variables; set CAPQC_CACHE=0 to disable
+caching. CAPQC_MIRROR names the default mirror directory.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+from urllib.parse import urlsplit
+
+log = logging.getLogger(__name__)
+
+DEFAULT_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'ngs_capture_qc')
+DEFAULT_SIZE = 2 * 1024 ** 3
+
+# bytes read at a time when downloading
+CHUNK_SIZE = 1 << 20
+
+# bytes held by each cache directory, measured on the first store of this process
+_sizes = {}
+_sizes_lock = threading.Lock()
+
+_units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+
+
+def parse_size(size):
+    """Convert a size such as 500M or 2G (or a number of bytes) to bytes"""
+
+    size = str(size).strip().upper().rstrip('B')
+    if size and size[-1] in _units:
+        return int(float(size[:-1]) * _units[size[-1]])
+    return int(size)
+
+
+def enabled():
+    return os.environ.get('CAPQC_CACHE', '1') not in ('0', 'false', 'no', '')
+
+
+def cache_dir():
+    return os.environ.get('CAPQC_CACHE_DIR') or DEFAULT_DIR
+
+
+def max_size():
+    return parse_size(os.environ.get('CAPQC_CACHE_SIZE', DEFAULT_SIZE))
+
+
+def file_digest(path, blocksize=1 << 20):
+    """Return the SHA-1 hex digest of the contents of `path`"""
+
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(blocksize), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _stat_file(path):
+    st = os.stat(path)
+    key = '{}:{}:{}'.format(os.path.abspath(path), st.st_size, st.st_mtime_ns)
+    return os.path.join(cache_dir(), 'stat', hashlib.sha1(key.encode()).hexdigest())
+
+
+def _entry_dir(kind, digest):
+    return os.path.join(cache_dir(), 'entries', '{}-{}'.format(kind, digest))
+
+
+def source_digest(path):
+    """Return the content hash of `path`, reusing a previously computed
+    hash if the file's size and modification time are unchanged."""
+
+    stat_file = _stat_file(path)
+    try:
+        with open(stat_file) as f:
+            digest = f.read().strip()
+        os.utime(stat_file, None)
+        return digest
+    except IOError:
+        pass
+
+    digest = file_digest(path)
+    try:
+        os.makedirs(os.path.dirname(stat_file), exist_ok=True)
+        with open(stat_file, 'w') as f:
+            f.write(digest)
+    except OSError as err:
+        log.warning('Could not write to cache: {}'.format(err))
+    return digest
+
+
+def array_digest(*arrays):
+    """Return the SHA-1 hex digest of the types, shapes and contents of `arrays`"""
+
+    import numpy as np
+    digest = hashlib.sha1()
+    for array in arrays:
+        array = np.asarray(array)
+        if array.dtype == object:
+            array = array.astype(str)
+        digest.update('{}{}'.format(array.dtype.str, array.shape).encode())
+        digest.update(np.ascontiguousarray(array).tobytes())
+    return digest.hexdigest()
+
+
+def lookup(path, kind):
+    """Return the entry directory holding data of type `kind` parsed
+    from `path`, or None if there is none. Marks the entry as used."""
+
+    return lookup_digest(kind, source_digest(path))
+
+
+def lookup_digest(kind, digest):
+    """Return the entry directory for data of type `kind` with content
+    hash `digest`, or None if there is none. Marks the entry as used."""
+
+    entry = _entry_dir(kind, digest)
+    meta = os.path.join(entry, 'meta.json')
+    if not os.path.exists(meta):
+        return None
+    try:
+        os.utime(meta, None)
+    except OSError:
+        pass
+    return entry
+
+
+def store(path, kind, writer):
+    """Create the entry for data of type `kind` parsed from `path`.
+    `writer` is called with a directory to write the data to. Returns
+    the entry directory, or None if the cache could not be written."""
+
+    st = os.stat(path)
+    return store_digest(kind, source_digest(path), writer,
+                        {'source': os.path.abspath(path), 'size': st.st_size, 'mtime': st.st_mtime})
+
+
+def store_digest(kind, digest, writer, meta):
+    """Create the entry for data of type `kind` with content hash
+    `digest`, as for `store`. `meta` is a dict describing the source,
+    with at least a 'source' key."""
+
+    entry = _entry_dir(kind, digest)
+    try:
+        os.makedirs(os.path.dirname(entry), exist_ok=True)
+        tmpdir = tempfile.mkdtemp(dir=os.path.dirname(entry), prefix='.tmp-')
+        writer(tmpdir)
+        with open(os.path.join(tmpdir, 'meta.json'), 'w') as f:
+            json.dump(dict(meta, kind=kind, created=time.time()), f)
+        try:
+            os.rename(tmpdir, entry)
+        except OSError:
+            # another process stored the same entry first
+            shutil.rmtree(tmpdir, ignore_errors=True)
+    except OSError as err:
+        log.warning('Could not write to cache: {}'.format(err))
+        return None
+
+    _stored(entry)
+    return entry
+
+
+def _stored(entry):
+    """Add the new `entry` to the running size of the cache, pruning if it is over the cap"""
+
+    root = cache_dir()
+    with _sizes_lock:
+        if root in _sizes:
+            _sizes[root] += _dir_size(entry)
+        else:
+            _sizes[root] = sum(e['bytes'] for e in _contents())
+        over = _sizes[root] > max_size()
+    if over:
+        prune(max_size(), keep=[entry])
+
+
+def load_arrays(kind, digest):
+    """Return the dict of arrays stored by `store_arrays`, or None if there is no such entry"""
+
+    import numpy as np
+    entry = lookup_digest(kind, digest)
+    if entry is None:
+        return None
+    try:
+        with np.load(os.path.join(entry, 'arrays.npz')) as data:
+            return {name: data[name] for name in data.files}
+    except (IOError, ValueError) as err:
+        log.warning('Ignoring unreadable cache entry {}: {}'.format(entry, err))
+        return None
+
+
+def store_arrays(kind, digest, arrays, source):
+    """Store a dict of arrays (without object arrays) as the entry for
+    data of type `kind` with content hash `digest`; `source` describes
+    where the data came from"""
+
+    import numpy as np
+
+    def writer(dirpath):
+        np.savez(os.path.join(dirpath, 'arrays.npz'), **arrays)
+
+    return store_digest(kind, digest, writer, {'source': source})
+
+
+def _url_file(url):
+    return os.path.join(cache_dir(), 'urls', hashlib.sha1(url.encode()).hexdigest())
+
+
+def mirror_path(url, mirror):
+    """Return the copy of `url` in the directory `mirror`, saved under
+    its host and path (as by ``wget -x``) or under its file name, or
+    None if there is none"""
+
+    parts = urlsplit(url)
+    for path in [os.path.join(mirror, parts.netloc, parts.path.lstrip('/')),
+                 os.path.join(mirror, os.path.basename(parts.path))]:
+        if os.path.isfile(path):
+            return path
+    return None
+
+
+def fetch(url, mirror=None):
+    """Return the path of the cached copy of `url`, first downloading it,
+    or copying it from the mirror directory `mirror` (default
+    CAPQC_MIRROR) if it is there, in chunks of CHUNK_SIZE bytes. Returns
+    None if the cache could not be written."""
+
+    name = os.path.basename(urlsplit(url).path) or 'download'
+    url_file = _url_file(url)
+    try:
+        with open(url_file) as f:
+            entry = lookup_digest('download', f.read().strip())
+        if entry is not None and os.path.isfile(os.path.join(entry, name)):
+            os.utime(url_file, None)
+            return os.path.join(entry, name)
+    except IOError:
+        pass
+
+    mirror = mirror or os.environ.get('CAPQC_MIRROR')
+    source = mirror_path(url, mirror) if mirror else None
+    try:
+        os.makedirs(os.path.join(cache_dir(), 'entries'), exist_ok=True)
+        f = tempfile.NamedTemporaryFile(dir=os.path.join(cache_dir(), 'entries'), prefix='.tmp-', delete=False)
+    except OSError as err:
+        log.warning('Could not write to cache: {}'.format(err))
+        return None
+
+    digest = hashlib.sha1()
+    try:
+        if source is None:
+            from urllib.request import urlopen
+            log.info('downloading {}'.format(url))
+            opened = urlopen(url)
+        else:
+            log.info('copying {} from {}'.format(url, source))
+            opened = open(source, 'rb')
+        with f, opened:
+            for chunk in iter(lambda: opened.read(CHUNK_SIZE), b''):
+                digest.update(chunk)
+                f.write(chunk)
+    except BaseException:
+        f.close()
+        os.remove(f.name)
+        raise
+
+    def writer(dirpath):
+        os.rename(f.name, os.path.join(dirpath, name))
+
+    entry = store_digest('download', digest.hexdigest(), writer, {'source': url})
+    if os.path.exists(f.name):
+        os.remove(f.name)
+    if entry is None:
+        return None
+    try:
+        os.makedirs(os.path.dirname(url_file), exist_ok=True)
+        with open(url_file, 'w') as out:
+            out.write(digest.hexdigest())
+    except OSError as err:
+        log.warning('Could not write to cache: {}'.format(err))
+    path = os.path.join(entry, name)
+    if not os.path.exists(path):
+        # evicted by another process since it was stored
+        log.warning('{} was evicted from the cache'.format(url))
+        return None
+    return path
+
+
+def _dir_size(path):
+    return sum(os.path.getsize(os.path.join(root, name))
+               for root, __, names in os.walk(path) for name in names)
+
+
+def entries():
+    """Return a list of dicts describing each cache entry, least
+    recently used first."""
+
+    root = os.path.join(cache_dir(), 'entries')
+    found = []
+    for name in os.listdir(root) if os.path.isdir(root) else []:
+        meta = os.path.join(root, name, 'meta.json')
+        if name.startswith('.') or not os.path.exists(meta):
+            continue
+        with open(meta) as f:
+            info = json.load(f)
+        info.update(name=name, path=os.path.join(root, name),
+                    bytes=_dir_size(os.path.join(root, name)),
+                    last_used=os.path.getmtime(meta))
+        found.append(info)
+    return sorted(found, key=lambda e: e['last_used'])
+
+
+def _sidecars():
+    """Return a list of dicts describing each stat, URL and region index file"""
+
+    found = []
+    for sub in ['stat', 'urls', 'index']:
+        root = os.path.join(cache_dir(), sub)
+        for name in os.listdir(root) if os.path.isdir(root) else []:
+            path = os.path.join(root, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            found.append({'name': os.path.join(sub, name), 'path': path, 'kind': sub, 'source': '',
+                          'bytes': st.st_size, 'last_used': st.st_mtime})
+    return found
+
+
+def _contents():
+    """Entries, stat, URL and index files, least recently used first"""
+
+    return sorted(entries() + _sidecars(), key=lambda e: e['last_used'])
+
+
+def prune(limit, keep=()):
+    """Evict least recently used entries, stat, URL and index files until the
+    cache holds at most `limit` bytes, sparing the entry directories in
+    `keep`. Returns the evicted entries and files."""
+
+    keep = set(keep)
+    with _sizes_lock:
+        current = _contents()
+        total = sum(e['bytes'] for e in current)
+        evicted = []
+        for entry in current:
+            if total <= limit:
+                break
+            if entry['path'] in keep:
+                continue
+            if entry['kind'] in ('stat', 'urls', 'index'):
+                try:
+                    os.remove(entry['path'])
+                except OSError:
+                    pass
+            else:
+                shutil.rmtree(entry['path'], ignore_errors=True)
+            total -= entry['bytes']
+            evicted.append(entry)
+        _sizes[cache_dir()] = total
+    return evicted
+
+
+def clear():
+    """Remove every cache entry, stat, URL and index file"""
+
+    for sub in ['entries', 'stat', 'urls', 'index']:
+        shutil.rmtree(os.path.join(cache_dir(), sub), ignore_errors=True)
+    with _sizes_lock:
+        _sizes.pop(cache_dir(), None)
@@ -0,0 +1,143 @@
+"""
+Run-length encoded per-base coverage of probe tiling
+
+A CoverageTrack holds, for each chromosome, the positions where the
+number of probes covering a base changes and the depth from each
+position on, built from the unmerged probes with a cumulative sum over
+their start (+1) and end (-1) events. Summaries of many intervals,
+such as every exon of a refGene table, are computed from prefix sums
+over the runs without expanding them into bases.
+"""
+
+import numpy as np
+import pandas as pd
+from natsort import natsorted
+
+from ngs_capture_qc.utils import chromosomes
+
+
+def _chrom_key(chrom):
+    return str(chromosomes.get(chrom, chrom))
+
+
+class CoverageTrack(object):
+    """
+    Probe depth along each chromosome. For a chromosome, depth is
+    ``depths[i]`` from ``positions[i]`` up to ``positions[i + 1]``; the
+    first position is 0 and the last run, to the end of the chromosome,
+    has depth 0.
+    """
+
+    def __init__(self, tracks):
+        # chromosome name -> (positions, depths)
+        self.tracks = tracks
+        self._keys = {_chrom_key(chrom): chrom for chrom in tracks}
+
+    @classmethod
+    def from_intervals(cls, chroms, starts, ends):
+        """Build the track from (unmerged) half-open intervals"""
+
+        starts = np.asarray(starts, dtype=np.int64)
+        ends = np.asarray(ends, dtype=np.int64)
+        codes, names = pd.factorize(np.asarray(chroms))
+        tracks = {}
+        for code, chrom in enumerate(names):
+            rows = codes == code
+            positions = np.concatenate(([0], starts[rows], ends[rows]))
+            changes = np.concatenate(([0], np.ones(rows.sum(), dtype=np.int64),
+                                      -np.ones(rows.sum(), dtype=np.int64)))
+            order = np.argsort(positions, kind='stable')
+            positions, depths = positions[order], np.cumsum(changes[order])
+            # keep the depth after the last event at each position, then drop runs that don't change depth
+            last = np.append(positions[1:] != positions[:-1], True)
+            positions, depths = positions[last], depths[last]
+            keep = np.concatenate(([True], depths[1:] != depths[:-1]))
+            positions, depths = positions[keep], depths[keep]
+            if positions[0] != 0:
+                positions, depths = np.concatenate(([0], positions)), np.concatenate(([0], depths))
+            tracks[chrom] = (positions, depths)
+        return cls(tracks)
+
+    def _runs(self, chrom):
+        chrom = self._keys.get(_chrom_key(chrom))
+        if chrom is None:
+            return np.zeros(1, dtype=np.int64), np.zeros(1, dtype=np.int64)
+        return self.tracks[chrom]
+
+    def _groups(self, chroms):
+        codes, names = pd.factorize(np.asarray(chroms))
+        for code, chrom in enumerate(names):
+            yield np.flatnonzero(codes == code), self._runs(chrom)
+
+    def summarize(self, chroms, starts, ends, thresholds=(1,)):
+        """
+        Summarize depth over each half-open interval. Returns a dict of
+        arrays: 'min' and 'mean' depth, and for each k in `thresholds`,
+        the fraction of bases covered at least k times (key k).
+        """
+
+        starts = np.asarray(starts, dtype=np.int64)
+        ends = np.asarray(ends, dtype=np.int64)
+        n = len(starts)
+        result = {'min': np.zeros(n, dtype=np.int64), 'mean': np.zeros(n)}
+        result.update((k, np.zeros(n)) for k in thresholds)
+        lengths = np.maximum(ends - starts, 1)
+        for rows, (positions, depths) in self._groups(chroms):
+            first = np.searchsorted(positions, starts[rows], side='right') - 1
+            last = np.searchsorted(positions, np.maximum(ends[rows], starts[rows] + 1), side='left')
+            # smallest depth over runs first..last-1, with a sentinel so last may be one past the end
+            bounds = np.column_stack((first, last)).ravel()
+            result['min'][rows] = np.minimum.reduceat(np.append(depths, 0), bounds)[::2]
+            widths = np.diff(positions)
+            for key, values in [('mean', depths)] + [(k, depths >= k) for k in thresholds]:
+                # bases (or depth summed over bases) from position 0 to the start of each run
+                prefix = np.concatenate(([0], np.cumsum(values[:-1] * widths)))
+
+                def area(x, run):
+                    return prefix[run] + values[run] * (x - positions[run])
+
+                total = area(ends[rows], last - 1) - area(starts[rows], first)
+                result[key][rows] = total / lengths[rows]
+        return result
+
+    def histogram(self, chroms, starts, ends):
+        """
+        Count the bases at each depth in each half-open interval.
+        Returns arrays (interval, depth, bases), one element for each
+        depth found in each interval, ordered by interval and depth.
+        """
+
+        starts = np.asarray(starts, dtype=np.int64)
+        ends = np.asarray(ends, dtype=np.int64)
+        intervals, run_depths, bases = [], [], []
+        for rows, (positions, depths) in self._groups(chroms):
+            first = np.searchsorted(positions, starts[rows], side='right') - 1
+            last = np.searchsorted(positions, ends[rows], side='left')
+            counts = np.maximum(last - first, 0)
+            interval = np.repeat(rows, counts)
+            run = np.repeat(first, counts) + np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+            run_ends = np.append(positions[1:], np.iinfo(np.int64).max)
+            overlap = np.minimum(ends[interval], run_ends[run]) - np.maximum(starts[interval], positions[run])
+            intervals.append(interval)
+            run_depths.append(depths[run])
+            bases.append(overlap)
+        if not intervals:
+            empty = np.array([], dtype=np.int64)
+            return empty, empty, empty
+        interval, depth, overlap = (np.concatenate(a) for a in (intervals, run_depths, bases))
+        # sum the runs of each interval with the same depth
+        frame = pd.DataFrame({'interval': interval, 'depth': depth, 'bases': overlap})
+        frame = frame[frame['bases'] > 0].groupby(['interval', 'depth'], sort=True)['bases'].sum().reset_index()
+        return frame['interval'].values, frame['depth'].values, frame['bases'].values
+
+    def write_bedgraph(self, outfile, name=None):
+        """Write the covered runs in bedGraph format to the open file `outfile`"""
+
+        if name:
+            outfile.write('track type=bedGraph name="{}"\n'.format(name))
+        for chrom in natsorted(self.tracks):
+            positions, depths = self.tracks[chrom]
+            covered = np.flatnonzero(depths[:-1] > 0)
+            for start, end, depth in zip(positions[covered].tolist(), positions[covered + 1].tolist(),
+                                         depths[covered].tolist()):
+                outfile.write('{}\t{}\t{}\t{}\n'.format(chrom, start, end, depth))
@@ -0,0 +1,259 @@
+"""
+In-process interval arithmetic on NumPy arrays, used in place of bedtools
+"""
+
+import numpy as np
+import pandas as pd
+
+
+def merge_intervals(chroms, starts, ends):
+    """Merge overlapping and book-ended intervals, as ``bedtools merge``
+    does with default arguments.
+
+    `chroms` is a sequence of chromosome names and `starts`/`ends` are
+    integer coordinates. Chromosomes are reported in order of first
+    appearance and intervals within each chromosome are sorted by start.
+    Returns a tuple of arrays (chroms, starts, ends) for the merged
+    intervals.
+    """
+
+    starts = np.asarray(starts, dtype=np.int64)
+    ends = np.asarray(ends, dtype=np.int64)
+    if not len(starts):
+        return np.array([], dtype=object), starts, ends
+
+    # int-code chromosomes in order of first appearance
+    codes, names = pd.factorize(np.asarray(chroms))
+    names = np.asarray(names, dtype=object)
+
+    order = np.lexsort((starts, codes))
+    codes, starts, ends = codes[order], starts[order], ends[order]
+
+    # Offset coordinates by chromosome so a single running maximum of
+    # interval ends never carries over from one chromosome to the next
+    shift = np.int64(1) << 32
+    offset = codes.astype(np.int64) * shift
+    reach = np.maximum.accumulate(ends + offset)
+    breaks = np.flatnonzero(starts[1:] + offset[1:] > reach[:-1]) + 1
+    first_rows = np.concatenate(([0], breaks))
+    last_rows = np.concatenate((breaks - 1, [len(starts) - 1]))
+
+    return (names[codes[first_rows]],
+            starts[first_rows],
+            reach[last_rows] - offset[last_rows])
+
+
+def _chrom_groups(chroms):
+    """Return a dict mapping each distinct value of `chroms` to the
+    array of row indices on that chromosome."""
+
+    codes, names = pd.factorize(np.asarray(chroms))
+    order = np.argsort(codes, kind='stable')
+    bounds = np.searchsorted(codes[order], np.arange(len(names) + 1))
+    return {name: order[bounds[i]:bounds[i + 1]] for i, name in enumerate(names)}
+
+
+def overlap_pairs(a_starts, a_ends, b_starts, b_ends, batch_size=1 << 20):
+    """Find every pair of overlapping intervals between `a` and `b`,
+    which are assumed to be on the same chromosome.
+
+    Intervals are half-open and must share at least one base, as in
+    ``bedtools intersect``. `b` is sorted by start once; each interval
+    in `a` is then compared only against the window of `b` intervals
+    whose start lies within the longest `b` interval of it, so the full
+    cross product is never built. Yields tuples (a_index, b_index) of
+    index arrays in batches of roughly `batch_size` candidate pairs,
+    ordered by `a` index and then by `b` start. All pairs for a given
+    `a` interval are reported in the same batch.
+    """
+
+    a_starts = np.asarray(a_starts, dtype=np.int64)
+    a_ends = np.asarray(a_ends, dtype=np.int64)
+    b_starts = np.asarray(b_starts, dtype=np.int64)
+    b_ends = np.asarray(b_ends, dtype=np.int64)
+    if not len(a_starts) or not len(b_starts):
+        return
+
+    b_order = np.argsort(b_starts, kind='stable')
+    sorted_starts = b_starts[b_order]
+    sorted_ends = b_ends[b_order]
+    max_length = (sorted_ends - sorted_starts).max()
+
+    lo = np.searchsorted(sorted_starts, a_starts - max_length, side='right')
+    hi = np.searchsorted(sorted_starts, a_ends, side='left')
+    counts = np.maximum(hi - lo, 0)
+
+    # split `a` into batches at interval boundaries
+    cumulative = np.cumsum(counts)
+    cuts = np.searchsorted(cumulative, np.arange(batch_size, cumulative[-1], batch_size))
+    cuts = np.unique(np.concatenate(([0], cuts, [len(a_starts)])))
+
+    for first, last in zip(cuts[:-1], cuts[1:]):
+        batch_counts = counts[first:last]
+        a_index = np.repeat(np.arange(first, last), batch_counts)
+        offsets = np.cumsum(batch_counts) - batch_counts
+        window = np.arange(len(a_index)) - np.repeat(offsets, batch_counts)
+        b_sorted = lo[a_index] + window
+        keep = (sorted_ends[b_sorted] > a_starts[a_index]) & \
+               (sorted_starts[b_sorted] < a_ends[a_index])
+        yield a_index[keep], b_order[b_sorted[keep]]
+
+
+def intersect(a_chroms, a_starts, a_ends, b_chroms, b_starts, b_ends,
+              batch_size=1 << 20):
+    """Find every pair of overlapping intervals between `a` and `b`,
+    chromosome by chromosome. Chromosomes are matched by name as given.
+
+    Yields tuples (a_index, b_index) of index arrays into the original
+    inputs; see ``overlap_pairs``.
+    """
+
+    a_starts = np.asarray(a_starts, dtype=np.int64)
+    a_ends = np.asarray(a_ends, dtype=np.int64)
+    b_starts = np.asarray(b_starts, dtype=np.int64)
+    b_ends = np.asarray(b_ends, dtype=np.int64)
+    b_groups = _chrom_groups(b_chroms)
+
+    for chrom, a_rows in _chrom_groups(a_chroms).items():
+        b_rows = b_groups.get(chrom)
+        if b_rows is None:
+            continue
+        for a_index, b_index in overlap_pairs(
+                a_starts[a_rows], a_ends[a_rows],
+                b_starts[b_rows], b_ends[b_rows], batch_size):
+            yield a_rows[a_index], b_rows[b_index]
+
+
+def union_length(chroms, starts, ends):
+    """Return the number of bases covered by any of the intervals,
+    counting bases covered by more than one interval once. Chromosomes
+    are matched by name as given, so callers should normalize names
+    that differ only by a 'chr' prefix first."""
+
+    __, starts, ends = merge_intervals(chroms, starts, ends)
+    return int((ends - starts).sum())
+
+
+def _disjoint_pairs(a_starts, a_ends, b_starts, b_ends):
+    """Find the overlapping pairs between two sorted lists of disjoint
+    intervals on one chromosome, a sweep in O(n + m) pairs. Returns
+    (a_index, b_index) arrays."""
+
+    # b intervals ending after each a starts, up to those starting after it ends
+    lo = np.searchsorted(b_ends, a_starts, side='right')
+    hi = np.searchsorted(b_starts, a_ends, side='left')
+    counts = np.maximum(hi - lo, 0)
+    a_index = np.repeat(np.arange(len(a_starts)), counts)
+    b_index = np.repeat(lo, counts) + np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    return a_index, b_index
+
+
+def _merged_groups(chroms, starts, ends):
+    """Merge the intervals and group them by chromosome, as a dict of
+    chromosome to (starts, ends) arrays, sorted and disjoint."""
+
+    chroms, starts, ends = merge_intervals(chroms, starts, ends)
+    return {chrom: (starts[rows], ends[rows]) for chrom, rows in _chrom_groups(chroms).items()}
+
+
+def intersection_length(a_chroms, a_starts, a_ends, b_chroms, b_starts, b_ends):
+    """Return the number of bases covered by both an interval of `a` and
+    an interval of `b`, counting each base once however many intervals
+    cover it. Chromosomes are matched by name as given.
+
+    Both sets are merged into sorted, disjoint intervals, which are then
+    swept together, so this takes O((n + m) log(n + m)) time and memory
+    proportional to the number of intervals, not bases.
+    """
+
+    b_groups = _merged_groups(b_chroms, b_starts, b_ends)
+    total = 0
+    for chrom, (starts, ends) in _merged_groups(a_chroms, a_starts, a_ends).items():
+        if chrom not in b_groups:
+            continue
+        other_starts, other_ends = b_groups[chrom]
+        a_index, b_index = _disjoint_pairs(starts, ends, other_starts, other_ends)
+        total += int((np.minimum(ends[a_index], other_ends[b_index]) -
+                      np.maximum(starts[a_index], other_starts[b_index])).sum())
+    return total
+
+
+def overlaps_any(a_chroms, a_starts, a_ends, b_chroms, b_starts, b_ends):
+    """Return a boolean mask of the intervals of `a` sharing at least one
+    base with any interval of `b`, as ``bedtools intersect -u``."""
+
+    a_starts = np.asarray(a_starts, dtype=np.int64)
+    a_ends = np.asarray(a_ends, dtype=np.int64)
+    mask = np.zeros(len(a_starts), dtype=bool)
+    b_groups = _merged_groups(b_chroms, b_starts, b_ends)
+    for chrom, rows in _chrom_groups(a_chroms).items():
+        if chrom not in b_groups:
+            continue
+        other_starts, other_ends = b_groups[chrom]
+        # the first merged b interval ending after each a interval starts
+        first = np.searchsorted(other_ends, a_starts[rows], side='right')
+        hit = first < len(other_starts)
+        hit[hit] = other_starts[first[hit]] < a_ends[rows][hit]
+        mask[rows] = hit
+    return mask
+
+
+class IntervalIndex(object):
+    """Half-open intervals on one chromosome, indexed for batches of
+    overlap queries.
+
+    The intervals are sorted by start and laid out as an implicit
+    binary tree, as in cgranges: the node at index i of level k has
+    children i - 2**(k-1) and i + 2**(k-1), and each node records the
+    largest end in its subtree. Queries descend the tree one level at a
+    time, all of them together, dropping the subtrees that end before a
+    query starts or start after it ends, so a batch of queries takes
+    O(log n) array operations.
+    """
+
+    def __init__(self, starts, ends):
+        starts = np.asarray(starts, dtype=np.int64)
+        ends = np.asarray(ends, dtype=np.int64)
+        self.order = np.argsort(starts, kind='stable')
+        self.levels = max(len(starts).bit_length(), 1)
+        size = (1 << self.levels) - 1
+        # pad to a complete tree with intervals that overlap nothing
+        self.starts = np.full(size, np.iinfo(np.int64).max)
+        self.ends = np.full(size, np.iinfo(np.int64).min)
+        self.starts[:len(starts)] = starts[self.order]
+        self.ends[:len(ends)] = ends[self.order]
+        self.max_ends = self.ends.copy()
+        for level in range(1, self.levels):
+            nodes = np.arange((1 << level) - 1, size, 1 << (level + 1))
+            half = 1 << (level - 1)
+            self.max_ends[nodes] = np.maximum(self.max_ends[nodes],
+                                              np.maximum(self.max_ends[nodes - half], self.max_ends[nodes + half]))
+
+    def __len__(self):
+        return len(self.order)
+
+    def overlaps(self, starts, ends):
+        """Find the intervals sharing at least one base with each query
+        interval. Returns (query_index, interval_index) arrays, ordered
+        by query and then by interval start; interval indices are
+        positions in the arrays the index was built from."""
+
+        starts = np.asarray(starts, dtype=np.int64)
+        ends = np.asarray(ends, dtype=np.int64)
+        query = np.arange(len(starts))
+        node = np.full(len(starts), (1 << (self.levels - 1)) - 1)
+        found_query, found_node = [], []
+        for level in range(self.levels - 1, -1, -1):
+            # the first interval of a subtree has its smallest start
+            keep = (self.max_ends[node] > starts[query]) & \
+                   (self.starts[node - ((1 << level) - 1)] < ends[query])
+            query, node = query[keep], node[keep]
+            hit = (self.starts[node] < ends[query]) & (self.ends[node] > starts[query])
+            found_query.append(query[hit])
+            found_node.append(node[hit])
+            if level:
+                half = 1 << (level - 1)
+                query, node = np.concatenate((query, query)), np.concatenate((node - half, node + half))
+        query, node = np.concatenate(found_query), np.concatenate(found_node)
+        order = np.lexsort((node, query))
+        return query[order], self.order[node[order]]
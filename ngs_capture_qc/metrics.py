@@ -0,0 +1,102 @@
+"""
+Per-stage timing and profiling for subcommands
+
+Subcommands wrap each step of their work in a named stage::
+
+    with metrics.stage('merge') as stage:
+        merged = merge_probes(probes)
+        stage.rows = len(probes)
+
+Each stage records its wall time, CPU time (including that of finished
+child processes), the peak resident set size of the process so far and,
+when ``rows`` is set, rows per second. ``capqc --metrics FILE`` writes
+the records for a run as JSON, and ``capqc --profile STAGE`` runs the
+named stage under cProfile and dumps the stats.
+"""
+
+import json
+import logging
+import os
+import sys
+import time
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+log = logging.getLogger(__name__)
+
+# Records of the completed stages, and the profiling settings, for this run
+records = []
+_profile = {'stage': None, 'outfile': None}
+
+
+def configure(profile=None, profile_output=None):
+    """Start a new run, profiling the stage named `profile` (if any) to `profile_output`"""
+
+    del records[:]
+    _profile['stage'] = profile
+    _profile['outfile'] = profile_output or (profile and '{}.prof'.format(profile))
+
+
+def peak_rss_mb():
+    """Peak resident set size of this process, in MB"""
+
+    if resource is None:
+        return None
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / (1024.0 ** 2 if sys.platform == 'darwin' else 1024.0)
+
+
+def _cpu_seconds():
+    t = os.times()
+    return time.process_time() + t.children_user + t.children_system
+
+
+class stage(object):
+    """Context manager timing the stage `name`; set `rows` to the number of rows processed"""
+
+    def __init__(self, name, rows=None):
+        self.name = name
+        self.rows = rows
+        self.profiler = None
+
+    def __enter__(self):
+        if _profile['stage'] == self.name:
+            import cProfile
+            self.profiler = cProfile.Profile()
+        self.wall = time.perf_counter()
+        self.cpu = _cpu_seconds()
+        if self.profiler:
+            self.profiler.enable()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.profiler:
+            self.profiler.disable()
+            self.profiler.dump_stats(_profile['outfile'])
+            log.info('wrote profile of {} to {}'.format(self.name, _profile['outfile']))
+        wall = time.perf_counter() - self.wall
+        records.append({
+            'stage': self.name,
+            'wall_seconds': round(wall, 6),
+            'cpu_seconds': round(_cpu_seconds() - self.cpu, 6),
+            'peak_rss_mb': peak_rss_mb(),
+            'rows': self.rows,
+            'rows_per_second': round(self.rows / wall, 1) if self.rows is not None and wall > 0 else None,
+        })
+        return False
+
+
+def write(outfile, command=None, argv=None):
+    """Write the stage records as JSON to `outfile` ('-' for stdout)"""
+
+    report = {'command': command, 'argv': argv, 'stages': records}
+    if outfile == '-':
+        json.dump(report, sys.stdout, indent=2)
+        sys.stdout.write('\n')
+    else:
+        with open(outfile, 'w') as f:
+            json.dump(report, f, indent=2)
@@ -0,0 +1,167 @@
+"""
+Run bedtools as pipelines of processes connected by pipes
+
+The processes of a Pipeline are started at once, each reading the
+output of the one before (eg `bedtools merge -i stdin | bedtools
+intersect -a stdin ...`), and the output of the last is read as it is
+written, so no intermediate files are needed. Independent pipelines run
+concurrently; use ``read_lines`` to drain one on a thread while another
+is read.
+
+A Bedtools runner for a singularity image starts one container instance
+on its first command and runs every command in it, so the image is
+mounted once however many times bedtools is run.
+"""
+
+import io
+import itertools
+import logging
+import os
+import subprocess
+import threading
+
+log = logging.getLogger(__name__)
+
+
+_instances = itertools.count()
+
+
+def bedtools_command(bedtools, *args):
+    """
+    Return the arguments running `bedtools <args>`, where `bedtools` is
+    a Bedtools runner, the path given on the command line or a
+    singularity exec prefix
+    """
+    if isinstance(bedtools, Bedtools):
+        return bedtools.command(*args)
+    return [x for x in bedtools.split(' ')] + ['bedtools'] + list(args)
+
+
+class Bedtools(object):
+    """
+    Runs bedtools from `path`, the bedtools argument of create_files and
+    summarize_assay. For a singularity image (ending in img), the first
+    command starts a singularity instance of it, with the working
+    directory bound, and every command is run in that instance until
+    the runner is closed. If the instance can't be started, each
+    command starts its own container, as `singularity exec` does.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.image = path.endswith('img')
+        self.instance = None
+        self._prefix = None
+
+    def _start(self):
+        cwd = os.getcwd()
+        name = 'capqc-{}-{}'.format(os.getpid(), next(_instances))
+        try:
+            subprocess.run(['singularity', 'instance', 'start', '--bind', cwd, self.path, name],
+                           check=True, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        except (OSError, subprocess.CalledProcessError) as err:
+            log.warning('could not start a singularity instance of {}, running a container per command: {}'.format(
+                self.path, getattr(err, 'stderr', None) or err))
+            return ['singularity', 'exec', '--bind', cwd, '--pwd', cwd, self.path]
+        log.info('started singularity instance {} of {}'.format(name, self.path))
+        self.instance = name
+        return ['singularity', 'exec', '--pwd', cwd, 'instance://' + name]
+
+    def command(self, *args):
+        """Return the arguments running `bedtools <args>`"""
+        if self._prefix is None:
+            self._prefix = self._start() if self.image else [x for x in self.path.split(' ')]
+        return self._prefix + ['bedtools'] + list(args)
+
+    def close(self):
+        """Stop the singularity instance, if one was started"""
+        if self.instance is not None:
+            subprocess.run(['singularity', 'instance', 'stop', self.instance],
+                           stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            self.instance = None
+        self._prefix = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class Pipeline(object):
+    """
+    Processes running `commands`, each reading the stdout of the one
+    before. `input`, an iterable of str, is written to the stdin of the
+    first on a thread. Iterate over the pipeline for the lines written
+    by the last; leaving a ``with`` block waits for the processes and
+    raises CalledProcessError if any failed.
+    """
+
+    def __init__(self, commands, input=None):
+        self.commands = commands
+        self.processes = []
+        stdin = subprocess.DEVNULL if input is None else subprocess.PIPE
+        for command in commands:
+            log.debug(' '.join(command))
+            process = subprocess.Popen(command, stdin=stdin, stdout=subprocess.PIPE)
+            if self.processes:
+                # only the next process holds the pipe, so it gets SIGPIPE if that one exits
+                self.processes[-1].stdout.close()
+            self.processes.append(process)
+            stdin = process.stdout
+        self.stdout = io.TextIOWrapper(self.processes[-1].stdout, encoding='utf-8')
+        self._feeder = None
+        if input is not None:
+            self._feeder = threading.Thread(target=self._feed, args=(input, ), daemon=True)
+            self._feeder.start()
+
+    def _feed(self, input):
+        stdin = io.TextIOWrapper(self.processes[0].stdin, encoding='utf-8')
+        try:
+            stdin.writelines(input)
+            stdin.close()
+        except BrokenPipeError:
+            pass
+
+    def __iter__(self):
+        return iter(self.stdout)
+
+    def wait(self):
+        """Wait for the processes to exit, raising CalledProcessError if any failed"""
+        self.stdout.close()
+        if self._feeder is not None:
+            self._feeder.join()
+        for command, process in zip(self.commands, self.processes):
+            if process.wait():
+                raise subprocess.CalledProcessError(process.returncode, command)
+
+    def kill(self):
+        for process in self.processes:
+            if process.poll() is None:
+                process.kill()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.kill()
+            self.stdout.close()
+            for process in self.processes:
+                process.wait()
+        else:
+            self.wait()
+
+
+def read_lines(pipeline, executor):
+    """
+    Read all of the output of `pipeline` on `executor`, returning a
+    Future for the list of lines; the pipeline is waited for as in
+    Pipeline.wait
+    """
+
+    def read():
+        with pipeline:
+            return list(pipeline)
+    return executor.submit(read)
+
@@ -0,0 +1,366 @@
+"""
+Genomic region queries, using a binned index over BGZF-compressed files
+
+Regions are given as ``chrom:start-end`` (1-based, inclusive, as in
+tabix and samtools) or ``chrom``, or as the transcribed regions of
+genes. Chromosome names are matched with and without the 'chr' prefix.
+
+For BGZF-compressed BED and refGene files an index is built on first
+use and saved next to the file as ``<file>.cqi``, or in the cache
+directory if the file's directory can't be written. Like a tabix index it
+maps each chromosome and UCSC bin (of the hierarchical binning scheme
+in the SAM specification) to chunks of virtual offsets, so a query
+only decompresses the blocks holding overlapping lines. Unlike tabix,
+the input does not need to be sorted. Other files are scanned.
+"""
+
+import hashlib
+import logging
+import os
+from collections import OrderedDict, namedtuple
+
+import numpy as np
+
+from ngs_capture_qc import bgzf, cache
+from ngs_capture_qc.utils import Opener, chromosomes
+
+log = logging.getLogger(__name__)
+
+# 0-based columns holding the chromosome, start and end of each line
+COLUMNS = {
+    'bed': (0, 1, 2),
+    'refgene': (2, 4, 5),
+}
+
+INDEX_SUFFIX = '.cqi'
+
+# bin levels of the binning scheme, as (shift, first bin) from largest to smallest
+_LEVELS = [(26, 1), (23, 9), (20, 73), (17, 585), (14, 4681)]
+
+
+class Region(namedtuple('Region', 'chrom start end')):
+    """A 0-based, half-open region; `end` is None for the rest of the chromosome"""
+
+    __slots__ = ()
+
+    def overlaps(self, chrom, start, end):
+        if isinstance(chrom, bytes):
+            chrom = chrom.decode()
+        return (_chrom_key(chrom) == _chrom_key(self.chrom) and end > self.start and
+                (self.end is None or start < self.end))
+
+    def __str__(self):
+        if self.end is None:
+            return self.chrom
+        return '{}:{}-{}'.format(self.chrom, self.start + 1, self.end)
+
+
+def _chrom_key(chrom):
+    return chromosomes.get(chrom, chrom)
+
+
+def parse_region(text):
+    """Parse ``chrom``, ``chrom:start`` or ``chrom:start-end`` (1-based, inclusive) into a Region"""
+
+    chrom, __, span = text.strip().partition(':')
+    if not chrom:
+        raise ValueError('invalid region "{}"'.format(text))
+    if not span:
+        return Region(chrom, 0, None)
+    start, __, end = span.replace(',', '').partition('-')
+    try:
+        start = int(start) - 1
+        end = int(end) if end else None
+    except ValueError:
+        raise ValueError('invalid region "{}"'.format(text))
+    if start < 0 or (end is not None and end <= start):
+        raise ValueError('invalid region "{}"'.format(text))
+    return Region(chrom, start, end)
+
+
+def gene_regions(table, genes):
+    """Return the regions spanned by the transcripts of `genes` in the RefGeneTable `table`"""
+
+    genes = set(genes)
+    rows = np.flatnonzero(np.isin(table['name2'], list(genes)))
+    missing = genes - set(table['name2'][rows].tolist())
+    if missing:
+        raise ValueError('genes not found in refgene: {}'.format(', '.join(sorted(missing))))
+    return [Region(chrom, start, end) for chrom, start, end in
+            zip(table.chrom[rows].tolist(), table['txStart'][rows].tolist(), table['txEnd'][rows].tolist())]
+
+
+def regions_from_args(region_args, gene_args, refgene, format):
+    """Return the regions selected by --region and --region-genes options (or None if neither was
+    given), looking genes up in the `refgene` file of the given format"""
+
+    if not region_args and not gene_args:
+        return None
+    regions = [parse_region(r) for r in region_args or []]
+    if gene_args:
+        from ngs_capture_qc.utils import RefGeneTable
+        genes = [g for arg in gene_args for g in arg.split(',') if g]
+        regions.extend(gene_regions(RefGeneTable.read(refgene, format=format), genes))
+    return regions
+
+
+def spanning_regions(chroms, starts, ends):
+    """Return a region for each chromosome spanning all of the intervals on it"""
+
+    names, codes = np.unique(np.asarray(chroms).astype(str), return_inverse=True)
+    lows = np.full(len(names), np.iinfo(np.int64).max, dtype=np.int64)
+    highs = np.zeros(len(names), dtype=np.int64)
+    np.minimum.at(lows, codes, np.asarray(starts, dtype=np.int64))
+    np.maximum.at(highs, codes, np.asarray(ends, dtype=np.int64))
+    return [Region(chrom, start, end) for chrom, start, end in zip(names.tolist(), lows.tolist(), highs.tolist())]
+
+
+def overlapping(chroms, starts, ends, regions):
+    """Boolean mask of the intervals overlapping any of `regions`"""
+
+    keys = np.array([_chrom_key(c) for c in chroms], dtype=object)
+    starts = np.asarray(starts)
+    ends = np.asarray(ends)
+    mask = np.zeros(len(keys), dtype=bool)
+    for region in regions:
+        hit = (keys == _chrom_key(region.chrom)) & (ends > region.start)
+        if region.end is not None:
+            hit &= starts < region.end
+        mask |= hit
+    return mask
+
+
+def reg2bin(start, end):
+    """The smallest bin holding the 0-based, half-open interval"""
+
+    end -= 1
+    for shift, first in reversed(_LEVELS):
+        if start >> shift == end >> shift:
+            return first + (start >> shift)
+    return 0
+
+
+def reg2bins(start, end):
+    """All bins that may hold intervals overlapping the 0-based, half-open region"""
+
+    end -= 1
+    bins = [0]
+    for shift, first in _LEVELS:
+        bins.extend(range(first + (start >> shift), first + (end >> shift) + 1))
+    return bins
+
+
+def _split_line(line, columns, ncols):
+    fields = line.split(b'\t', ncols)
+    return fields[columns[0]], int(fields[columns[1]]), int(fields[columns[2]])
+
+
+class RegionIndex(object):
+    """
+    Chunks of virtual offsets for each chromosome and bin of a BGZF file.
+
+    Consecutive lines in the same chromosome and bin share a chunk, so
+    a file sorted by position has few chunks per bin.
+    """
+
+    def __init__(self, chrom_names, chunk_chroms, chunk_bins, chunk_starts, chunk_ends, source=None):
+        self.chrom_names = chrom_names
+        self.chunk_chroms = chunk_chroms
+        self.chunk_bins = chunk_bins
+        self.chunk_starts = chunk_starts
+        self.chunk_ends = chunk_ends
+        self.source = source
+
+    @classmethod
+    def build(cls, path, format='bed', threads=None):
+        """Index the BGZF file `path`, whose lines are in `format` ('bed' or 'refgene')"""
+
+        columns = COLUMNS[format]
+        ncols = max(columns) + 1
+        chrom_codes = {}
+        chunks = []  # [chrom code, bin, start, end]
+
+        def add(line, start, end):
+            # called with each complete line and its virtual offsets
+            if not line.strip() or line.startswith((b'#', b'track', b'browser')):
+                return
+            chrom, beg, stop = _split_line(line, columns, ncols)
+            code = chrom_codes.setdefault(chrom, len(chrom_codes))
+            bin = reg2bin(beg, max(stop, beg + 1))
+            if chunks and chunks[-1][0] == code and chunks[-1][1] == bin and chunks[-1][3] == start:
+                chunks[-1][3] = end
+            else:
+                chunks.append([code, bin, start, end])
+
+        with open(path, 'rb') as f:
+            carry, carry_start = b'', None
+            for offset, data in bgzf.iter_blocks(f, threads=threads):
+                pos = 0
+                while True:
+                    newline = data.find(b'\n', pos)
+                    if newline < 0:
+                        break
+                    start = carry_start if carry else (offset << 16) | pos
+                    # the next line starts after the newline, possibly in the next block
+                    end = (offset << 16) | (newline + 1)
+                    add(carry + data[pos:newline], start, end)
+                    carry, pos = b'', newline + 1
+                if pos < len(data):
+                    if not carry:
+                        carry_start = (offset << 16) | pos
+                    carry += data[pos:]
+            if carry:
+                add(carry, carry_start, None)
+
+        if chunks and chunks[-1][3] is None:
+            # a final line without a newline runs to the end of the file
+            chunks[-1][3] = np.iinfo(np.uint64).max
+        chunks = np.array(chunks, dtype=np.uint64).reshape(-1, 4)
+        names = sorted(chrom_codes, key=chrom_codes.get)
+        st = os.stat(path)
+        return cls(np.array([n.decode() for n in names], dtype=str), chunks[:, 0].astype(np.int32),
+                   chunks[:, 1].astype(np.int32), chunks[:, 2], chunks[:, 3],
+                   {'size': st.st_size, 'mtime_ns': st.st_mtime_ns, 'format': format})
+
+    def save(self, path):
+        with open(path, 'wb') as f:
+            np.savez(f, chrom_names=self.chrom_names, chunk_chroms=self.chunk_chroms,
+                     chunk_bins=self.chunk_bins, chunk_starts=self.chunk_starts, chunk_ends=self.chunk_ends,
+                     source=np.array([self.source['size'], self.source['mtime_ns']], dtype=np.int64),
+                     format=np.array(self.source['format']))
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            size, mtime_ns = data['source'].tolist()
+            return cls(data['chrom_names'], data['chunk_chroms'], data['chunk_bins'],
+                       data['chunk_starts'], data['chunk_ends'],
+                       {'size': size, 'mtime_ns': mtime_ns, 'format': str(data['format'])})
+
+    def is_current(self, path, format):
+        st = os.stat(path)
+        return (self.source['size'], self.source['mtime_ns'], self.source['format']) == \
+            (st.st_size, st.st_mtime_ns, format)
+
+    def query(self, regions):
+        """Return merged (start, end) virtual offset chunks that may hold lines overlapping `regions`"""
+
+        keys = [_chrom_key(c) for c in self.chrom_names.tolist()]
+        mask = np.zeros(len(self.chunk_starts), dtype=bool)
+        for region in regions:
+            codes = [i for i, key in enumerate(keys) if key == _chrom_key(region.chrom)]
+            on_chrom = np.isin(self.chunk_chroms, codes)
+            if region.end is None:
+                mask |= on_chrom
+            else:
+                mask |= on_chrom & np.isin(self.chunk_bins, reg2bins(region.start, region.end))
+        order = np.argsort(self.chunk_starts[mask], kind='stable')
+        merged = []
+        for start, end in zip(self.chunk_starts[mask][order].tolist(), self.chunk_ends[mask][order].tolist()):
+            if merged and start <= merged[-1][1]:
+                merged[-1][1] = max(merged[-1][1], end)
+            else:
+                merged.append([start, end])
+        return merged
+
+
+def index_path(path):
+    return path + INDEX_SUFFIX
+
+
+def cached_index_path(path):
+    """Where the index of `path` is kept in the cache directory"""
+
+    digest = hashlib.sha1(os.path.abspath(path).encode()).hexdigest()
+    return os.path.join(cache.cache_dir(), 'index', digest + INDEX_SUFFIX)
+
+
+def _index_paths(path):
+    return [index_path(path)] + ([cached_index_path(path)] if cache.enabled() else [])
+
+
+def save_index(index, path):
+    """Save the index of `path` next to it or, failing that, in the cache
+    directory, returning where it was saved (None if it could not be)"""
+
+    for ipath in _index_paths(path):
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(ipath)), exist_ok=True)
+            index.save(ipath)
+            return ipath
+        except (IOError, OSError) as err:
+            log.info('Could not save index {}: {}'.format(ipath, err))
+    log.warning('Could not save an index of {}'.format(path))
+    return None
+
+
+def open_index(path, format='bed'):
+    """Return the index of the BGZF file `path`, building and saving it if
+    it is missing or out of date, or None if `path` is not BGZF"""
+
+    if not bgzf.is_bgzf(path):
+        return None
+    for ipath in _index_paths(path):
+        if os.path.exists(ipath):
+            index = RegionIndex.load(ipath)
+            if index.is_current(path, format):
+                if ipath != index_path(path):
+                    # mark it as used, as for cache entries
+                    os.utime(ipath, None)
+                return index
+    log.info('indexing {}'.format(path))
+    index = RegionIndex.build(path, format)
+    save_index(index, path)
+    return index
+
+
+def _read_chunks(f, chunks, threads, executor):
+    """Yield the uncompressed bytes between each pair of (start, end)
+    virtual offsets in `chunks`, in order, decompressing each block once"""
+
+    blocks, loaded = OrderedDict(), -1
+    for start, end in chunks:
+        first, within = start >> 16, start & 0xffff
+        last, cut = end >> 16, end & 0xffff
+        if first not in blocks or last > loaded:
+            # read to the end of this chunk, dropping the blocks of previous chunks
+            blocks, loaded = OrderedDict(bgzf.iter_blocks(f, first, threads, executor, end=last)), last
+        data = []
+        for offset, block in blocks.items():
+            if offset < first:
+                continue
+            if offset > last or (offset == last and not cut):
+                break
+            block = block[:cut] if offset == last else block
+            data.append(block[within:] if offset == first else block)
+        yield b''.join(data)
+
+
+def fetch(path, regions, format='bed', threads=None):
+    """Return the lines of `path` (in `format`) overlapping any of
+    `regions`, in file order. BGZF files are read through their index;
+    other files are scanned."""
+
+    columns = COLUMNS[format]
+    ncols = max(columns) + 1
+
+    def keep(line):
+        if not line.strip() or line.startswith((b'#', b'track', b'browser')):
+            return False
+        chrom, start, end = _split_line(line, columns, ncols)
+        return any(r.overlaps(chrom, start, end) for r in regions)
+
+    index = open_index(path, format)
+    if index is None:
+        with Opener('rb')(path) as f:
+            return [line.decode() for line in f if keep(line)]
+
+    from concurrent.futures import ThreadPoolExecutor
+    threads = threads or bgzf.default_threads()
+    lines = []
+    with open(path, 'rb') as f, ThreadPoolExecutor(threads) as executor:
+        for data in _read_chunks(f, index.query(regions), threads, executor):
+            for line in data.splitlines(True):
+                if keep(line):
+                    lines.append(line.decode())
+    return lines
@@ -9,7 +9,7 @@ from argparse import RawDescriptionHelpFormatter
 import sys
 import os
 import logging
-from ngs_capture_qc import subcommands, __version__ as version
+from ngs_capture_qc import subcommands, metrics, __version__ as version
 
 def main(argv):
     action, arguments = parse_arguments(argv)
@@ -29,15 +29,20 @@ def main(argv):
     # set up logging
     logging.basicConfig(stream=sys.stdout, format=logformat, level=loglevel)
 
-    return action(arguments)
+    # time the whole action as a stage named for the subcommand
+    metrics.configure(arguments.profile, arguments.profile_output)
+    try:
+        with metrics.stage(arguments.subparser_name):
+            return action(arguments)
+    finally:
+        if arguments.metrics:
+            metrics.write(arguments.metrics, arguments.subparser_name, argv)
 
-def parse_arguments(argv):
+def add_global_arguments(parser):
     """
-    Create the argument parser
+    Add the options that apply to every subcommand
     """
 
-    parser = argparse.ArgumentParser(description=__doc__)
-
     parser.add_argument('-V', '--version', action='version',
         version = version,
         help = 'Print the version number and exit')
@@ -49,6 +54,34 @@ def parse_arguments(argv):
     parser.add_argument('-q', '--quiet',
         action='store_const', dest='verbosity', const=0,
         help='Suppress output')
+    parser.add_argument('--metrics', metavar='FILE',
+        help='Write wall time, CPU time, peak memory and rows per second '
+             'for each stage of the subcommand to FILE as JSON (- for stdout)')
+    parser.add_argument('--profile', metavar='STAGE',
+        help='Profile the named stage (or the subcommand name for all of it) with cProfile')
+    parser.add_argument('--profile-output', metavar='FILE',
+        help='File for the --profile stats (default STAGE.prof)')
+
+def selected_subcommand(argv):
+    """
+    Return the name of the subcommand in `argv`, if any, without
+    building the full parser
+    """
+
+    parser = argparse.ArgumentParser(add_help=False)
+    add_global_arguments(parser)
+    parser.add_argument('subparser_name', nargs='?')
+    parser.add_argument('remainder', nargs=argparse.REMAINDER)
+    known, __ = parser.parse_known_args(argv)
+    return known.subparser_name
+
+def parse_arguments(argv):
+    """
+    Create the argument parser
+    """
+
+    parser = argparse.ArgumentParser(description=__doc__)
+    add_global_arguments(parser)
 
     ##########################
     # Setup all sub-commands #
@@ -63,19 +96,24 @@ def parse_arguments(argv):
     # End help sub-command
 
     actions = {}
+    selected = selected_subcommand(argv)
 
-    for name, mod in subcommands.itermodules(os.path.split(subcommands.__file__)[0]):
+    for name, doc in subcommands.iterdocs(os.path.split(subcommands.__file__)[0]):
         # set up subcommand help text. The first line of the dosctring
         # in the module is displayed as the help text in the
         # script-level help message (`script -h`). The entire
         # docstring is displayed in the help message for the
         # individual subcommand ((`script action -h`)).
         subparser = subparsers.add_parser(name,
-                                          help = mod.__doc__.lstrip().split('\n', 1)[0],
-                                          description = mod.__doc__,
+                                          help = doc.lstrip().split('\n', 1)[0],
+                                          description = doc,
                                           formatter_class = RawDescriptionHelpFormatter)
-        mod.build_parser(subparser)
-        actions[name] = mod.action
+        # Only the selected subcommand is imported, so its
+        # dependencies are not loaded for other subcommands or `-h`
+        if name == selected:
+            mod = subcommands.load(name)
+            mod.build_parser(subparser)
+            actions[name] = mod.action
 
     # Determine we have called ourself (e.g. "help <action>")
     # Set arguments to display help if parameter is set
@@ -1,11 +1,29 @@
+import ast
 import glob
+import importlib
 from os.path import splitext, split, join
 import argparse
 
+def _commands(subcommands_path):
+    return [x for x in [splitext(split(p)[1])[0] for p in sorted(glob.glob(join(subcommands_path, '*.py')))] if not x.startswith('_')]
+
 def itermodules(subcommands_path, root=__name__):
 
-    commands = [x for x in [splitext(split(p)[1])[0] for p in glob.glob(join(subcommands_path, '*.py'))] if not x.startswith('_')]
+    commands = _commands(subcommands_path)
 
     for command in commands:
         yield command, __import__('%s.%s' % (root, command), fromlist=[command])
 
+def iterdocs(subcommands_path):
+    """Yield the name and docstring of each subcommand, read from the
+    module source so that the module (and its dependencies) are not
+    imported"""
+
+    for command in _commands(subcommands_path):
+        with open(join(subcommands_path, command + '.py')) as f:
+            yield command, ast.get_docstring(ast.parse(f.read()), clean=False) or ''
+
+def load(command, root=__name__):
+    """Import and return the module for a single subcommand"""
+
+    return importlib.import_module('%s.%s' % (root, command))
@@ -0,0 +1,75 @@
+"""
+Inspect and prune the cache of parsed refGene tables
+
+Parsed refGene tables are cached in CAPQC_CACHE_DIR (default
+~/.cache/ngs_capture_qc) and memory-mapped on later runs. The cache is
+capped at CAPQC_CACHE_SIZE bytes (default 2G), evicting the least
+recently used tables first.
+
+Downloaded files, such as the UCSC refGene table, are kept in the cache
+by content; ``fetch`` downloads them ahead of time, or copies them from
+a mirror directory (--mirror or CAPQC_MIRROR) on nodes without network
+access.
+
+usage:
+
+ capqc cache list
+ capqc cache prune --max-size 500M
+ capqc cache clear
+ capqc cache fetch --mirror /shared/mirror [--url URL ...]
+"""
+
+import sys
+import time
+import logging
+
+from ngs_capture_qc import cache
+
+log = logging.getLogger(__name__)
+
+def build_parser(parser):
+    parser.add_argument('command', nargs='?', choices=['list', 'prune', 'clear', 'fetch'], default='list',
+                        help='list entries (default), prune to the size cap, remove all entries, '
+                        'or download urls into the cache')
+    parser.add_argument('--url', action='append', dest='urls',
+                        help='URL to fetch; may be repeated (default: the hg19 UCSC refGene table)')
+    parser.add_argument('--mirror',
+                        help='Directory to copy fetched files from, holding them by host and path '
+                        'or by file name (default CAPQC_MIRROR)')
+    parser.add_argument('--max-size',
+                        help='Size cap for prune, eg 500M or 2G (default CAPQC_CACHE_SIZE)')
+
+def action(args):
+    if args.urls and args.command != 'fetch':
+        log.error('--url is only used by fetch')
+        sys.exit(1)
+    if args.command == 'fetch':
+        if not cache.enabled():
+            log.error('the cache is disabled (CAPQC_CACHE=0)')
+            sys.exit(1)
+        if not args.urls:
+            from ngs_capture_qc.utils import REFGENE_URL
+            args.urls = [REFGENE_URL]
+        for url in args.urls:
+            try:
+                path = cache.fetch(url, args.mirror)
+            except OSError as err:
+                log.error('could not fetch {}: {}'.format(url, err))
+                sys.exit(1)
+            if path is None:
+                sys.exit(1)
+            sys.stdout.write('{}\t{}\n'.format(url, path))
+    elif args.command == 'clear':
+        cache.clear()
+    elif args.command == 'prune':
+        limit = cache.parse_size(args.max_size) if args.max_size else cache.max_size()
+        for entry in cache.prune(limit):
+            sys.stdout.write('removed\t{}\t{}\n'.format(entry['name'], entry['source']))
+
+    entries = cache.entries()
+    sys.stdout.write('{}\t{} entries\t{} bytes\n'.format(
+        cache.cache_dir(), len(entries), sum(e['bytes'] for e in entries)))
+    for entry in entries:
+        sys.stdout.write('\t'.join([entry['name'], str(entry['bytes']),
+                                    time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(entry['last_used'])),
+                                    entry['source']]) + '\n')
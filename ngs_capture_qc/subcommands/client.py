@@ -0,0 +1,123 @@
+"""
+Send summarize and per-gene coverage queries to ``capqc serve``
+
+Requests go to the service's Unix socket (--socket, default CAPQC_SOCKET)
+or, without one, to its port on localhost (--port). ``summarize`` writes
+the same files as summarize_assay (with --engine native), ``coverage``
+prints the per-refgene summary of each transcript of the given genes, and
+``status`` describes the refgene table the service holds.
+
+usage:
+
+ capqc client --socket /tmp/capqc.sock summarize assay.bed genes.txt --outdir out
+ capqc client coverage assay.bed EGFR,KRAS
+ capqc client status
+"""
+
+import http.client
+import json
+import logging
+import os
+import socket
+import sys
+
+log = logging.getLogger(__name__)
+
+DEFAULT_PORT = 8765
+
+def build_parser(parser):
+    parser.add_argument('--socket', default=os.environ.get('CAPQC_SOCKET'),
+                        help='Unix socket of the service (default CAPQC_SOCKET)')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT,
+                        help='Port of the service on localhost, without --socket (default: %(default)s)')
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    summarize = commands.add_parser('summarize', help='Summarize an assay, as summarize_assay')
+    summarize.add_argument('bed', help="Assay Reference bed file")
+    summarize.add_argument('genes', help="Gene, RefSeq for assay")
+    summarize.add_argument('--outdir', required=False, help="Output directory for summary scripts")
+    summarize.add_argument('--region', action='append',
+                           help='Only summarize probes and refgenes overlapping this region, chr:start-end '
+                                '(1-based, inclusive) or chr. May be repeated')
+    summarize.add_argument('--region-genes', action='append', metavar='GENES',
+                           help='Only summarize probes and refgenes overlapping these genes (comma-separated). '
+                                'May be repeated')
+    summarize.add_argument('--depth', action='store_true',
+                           help='Also write exon_depth_summary.txt and depth_histogram.txt')
+    summarize.add_argument('--depth-thresholds', default='1,2,5',
+                           help='Comma-separated depths k for the fraction of each exon covered by at least k '
+                                'probes with --depth (default: 1,2,5)')
+
+    coverage = commands.add_parser('coverage', help='Report the coverage of each transcript of some genes')
+    coverage.add_argument('bed', help="Assay Reference bed file")
+    coverage.add_argument('gene_names', nargs='+', metavar='genes', help='Gene names (comma-separated)')
+
+    commands.add_parser('status', help='Describe the refgene table held by the service')
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    """An HTTPConnection to a server listening on the Unix socket `socket_path`"""
+
+    def __init__(self, socket_path, timeout=None):
+        super(UnixHTTPConnection, self).__init__('localhost', timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if self.timeout is not None:
+            self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+def request(path, payload=None, socket_path=None, port=DEFAULT_PORT, timeout=None):
+    """
+    Send `payload` to the service as JSON (or GET `path` without one), returning the decoded
+    response. Raises ValueError with the service's message if the request failed.
+    """
+    if socket_path:
+        conn = UnixHTTPConnection(socket_path, timeout)
+    else:
+        conn = http.client.HTTPConnection('127.0.0.1', port, timeout=timeout)
+    try:
+        if payload is None:
+            conn.request('GET', path)
+        else:
+            conn.request('POST', path, json.dumps(payload).encode(), {'Content-Type': 'application/json'})
+        response = conn.getresponse()
+        result = json.loads(response.read().decode())
+    finally:
+        conn.close()
+    if response.status != 200:
+        raise ValueError(result.get('error', response.reason))
+    return result
+
+def action(args):
+    if args.command == 'summarize':
+        path, payload = '/summarize', {
+            'bed': os.path.abspath(args.bed), 'genes': os.path.abspath(args.genes),
+            'region': args.region, 'region_genes': args.region_genes,
+            'depth': args.depth, 'depth_thresholds': args.depth_thresholds}
+    elif args.command == 'coverage':
+        path, payload = '/coverage', {
+            'bed': os.path.abspath(args.bed),
+            'genes': [g for arg in args.gene_names for g in arg.split(',') if g]}
+    else:
+        path, payload = '/status', None
+
+    try:
+        result = request(path, payload, args.socket, args.port)
+    except (OSError, ValueError) as err:
+        log.error('Error: {}'.format(err))
+        sys.exit(1)
+
+    if args.command == 'summarize':
+        out = args.outdir if args.outdir else ''
+        for name, text in sorted(result['files'].items()):
+            with open(os.path.join(out, name), 'w', newline='') as f:
+                f.write(text)
+    elif args.command == 'coverage':
+        sys.stdout.write('\t'.join(result['header']) + '\n')
+        for row in result['rows']:
+            sys.stdout.write('\t'.join(map(str, row)) + '\n')
+    else:
+        for key, value in sorted(result.items()):
+            sys.stdout.write('{}\t{}\n'.format(key, value))
@@ -3,13 +3,17 @@ Script to create specifically formatted files from the original probes file
 Picard and merged,annotated BED file
 """
 
-import subprocess
 import sys
 import logging
 import os
+from multiprocessing import Pool
+import numpy as np
 import pandas as pd
-from natsort import natsorted
-from ngs_capture_qc.utils import check_probe_format
+from ngs_capture_qc import cache, metrics
+from ngs_capture_qc.pipeline import Bedtools, Pipeline, bedtools_command
+from ngs_capture_qc.regions import fetch, regions_from_args, spanning_regions
+from ngs_capture_qc.utils import check_probe_format, genomic_order, RefGeneTable, partition_by_chromosome
+from ngs_capture_qc.intervals import merge_intervals, intersect
 if sys.version_info[0] < 3: 
     from StringIO import StringIO
 else:
@@ -17,27 +21,58 @@ else:
 
 log = logging.getLogger(__name__)
 
+# Version of the cached chromosome results; bump it whenever _merge_and_annotate
+# computes something different, so results cached by older versions are not used
+PARTITION_VERSION = 1
+PARTITION_KIND = 'annotation-partition-v{}'.format(PARTITION_VERSION)
+
 def build_parser(parser):
     parser.add_argument('probefile', help='The probe file from the vendor file')
     parser.add_argument('refgene_bed', help="UCSC RefGene gene data in bed format, chrm|start|stop|gene")
-    parser.add_argument('bedtools', default='',help='Path to bedtools, accepts binary or singularity image')
+    parser.add_argument('bedtools', nargs='?', default='',
+                        help='Path to bedtools, accepts binary or singularity image. Only used with --engine bedtools')
     parser.add_argument('outdir', default='.', help="Output directory for summary scripts")
+    parser.add_argument('--engine', choices=['native', 'bedtools'], default='native',
+                        help='Merge and annotate probes in-process (native, default) or with bedtools')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='Number of chromosomes to process at once with --engine native (default: 1)')
+    parser.add_argument('--region', action='append',
+                        help='Only process probes overlapping this region, chr:start-end (1-based, inclusive) '
+                             'or chr. May be repeated. Requires --engine native')
+    parser.add_argument('--region-genes', action='append', metavar='GENES',
+                        help='Only process probes overlapping these genes (comma-separated), as found in refgene_bed. '
+                             'May be repeated. Requires --engine native')
+
+def merge_probes(probes):
+    """Given correctly formatted probes, return a dataframe of merged
+    intervals identical to the output of `bedtools merge`"""
+    chroms, starts, stops = merge_intervals(probes['chrom'].values,
+                                            probes['start'].values,
+                                            probes['stop'].values)
+    return pd.DataFrame({'chrom': chroms, 'start': starts, 'stop': stops})
 
 def write_merged_bed(probes, bedtools, temp_merged_bed):
-    """Given correctly formatted probes, write the merged bed file"""
-    #First, create merged bed file
-    write_probes=open(temp_merged_bed, 'w')
-    merge_probes_args = [x for x in bedtools.split(' ')]+['bedtools', 'merge', '-i', probes]
-    subprocess.call(merge_probes_args, stdout=write_probes) 
-    write_probes.close()
+    """Given the path to a correctly formatted probe file, write the merged bed file with bedtools"""
+    with Pipeline([bedtools_command(bedtools, 'merge', '-i', probes)]) as merge, open(temp_merged_bed, 'w') as f:
+        f.writelines(merge)
 
 def write_annotated_bed(temp_merged_bed, bedtools, refgene, anno_bed):
     """Given merged bed file, replacing the annotation with gene names"""
-    #Next, annotate this file
-    intersect_args = [x for x in bedtools.split(' ')]+['bedtools', 'intersect', '-a', temp_merged_bed, '-b', refgene, '-loj'] 
-    annotate = subprocess.Popen(intersect_args, stdout=subprocess.PIPE)
-    data = StringIO(annotate.communicate()[0].decode('utf-8'))
-    df = pd.read_csv(data, sep='\t', header=None)
+    with Pipeline([bedtools_command(bedtools, 'intersect', '-a', temp_merged_bed, '-b', refgene, '-loj')]) as annotate:
+        write_annotation(annotate.stdout, anno_bed)
+
+def merge_and_annotate_bed(probes, bedtools, refgene, anno_bed):
+    """Merge and annotate the probes with `bedtools merge | bedtools intersect -loj`,
+    streaming the probes in and the annotation out through pipes"""
+    commands = [bedtools_command(bedtools, 'merge', '-i', 'stdin'),
+                bedtools_command(bedtools, 'intersect', '-a', 'stdin', '-b', refgene, '-loj')]
+    lines = [probes.to_csv(columns=['chrom','start','stop'], header=False, sep='\t', index=False)]
+    with Pipeline(commands, input=lines) as annotate:
+        write_annotation(annotate.stdout, anno_bed)
+
+def write_annotation(intersection, anno_bed):
+    """Given the output of `bedtools intersect -loj` of merged probes, write them with gene names"""
+    df = pd.read_csv(intersection, sep='\t', header=None)
     #Ignore all columns in merged output except the 7 we care about
     df=df.iloc[:,:7]
     df.columns=['chrom','start','stop','Rchr','Rstart','Rstop','gene']
@@ -48,32 +83,133 @@ def write_annotated_bed(temp_merged_bed, bedtools, refgene, anno_bed):
     df=df.groupby(['chrom','start','stop']).gene.unique().apply(lambda x: ';'.join(x)).reset_index()
 
     df.replace(to_replace=r'^\.$', value='intergenic', regex=True, inplace=True)
-    #Sort by chromosome and start
-    #See https://stackoverflow.com/questions/29580978/naturally-sorting-pandas-dataframe
-    df.chrom=df.chrom.astype('category')
-    df.chrom.cat.reorder_categories(natsorted(set(df.chrom)), inplace=True, ordered=True)
-    df.start = df.start.astype('category')
-    df.start.cat.reorder_categories(natsorted(set(df.start)), inplace=True, ordered=True)
-    df.sort_values('chrom', inplace=True)
+    #Sort by chromosome, start and stop
+    df=df.iloc[genomic_order(df.chrom.values, df.start.values, df.stop.values)]
     df.to_csv(anno_bed, columns=['chrom','start','stop','gene'],header=None,index=False, sep='\t')
 
-def create_bed(probes,output_basename,refgene_bed, bedtools):
-    """Inital step for new assay, validate probe file and write clean, annotated bed file"""
-    #Write temp clean probe file for bedtools usage
-    probes_temp=output_basename+'-TEMP.probes'
-    probes.to_csv(probes_temp, columns=['chrom','start','stop'],header=False,sep='\t', index=False)
+def annotate_merged(merged, refgene):
+    """Given merged probes, return a dataframe with the gene names of
+    every overlapping refgene joined by ';', or 'intergenic', in place
+    of the annotation. Equivalent to the `bedtools intersect -loj`
+    output processed by write_annotated_bed. `refgene` is the path to
+    the refgene bed or a RefGeneTable.
+    """
+    refgenes = refgene if isinstance(refgene, RefGeneTable) else RefGeneTable.read(refgene, format='bed')
+    gene_codes, gene_names = pd.factorize(refgenes['name2'])
+
+    labels = np.full(len(merged), 'intergenic', dtype=object)
+    for merged_index, refgene_index in intersect(
+            merged['chrom'].astype(str).values, merged['start'].values, merged['stop'].values,
+            refgenes.chrom, refgenes['txStart'], refgenes['txEnd']):
+        if not len(merged_index):
+            continue
+        #Order hits by target, then by position in the refgene file, and
+        #keep the first hit of each gene for each target
+        order = np.lexsort((refgene_index, merged_index))
+        merged_index, refgene_index = merged_index[order], refgene_index[order]
+        key = merged_index * len(gene_names) + gene_codes[refgene_index]
+        __, first = np.unique(key, return_index=True)
+        first.sort()
+        merged_index = merged_index[first]
+        genes = gene_names[gene_codes[refgene_index[first]]]
+        bounds = np.flatnonzero(np.diff(merged_index)) + 1
+        targets = merged_index[np.concatenate(([0], bounds))]
+        labels[targets] = [';'.join(g) for g in np.split(np.asarray(genes, dtype=object), bounds)]
+
+    annotated = pd.DataFrame({'chrom': merged['chrom'].values,
+                              'start': merged['start'].values,
+                              'stop': merged['stop'].values,
+                              'gene': labels})
+    #Sort by chromosome and start
+    order = genomic_order(annotated['chrom'].values, annotated['start'].values, annotated['stop'].values)
+    return annotated.iloc[order]
 
-    #Write temp merged bed file
-    temp_merged_bed=output_basename+'-TEMP.bed'
-    write_merged_bed(probes_temp, bedtools, temp_merged_bed)
+def _merge_and_annotate(task):
+    probes, refgenes = task
+    return annotate_merged(merge_probes(probes), refgenes)
 
-    #Write merged, annotated bed file
+def _partition_digest(task):
+    """Hash the probes and refgenes of a chromosome partition task"""
+    probes, refgenes = task
+    return cache.array_digest([PARTITION_VERSION], probes['chrom'].values, probes['start'].values, probes['stop'].values,
+                              refgenes.chrom, refgenes['txStart'], refgenes['txEnd'], refgenes['name2'])
+
+def _store_partition(digest, annotated):
+    cache.store_arrays(PARTITION_KIND, digest,
+                       {c: np.asarray(annotated[c], dtype=str if c in ('chrom', 'gene') else np.int64)
+                        for c in ['chrom', 'start', 'stop', 'gene']},
+                       'create_files chromosome {}'.format(annotated['chrom'].iloc[0] if len(annotated) else ''))
+
+def _load_partition(digest):
+    data = cache.load_arrays(PARTITION_KIND, digest)
+    if data is None:
+        return None
+    return pd.DataFrame({'chrom': data['chrom'].astype(object), 'start': data['start'],
+                         'stop': data['stop'], 'gene': data['gene'].astype(object)})
+
+def annotate_probes(probes, refgene, jobs=1, cached=False):
+    """Merge and annotate the probes, processing up to `jobs` chromosomes
+    at once. Output is the same as annotate_merged(merge_probes(probes)).
+    With `cached`, the annotated probes of each chromosome are kept in the
+    on-disk cache, keyed by its probes and refgenes, and reused on later runs."""
+    if jobs <= 1 and not cached:
+        with metrics.stage('merge') as stage:
+            merged = merge_probes(probes)
+            stage.rows = len(probes)
+        with metrics.stage('intersect') as stage:
+            annotated = annotate_merged(merged, refgene)
+            stage.rows = len(merged)
+        return annotated
+
+    with metrics.stage('read-refgene') as stage:
+        refgenes = refgene if isinstance(refgene, RefGeneTable) else RefGeneTable.read(refgene, format='bed')
+        stage.rows = len(refgenes)
+    partitions = partition_by_chromosome(probes['chrom'].values, refgenes.chrom)
+    tasks = [(probes.iloc[probe_index], refgenes.take(refgene_index))
+             for probe_index, refgene_index in partitions]
+    with metrics.stage('merge-intersect') as stage:
+        # Reuse the results of chromosomes with unchanged probes and refgenes
+        annotated = [None] * len(tasks)
+        digests = [None] * len(tasks)
+        if cached:
+            for i, task in enumerate(tasks):
+                digests[i] = _partition_digest(task)
+                annotated[i] = _load_partition(digests[i])
+            log.info('reusing cached results for {} of {} chromosomes'.format(
+                sum(a is not None for a in annotated), len(tasks)))
+        todo = [i for i, a in enumerate(annotated) if a is None]
+        if jobs <= 1 or len(todo) <= 1:
+            computed = map(_merge_and_annotate, [tasks[i] for i in todo])
+        else:
+            with Pool(min(jobs, len(todo))) as pool:
+                computed = pool.map(_merge_and_annotate, [tasks[i] for i in todo])
+        for i, result in zip(todo, computed):
+            annotated[i] = result
+            if cached:
+                _store_partition(digests[i], result)
+        stage.rows = len(probes)
+    if not annotated:
+        return annotate_merged(merge_probes(probes), refgenes)
+    #Each partition is sorted; sort again in case names of one chromosome differ, eg chr1 and 1
+    annotated = pd.concat(annotated, ignore_index=True)
+    order = genomic_order(annotated['chrom'].values, annotated['start'].values, annotated['stop'].values)
+    return annotated.iloc[order]
+
+def create_bed(probes,output_basename,refgene_bed, bedtools, engine='native', jobs=1, cached=False):
+    """Inital step for new assay, validate probe file and write clean, annotated bed file"""
     anno_bed=output_basename+'.anno.bed'
-    write_annotated_bed(temp_merged_bed, bedtools, refgene_bed, anno_bed)
+    if engine == 'native':
+        #Merge and annotate in memory, no temp files needed
+        annotated = annotate_probes(probes, refgene_bed, jobs, cached)
+        with metrics.stage('write-outputs') as stage:
+            annotated.to_csv(anno_bed, columns=['chrom','start','stop','gene'],header=None,index=False, sep='\t')
+            stage.rows = len(annotated)
+        return
 
-    # #Remove temp merged bed file
-    # os.remove(probes_temp)
-    # os.remove(temp_merged_bed)
+    #Merge and annotate with bedtools, piping the probes through without temp files
+    with metrics.stage('merge-intersect') as stage:
+        merge_and_annotate_bed(probes, bedtools, refgene_bed, anno_bed)
+        stage.rows = len(probes)
 
 def create_picard_bed(probes, output_basename):
     """Use doc/PicardHeader and probe file to create a file 
@@ -86,24 +222,60 @@ def create_picard_bed(probes, output_basename):
                 picard_out.write(line)
     probes.to_csv(picard_bed, columns=['chrom','start','stop','strand','annotation'],header=False,index=False,sep='\t', mode='a')
 
+def read_probes(probefile, regions=None):
+    """Read the probe file, or only the probes overlapping `regions`; see ngs_capture_qc.regions"""
+    if regions is None:
+        return pd.read_csv(open(probefile,'r'), delimiter='\t', header=None)
+    lines = fetch(probefile, regions, format='bed')
+    if not lines:
+        raise ValueError('No probes overlap {}'.format(', '.join(map(str, regions))))
+    return pd.read_csv(StringIO(''.join(lines)), delimiter='\t', header=None)
+
 def action(args):
+    if args.engine == 'bedtools' and (args.region or args.region_genes):
+        log.error('Error: --region and --region-genes require --engine native')
+        sys.exit(1)
+
+    try:
+        regions = regions_from_args(args.region, args.region_genes, args.refgene_bed, 'bed')
+    except ValueError as err:
+        log.error('Error: {}'.format(err))
+        sys.exit(1)
+
     #Read in the probes
-    probes = pd.read_csv(open(args.probefile,'r'), delimiter='\t', header=None)
+    with metrics.stage('read-probes') as stage:
+        try:
+            probes = read_probes(args.probefile, regions)
+        except ValueError as err:
+            log.error('Error: {}'.format(err))
+            sys.exit(1)
 
-    #Assert the probes are in the correct format for processing
-    probes = check_probe_format(probes)
+        #Assert the probes are in the correct format for processing
+        probes = check_probe_format(probes)
+        stage.rows = len(probes)
     
     #setup name for resulting files
     probe_basename=os.path.splitext(os.path.basename(args.probefile))[0]
     output_basename=os.path.join(os.path.join(args.outdir,probe_basename))
 
+    if args.engine == 'bedtools' and not args.bedtools:
+        log.error('Error: --engine bedtools requires the path to bedtools')
+        sys.exit(1)
+
     #Now, create files based on CLI arguments
     #Parse probes, write clean bed file
-    if args.bedtools.endswith('img'):
-        bedtools='singularity exec --bind {} --pwd {} {}'.format(os.getcwd(), os.getcwd(), args.bedtools)
-    else:
-        bedtools=args.bedtools
-    create_bed(probes, output_basename, args.refgene_bed, bedtools)
+    refgene = args.refgene_bed
+    if regions is not None:
+        # read the refgenes under all of the probes, including the parts outside the regions,
+        # so merged probes crossing a region's edge are annotated as in a run without regions
+        with metrics.stage('read-refgene') as stage:
+            spans = spanning_regions(probes['chrom'].values, probes['start'].values, probes['stop'].values)
+            refgene = RefGeneTable.read(args.refgene_bed, format='bed', regions=spans)
+            stage.rows = len(refgene)
+    with Bedtools(args.bedtools) as bedtools:
+        create_bed(probes, output_basename, refgene, bedtools, args.engine, args.jobs, cache.enabled())
 
     #Parse probes, write picard file
-    create_picard_bed(probes, output_basename)
+    with metrics.stage('write-picard') as stage:
+        create_picard_bed(probes, output_basename)
+        stage.rows = len(probes)
@@ -1,19 +1,21 @@
 """Filter a file containing the refgene annotation table, limiting to
 preferred transcripts.
 
-Overlapping genes will result in an error.
+Overlapping genes will result in an error; every overlapping pair is
+reported, and with --conflicts also written to a tab-delimited file.
 """
 
 import sys
 import csv
+import heapq
 import pprint
-from itertools import groupby
 from operator import itemgetter
-from collections import namedtuple
+from collections import defaultdict
 import logging
-import pandas as pd
+import numpy as np
 
-from ngs_capture_qc.utils import chromosomes
+from ngs_capture_qc import metrics
+from ngs_capture_qc.utils import RefGeneTable, genomic_order
 
 log = logging.getLogger(__name__)
 
@@ -24,6 +26,8 @@ def build_parser(parser):
                         help='File defining preferred transcripts')
     parser.add_argument('outfile',
                         help='output file')
+    parser.add_argument('--conflicts',
+                        help='Write overlapping genes to this tab-delimited file (written even if empty)')
 
 refgene_fields = """
 bin
@@ -59,85 +63,132 @@ def read_refgene(file):
     Skip the header (which starts with #bin) if present
     """
     
-    return csv.DictReader(filter(lambda row: row[0]!='#',file), fieldnames=refgene_fields, delimiter='\t')
+    return RefGeneTable.read(file).rows(fieldnames=refgene_fields)
 
 
+def find_overlapping(features):
+    """Return every pair of elements of `features`, a sequence of
+    (name, start, end) tuples, with overlapping ranges. Ranges that
+    share an end point overlap. Pairs are ordered by the start of the
+    second feature, using a single sweep over the sorted features.
+
+    """
+    overlapping = []
+    active = []  # heap of (end, position) of features that may still overlap
+    features = sorted(features, key=itemgetter(1, 2))
+    for i, (name, start, end) in enumerate(features):
+        while active and active[0][0] < start:
+            heapq.heappop(active)
+        overlapping.extend((features[j], features[i]) for __, j in sorted(active, key=itemgetter(1)))
+        heapq.heappush(active, (end, i))
+    return overlapping
+
 def check_overlapping(features):
     """Check for elements of `features` with overlapping ranges. In the
-    case of overlap, print an informative error message and return
-    names and positions of overlapping features.
+    case of overlap, raise a ValueError listing every overlapping pair;
+    otherwise return an empty list.
 
     """
-    features = features[:]
-    overlapping = []
-    for i in range(len(features)-1):
-        prev_name, prev_start, prev_end = features[i]
-        name, start, end = features[i+1]
-        if prev_end >= start:
-            overlap = ((prev_name, prev_start, prev_end), (name, start, end))
-            overlapping.append(overlap)
-            raise ValueError('overlapping features: ' + pprint.pformat(overlap))
+    overlapping = find_overlapping(features)
+    if overlapping:
+        raise ValueError('overlapping features: ' + pprint.pformat(overlapping))
     return overlapping
 
-Node = namedtuple('Node', 'name start end left right')
+def read_preferred(genes):
+    """Return a dict mapping each gene in the preferred transcripts file
+    `genes` (with a header line) to its RefSeq, without the version"""
+    preferred = {}
+    with open(genes, 'r') as f:
+        reader = csv.reader(f, delimiter='\t')
+        next(reader, None)
+        for row in reader:
+            if not row:
+                continue
+            gene, refseq = row[0], row[1].split('.')[0] if len(row) > 1 else ''
+            if preferred.get(gene, refseq) != refseq:
+                raise ValueError('{} is listed with more than one preferred transcript: {}, {}'.format(
+                    gene, preferred[gene], refseq))
+            preferred[gene] = refseq
+    return preferred
+
+def write_conflicts(conflicts, outfile):
+    """Write overlapping pairs, as (chrom, feature, feature), to `outfile` as tab-delimited text"""
+    with open(outfile, 'w') as f:
+        writer = csv.writer(f, delimiter='\t', lineterminator='\n')
+        writer.writerow(['chrom', 'gene1', 'start1', 'end1', 'gene2', 'start2', 'end2'])
+        for chrom, first, second in conflicts:
+            writer.writerow((chrom,) + tuple(first) + tuple(second))
 
 def action(args):
-    #Parse preferred transcripts, write coverage info
-    transcripts=pd.read_csv(open(args.genes, 'r'), delimiter='\t')
-    transcripts.columns=['Gene','RefSeq']
-    transcripts['RefSeq']=transcripts['RefSeq'].apply(lambda x: str(x).split('.')[0])
+    #Parse preferred transcripts
+    try:
+        transcripts = read_preferred(args.genes)
+    except ValueError as err:
+        log.error('Error: {}'.format(err))
+        sys.exit(1)
 
     # read and filter the refgene file
-    refgenes = read_refgene(open(args.refgene, 'r'))
-    fieldnames = refgenes.fieldnames
+    with metrics.stage('read-refgene') as stage:
+        table = RefGeneTable.read(args.refgene)
+        stage.rows = len(table)
+    fieldnames = refgene_fields
 
-    refgenes = [r for r in refgenes
-                if r['chrom'] in chromosomes and r['name'] in transcripts['Gene'].values]
+    kept_rows = np.flatnonzero(table.in_chromosomes() & np.isin(table['name2'], list(transcripts)))
 
     # sort by chromosome, transcription start
-    refgenes.sort(key=lambda row: (str(chromosomes[row['chrom']]), str(row['txStart'])))
-
-    # group by gene and choose one transcript for each
-    filtered_output = []
-    for gene, grp in groupby(refgenes, itemgetter('name')):
-        grp = list(grp)
-        preferred = transcripts.loc[transcripts['Gene']==gene, 'RefSeq'].item()
-        if preferred:
-            keep = [r for r in grp if r['refgene'].split('.')[0] in preferred]
-            if not keep:
-                log.error('Error: %s has a preferred transcript of %s but only %s was found' %
-                          (gene, preferred, ','.join(r['refgene'] for r in grp)))
-                sys.exit(1)
-            elif len(keep) > 1:
-                log.warning('{} has more than one preferred transcript; using {}'.format(
-                    gene, keep[0]['refgene']))
-        else:
-            log.warning('no preferred transcript for {}'.format(gene))
-            keep = grp[:1]
-
-        filtered_output.append(keep[0])
-
-#    all transcripts are found among preferred transcripts
-#    for k in filtered_output:
-#        print(k)
-#        print(transcripts[transcripts['RefSeq'].astype(str).str.contains(k['refgene'])])
-    assert [transcripts[transcripts['RefSeq'].astype(str).str.contains(k['refgene'])] for k in filtered_output]
-
-    # Check for overlapping genes and exit with an error if any are
-    # found.
-    overlapping = []
-    rows = sorted(filtered_output, key=itemgetter('chrom'))
-    for chrom, grp in groupby(rows, key=itemgetter('chrom')):
-        grp = sorted(
-            [(row['name'], int(row['txStart']), int(row['txEnd'])) for row in grp],
-            key=itemgetter(1, 2)
-        )
-        overlapping.extend(check_overlapping(grp))
-
-    if overlapping:
+    kept_rows = kept_rows[genomic_order(table.chrom_names[table.chrom_codes[kept_rows]], table['txStart'][kept_rows])]
+
+    # index the rows by gene, choose one transcript for each, and keep the genomic order
+    position = {row: i for i, row in enumerate(kept_rows.tolist())}
+    by_gene = defaultdict(list)
+    for row, gene in zip(kept_rows.tolist(), table['name2'][kept_rows].tolist()):
+        by_gene[gene].append(row)
+    accessions = table['name']
+    chosen = []
+    with metrics.stage('filter') as stage:
+        stage.rows = len(kept_rows)
+        for gene, rows in by_gene.items():
+            preferred = transcripts[gene]
+            if preferred:
+                group_keep = [r for r in rows if accessions[r].split('.')[0] in preferred]
+                if not group_keep:
+                    log.error('Error: %s has a preferred transcript of %s but only %s was found' %
+                              (gene, preferred, ','.join(accessions[r] for r in rows)))
+                    sys.exit(1)
+                elif len(group_keep) > 1:
+                    log.warning('{} has more than one preferred transcript; using {}'.format(
+                        gene, accessions[group_keep[0]]))
+            else:
+                log.warning('no preferred transcript for {}'.format(gene))
+                group_keep = rows[:1]
+
+            chosen.append(group_keep[0])
+        chosen.sort(key=position.get)
+        filtered_output = list(table.rows(chosen, fieldnames=refgene_fields))
+
+    # Check for overlapping genes, reporting all of them, and exit with
+    # an error if any are found.
+    with metrics.stage('check-overlapping') as stage:
+        by_chrom = defaultdict(list)
+        for row in filtered_output:
+            by_chrom[row['chrom']].append((row['name'], int(row['txStart']), int(row['txEnd'])))
+        conflicts = []
+        chroms = list(by_chrom)
+        for chrom in [chroms[i] for i in genomic_order(chroms)]:
+            conflicts.extend((chrom, first, second) for first, second in find_overlapping(by_chrom[chrom]))
+        stage.rows = len(filtered_output)
+
+    if args.conflicts:
+        write_conflicts(conflicts, args.conflicts)
+
+    if conflicts:
+        for chrom, first, second in conflicts:
+            log.error('overlapping features on {}: {}'.format(chrom, pprint.pformat((first, second))))
         log.error('Error: overlapping genes were found')
         sys.exit(1)
 
 
-    writer = csv.DictWriter(open(args.outfile,'w'), fieldnames=fieldnames, delimiter='\t')
-    writer.writerows(filtered_output)
+    with metrics.stage('write-outputs') as stage:
+        writer = csv.DictWriter(open(args.outfile,'w'), fieldnames=fieldnames, delimiter='\t')
+        writer.writerows(filtered_output)
+        stage.rows = len(filtered_output)
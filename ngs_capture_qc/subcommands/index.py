@@ -0,0 +1,52 @@
+"""
+Index BGZF-compressed bed or refGene files for --region and --region-genes queries
+
+The index is written next to each file as <file>.cqi, or in the cache
+directory (CAPQC_CACHE_DIR) if that can't be written. Files are also
+indexed on their first region query, so this is only needed to index
+ahead of time, or to check what a region query would return.
+
+usage:
+
+ capqc index assay.bed.gz refGene.bed.gz
+ capqc index refGene.txt.gz --format refgene
+ capqc index assay.bed.gz --region chr7:55086725-55275031
+"""
+
+import sys
+import logging
+
+from ngs_capture_qc import bgzf, metrics
+from ngs_capture_qc.regions import COLUMNS, RegionIndex, fetch, parse_region, save_index
+
+log = logging.getLogger(__name__)
+
+def build_parser(parser):
+    parser.add_argument('infiles', nargs='+', help='BGZF-compressed files, eg written by bgzip')
+    parser.add_argument('--format', choices=sorted(COLUMNS), default='bed',
+                        help='bed (chrom, start, end in the first columns; default) or a UCSC refGene table')
+    parser.add_argument('--region', action='append',
+                        help='Print the lines overlapping this region, chr:start-end (1-based, inclusive) or chr. '
+                             'May be repeated')
+
+def action(args):
+    try:
+        regions = [parse_region(r) for r in args.region or []]
+    except ValueError as err:
+        log.error('Error: {}'.format(err))
+        sys.exit(1)
+
+    for infile in args.infiles:
+        if not bgzf.is_bgzf(infile):
+            log.error('Error: {} is not BGZF-compressed; compress it with bgzip'.format(infile))
+            sys.exit(1)
+        with metrics.stage('index') as stage:
+            index = RegionIndex.build(infile, args.format)
+            ipath = save_index(index, infile)
+            stage.rows = len(index.chunk_starts)
+        if ipath is None:
+            log.error('Error: could not write an index of {}'.format(infile))
+            sys.exit(1)
+        log.info('wrote {}'.format(ipath))
+        if regions:
+            sys.stdout.writelines(fetch(infile, regions, args.format))
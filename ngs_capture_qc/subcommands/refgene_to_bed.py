@@ -4,10 +4,10 @@ Convert UCSC refgene.txt files to BED format, for use in summarize_assay script
  
 import sys 
 import csv
-from operator import itemgetter
 
-from natsort import natsorted
-from ngs_capture_qc.utils import chromosomes
+import numpy as np
+from ngs_capture_qc import metrics
+from ngs_capture_qc.utils import RefGeneTable, chrom_rank
  
 def build_parser(parser):
     parser.add_argument('refgene', help='UCSC table browser download')
@@ -15,28 +15,16 @@ def build_parser(parser):
 
  
 def action(args):
-    refgene_fields = """
-    bin
-    name
-    chrom
-    strand
-    txStart
-    txEnd
-    cdsStart
-    cdsEnd
-    exonCount
-    exonStarts
-    exonEnds
-    score
-    name2
-    cdsStartStat
-    cdsEndStat
-    exonFrames
-    """.split()
-    #Skip the header lines, read in only the columns we need because some unnecessary columns can be millions of characters long
-    reader = csv.DictReader(filter(lambda row: row[0]!='#',open(args.refgene,'r')), delimiter='\t', fieldnames=refgene_fields)
-    out=[x for x in reader if x['chrom'] in chromosomes]
-    sorted_out = natsorted(out, key=itemgetter('chrom'))
+    #Skip the header lines, keep only the chromosomes we know about
+    with metrics.stage('read-refgene') as stage:
+        refgenes = RefGeneTable.read(args.refgene)
+        stage.rows = len(refgenes)
+        refgenes = refgenes.take(refgenes.in_chromosomes())
+    #Natural sort by chromosome, keeping the file order within each chromosome
+    ranks = chrom_rank(refgenes.chrom_names)[refgenes.chrom_codes]
+    sorted_out = refgenes.rows(np.argsort(ranks, kind='stable'))
     headers = ['chrom','txStart','txEnd','name2','name','strand','exonCount','exonStarts','exonEnds']
-    writer = csv.DictWriter(open(args.outfile,'w'), extrasaction='ignore',fieldnames=headers, delimiter='\t')
-    writer.writerows(sorted_out)
+    with metrics.stage('write-outputs') as stage:
+        writer = csv.DictWriter(open(args.outfile,'w'), extrasaction='ignore',fieldnames=headers, delimiter='\t')
+        writer.writerows(sorted_out)
+        stage.rows = len(refgenes)
@@ -0,0 +1,208 @@
+"""
+Serve summarize_assay and per-gene coverage queries from memory
+
+refgene_bed is read once, and requests from ``capqc client`` are answered
+from the table in memory, each on its own thread, over a Unix socket
+(--socket, default CAPQC_SOCKET) or HTTP on a localhost port (--port).
+Probes are intersected in-process, as by summarize_assay --engine native.
+Preferred transcript files are read when first used and kept, and read
+again if they change; --preferred reads them at startup.
+
+usage:
+
+ capqc serve refgene.bed --socket /tmp/capqc.sock --preferred genes.txt
+"""
+
+import json
+import logging
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from socketserver import ThreadingMixIn, UnixStreamServer
+
+from ngs_capture_qc import cache, metrics
+from ngs_capture_qc.regions import gene_regions, overlapping, parse_region
+from ngs_capture_qc.subcommands.client import DEFAULT_PORT
+from ngs_capture_qc.subcommands.summarize_assay import (
+    native_coverage, read_assay, read_refgenes, refgene_header, refgene_rows, refgene_summary,
+    write_depth, write_summaries)
+from ngs_capture_qc.utils import RefGeneTable
+
+log = logging.getLogger(__name__)
+
+def build_parser(parser):
+    parser.add_argument('refgene_bed', help="UCSC Refgene data in bed format")
+    parser.add_argument('--socket', default=os.environ.get('CAPQC_SOCKET'),
+                        help='Listen on this Unix socket (default CAPQC_SOCKET)')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT,
+                        help='Listen on this port on localhost, without --socket (default: %(default)s)')
+    parser.add_argument('--preferred', action='append', metavar='GENES',
+                        help='Preferred transcripts file to read at startup. May be repeated')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='Number of chromosomes to process at once for each request (default: 1)')
+
+class Service(object):
+    """
+    The refgene table and preferred transcript lists shared by the
+    request threads, with the queries they answer
+    """
+
+    def __init__(self, refgene_bed, jobs=1):
+        self.refgene_bed = refgene_bed
+        self.table = RefGeneTable.read(refgene_bed, format='bed')
+        self.rows = refgene_rows(self.table)
+        self.jobs = jobs
+        self._preferred = {}
+        self._lock = threading.Lock()
+
+    def preferred(self, path):
+        """Return the lines of the preferred transcripts file `path`, read again if it has changed"""
+        mtime = os.stat(path).st_mtime
+        with self._lock:
+            cached = self._preferred.get(path)
+            if cached is None or cached[0] != mtime:
+                with open(path) as f:
+                    cached = self._preferred[path] = (mtime, f.readlines())
+        return cached[1]
+
+    def select(self, regions):
+        """Return the table, and its rows, of the refgenes overlapping `regions` (all of them with None)"""
+        if regions is None:
+            return self.table, self.rows
+        table = self.table.take(overlapping(self.table.chrom, self.table['txStart'], self.table['txEnd'], regions))
+        return table, refgene_rows(table)
+
+    def summarize(self, bed, genes, region=None, region_genes=None, depth=False, depth_thresholds='1,2,5'):
+        """Return the files summarize_assay writes for the probes in `bed` and the preferred
+        transcripts `genes`, as a dict of file name to contents"""
+        regions = None
+        if region or region_genes:
+            names = [g for arg in region_genes or [] for g in arg.split(',') if g]
+            regions = [parse_region(r) for r in region or []] + \
+                (gene_regions(self.table, names) if names else [])
+        thresholds = [int(k) for k in depth_thresholds.split(',') if k]
+
+        table, rows = self.select(regions)
+        refgenes = read_refgenes(table, rows)
+        assay = read_assay(bed, regions)
+        non_intersecting = native_coverage(assay, refgenes, rows, self.jobs, regions, cache.enabled())
+        out = tempfile.mkdtemp(prefix='capqc-serve-')
+        try:
+            write_summaries(assay, self.preferred(genes), out, refgenes, non_intersecting, regions)
+            if depth:
+                write_depth(assay[1:], table, out, thresholds)
+            files = {}
+            for name in os.listdir(out):
+                with open(os.path.join(out, name), newline='') as f:
+                    files[name] = f.read()
+        finally:
+            shutil.rmtree(out, ignore_errors=True)
+        return {'files': files}
+
+    def coverage(self, bed, genes):
+        """Return the per-refgene summary of each transcript of `genes` for the probes in `bed`"""
+        regions = gene_regions(self.table, genes)
+        table, rows = self.select(regions)
+        refgenes = read_refgenes(table, rows)
+        native_coverage(bed, refgenes, rows, regions=regions)
+        names = set(genes)
+        summaries = [refgene_summary(data['name'], refgene, data)
+                     for refgene, data in sorted(refgenes.items(), key=lambda item: (item[1]['name'], item[0]))
+                     if data['name'] in names]
+        return {'header': refgene_header, 'rows': [[s[f] for f in refgene_header] for s in summaries]}
+
+    def status(self):
+        with self._lock:
+            preferred = sorted(self._preferred)
+        return {'refgene_bed': self.refgene_bed, 'refgenes': len(self.table), 'preferred': preferred}
+
+class Handler(BaseHTTPRequestHandler):
+    """Answers GET /status and POST /summarize and /coverage, with the arguments as a JSON object"""
+
+    def do_GET(self):
+        if self.path == '/status':
+            self._reply(200, self.server.service.status())
+        else:
+            self._reply(404, {'error': 'unknown request {}'.format(self.path)})
+
+    def do_POST(self):
+        query = {'/summarize': self.server.service.summarize,
+                 '/coverage': self.server.service.coverage}.get(self.path)
+        if query is None:
+            self._reply(404, {'error': 'unknown request {}'.format(self.path)})
+            return
+        try:
+            params = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))).decode())
+            result = query(**params)
+        except (ValueError, TypeError, OSError) as err:
+            log.warning('{} failed: {}'.format(self.path, err))
+            self._reply(400, {'error': str(err)})
+        except Exception as err:
+            log.exception('{} failed'.format(self.path))
+            self._reply(500, {'error': str(err)})
+        else:
+            self._reply(200, result)
+
+    def _reply(self, status, result):
+        body = json.dumps(result).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # client_address is empty for Unix sockets
+        log.info(format % args)
+
+class UnixHTTPServer(ThreadingMixIn, UnixStreamServer):
+    daemon_threads = True
+
+def make_server(service, socket_path=None, port=DEFAULT_PORT):
+    """Return a server answering requests to `service`, on the Unix socket `socket_path` or
+    on `port` on localhost. A socket left behind by a server that has exited is replaced."""
+    if socket_path:
+        if os.path.exists(socket_path):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(socket_path)
+            except ConnectionRefusedError:
+                os.remove(socket_path)
+            else:
+                raise OSError('{} is in use'.format(socket_path))
+            finally:
+                probe.close()
+        server = UnixHTTPServer(socket_path, Handler)
+    else:
+        server = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+    server.service = service
+    return server
+
+def action(args):
+    with metrics.stage('read-refgene') as stage:
+        service = Service(args.refgene_bed, args.jobs)
+        for path in args.preferred or []:
+            service.preferred(os.path.abspath(path))
+        stage.rows = len(service.table)
+
+    try:
+        server = make_server(service, args.socket, args.port)
+    except OSError as err:
+        log.error('Error: {}'.format(err))
+        sys.exit(1)
+
+    log.warning('serving {} on {}'.format(
+        args.refgene_bed, args.socket or 'http://127.0.0.1:{}'.format(args.port)))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if args.socket:
+            os.remove(args.socket)
@@ -5,134 +5,472 @@ Requires refgene data in bed format, available with UW genomes or use refgene_to
 """
  
 import sys
-import subprocess
 import csv
 import os
 import logging 
 
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import Pool
+
+import numpy as np
+from ngs_capture_qc import cache, metrics
+from ngs_capture_qc.coverage import CoverageTrack
+from ngs_capture_qc.intervals import intersect, merge_intervals, overlaps_any, union_length, intersection_length
+from ngs_capture_qc.pipeline import Bedtools, Pipeline, bedtools_command, read_lines
+from ngs_capture_qc.regions import fetch, regions_from_args
+from ngs_capture_qc.utils import RefGeneTable, partition_by_chromosome, chromosomes
+
 if sys.version_info[0] < 3: 
     from StringIO import StringIO
 else:
     from io import StringIO
 log = logging.getLogger(__name__)
 
+# Version of the cached chromosome results; bump it whenever _partition_coverage
+# computes something different, so results cached by older versions are not used.
+# 2: probes are merged before they are counted
+PARTITION_VERSION = 2
+PARTITION_KIND = 'coverage-partition-v{}'.format(PARTITION_VERSION)
+
 def build_parser(parser):
     parser.add_argument('bed',  help="Assay Reference bed file, sorted, with ^M removed from end of lines")
     parser.add_argument('genes', help="Gene, RefSeq for assay")
     parser.add_argument('refgene_bed', help="UCSC Refgene data in bed format")
-    parser.add_argument('bedtools',help='Path to bedtools, accepts binary or singularity image')
+    parser.add_argument('bedtools', nargs='?', default='',
+                        help='Path to bedtools, accepts binary or singularity image. Only used with --engine bedtools')
     parser.add_argument('--outdir', required=False, help="Output directory for summary scripts")
+    parser.add_argument('--engine', choices=['native', 'bedtools'], default='native',
+                        help='Intersect probes and refgenes in-process (native, default) or with bedtools')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='Number of chromosomes to process at once with --engine native (default: 1)')
+    parser.add_argument('--region', action='append',
+                        help='Only summarize probes and refgenes overlapping this region, chr:start-end '
+                             '(1-based, inclusive) or chr. May be repeated. Requires --engine native')
+    parser.add_argument('--region-genes', action='append', metavar='GENES',
+                        help='Only summarize probes and refgenes overlapping these genes (comma-separated). '
+                             'May be repeated. Requires --engine native')
+    parser.add_argument('--depth', action='store_true',
+                        help='Also write the probe depth over every exon of refgene_bed (exon_depth_summary.txt) '
+                             'and histograms of bases at each depth per exon and transcript (depth_histogram.txt)')
+    parser.add_argument('--depth-thresholds', default='1,2,5',
+                        help='Comma-separated depths k for the fraction of each exon covered by at least k probes '
+                             'with --depth (default: 1,2,5)')
+    parser.add_argument('--bedgraph', metavar='FILE',
+                        help='Write the number of probes covering each base in bedGraph format')
 
 class exonTracker:
     """
     Keeps track of a gene's exons.  When an interval is inserted, any relevant exons are covered.
-    Initially, all exon intervals' values are covered=False
+    Exons are held as integer arrays sorted by start, with the number of bases covered in each;
+    initially all exons have no coverage. The arrays are only built once an interval is inserted,
+    so trackers for transcripts without coverage cost almost nothing.
     """
     def __init__(self, exonStarts, exonEnds):
-        self.exons = dict(((start,end),False) for start,end in zip(exonStarts,exonEnds))
         assert(len(exonStarts) == len(exonEnds))
+        self.exonStarts = exonStarts
+        self.exonEnds = exonEnds
+        self._bases = None
+
+    def _index(self):
+        if self._bases is None:
+            starts = np.array(self.exonStarts, dtype=np.int64)
+            self.order = np.argsort(starts, kind='stable')
+            self.starts = starts[self.order]
+            self.ends = np.array(self.exonEnds, dtype=np.int64)[self.order]
+            #Running maximum of exon ends, so exons entirely before a probe can be skipped with searchsorted
+            self.reach = np.maximum.accumulate(self.ends) if len(self.ends) else self.ends
+            self._bases = np.zeros(len(starts), dtype=np.int64)
+
+    def __len__(self):
+        return len(self.exonStarts)
+
+    @property
+    def bases(self):
+        """Number of bases covered in each exon, in the order provided"""
+        self._index()
+        return self._bases
+
+    @property
+    def exons(self):
+        """Map each (start, end) exon, as provided, to whether it has any coverage"""
+        return dict(zip(zip(self.exonStarts, self.exonEnds), (self.bases > 0).tolist()))
+
+    def exons_hit(self):
+        """Return the number of exons with any coverage"""
+        return 0 if self._bases is None else int(np.count_nonzero(self._bases))
+
+    def add_bases(self, bases):
+        """Add covered base counts for each exon, in the order provided, as returned by `bases`"""
+        self._index()
+        self._bases += bases
 
     def insert(self, start, end):
-        #Probes are merged, and therefore may cover multiple exons
+        self.insert_many([start], [end])
+
+    def insert_many(self, starts, ends):
+        """Cover exons with every interval given by `starts` and `ends`,
+        adding the overlapping bases to each exon's count. Probes are
+        merged, and therefore may cover multiple exons"""
         #probe: 1-100, exons: 1-20, 30-49, 59-99
-        for exonStart, exonEnd in self.exons.keys():
-            #start/end within exon
-            if ((int(exonStart) <= int(start) < int(exonEnd)) and (int(exonStart) <= int(end) < int(exonEnd))) or ((int(exonStart) <= int(start) < int(exonEnd)) and (int(end) > int(exonEnd))) or ((int(start) <= int(exonStart) < int(end)) and (int(start) < int(exonEnd) < int(end))) or ((int(exonStart) < int(end) <= int(exonEnd)) and  (int(start) <= int(exonStart))):
-                self.exons[(exonStart,exonEnd)] = True
-
-def calculate_total_covered(probes):
-    '''calculate the total regions covered by using the merged probes file'''
-    total_cov=0
-    with open(probes, 'r') as p:
-        for line in p:
-            ls=line.split('\t')
-            chrm,start,stop=ls[0:3]
-            line_sum=int(stop)-int(start)
-            total_cov += line_sum
-    return total_cov
+        self._index()
+        starts = np.asarray(starts, dtype=np.int64)
+        ends = np.asarray(ends, dtype=np.int64)
+        first = np.searchsorted(self.reach, starts, side='right')
+        last = np.searchsorted(self.starts, ends, side='left')
+        counts = np.maximum(last - first, 0)
+        probe = np.repeat(np.arange(len(starts)), counts)
+        exon = np.repeat(first, counts) + np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        overlap = np.minimum(ends[probe], self.ends[exon]) - np.maximum(starts[probe], self.starts[exon])
+        keep = overlap > 0
+        np.add.at(self._bases, self.order[exon[keep]], overlap[keep])
 
+# chromosome names, with those naming the same chromosome ('chr1', '1') made equal
+normalize_chroms = np.vectorize(lambda c: str(chromosomes.get(c, c)), otypes=[object])
 
-def action(args):
+def calculate_total_covered(probes, regions=None):
+    '''calculate the total regions covered by the probes file, or only the
+    probes overlapping `regions`, counting bases under overlapping probes once'''
+    __, chroms, starts, ends = read_assay(probes, regions)
+    return union_length(normalize_chroms(chroms), starts, ends)
+
+def calculate_coding_covered(probes, spans):
+    '''calculate the bases covered by the probes, (chroms, starts, ends), within
+    any of the gene `spans`, (chroms, starts, ends), counting each base once
+    however many probes and overlapping genes cover it'''
+    normalize = normalize_chroms
+    chroms, starts, ends = probes
+    span_chroms, span_starts, span_ends = spans
+    if not len(chroms) or not len(span_chroms):
+        return 0
+    return intersection_length(normalize(chroms), starts, ends, normalize(span_chroms), span_starts, span_ends)
 
-    if args.bedtools.endswith('img'):
-        bedtools='singularity exec --bind {} --pwd {} {}'.format(os.getcwd(), os.getcwd(), args.bedtools)
+
+def read_assay(bed, regions=None):
+    """Read the assay bed file, returning the probe lines (without line
+    endings) and arrays of their chromosomes, starts and ends. Header,
+    track and browser lines are skipped, as bedtools does. With
+    `regions`, only the probes overlapping them are read."""
+    if regions is not None:
+        source = fetch(bed, regions)
     else:
-        bedtools=args.bedtools
+        with open(bed, 'r') as f:
+            source = f.readlines()
+    lines = [line.rstrip('\n') for line in source
+             if line.strip() and not line.startswith(('#', 'track', 'browser'))]
+    fields = [line.split('\t', 3) for line in lines]
+    chroms = np.array([f[0] for f in fields], dtype=object)
+    starts = np.array([int(f[1]) for f in fields], dtype=np.int64)
+    ends = np.array([int(f[2]) for f in fields], dtype=np.int64)
+    return lines, chroms, starts, ends
 
-    out = args.outdir if args.outdir else ''
-    refgenes = {}
-    genes = {}
+def _coverage(probes, rows, row_keys, trackers, nkeys):
+    """Intersect `probes` (chroms, starts, ends) with the refgene `rows`,
+    inserting the probes into `trackers`, a mapping of the refgenes key
+    index in `row_keys` to its exonTracker. Returns a mask of the probes
+    intersecting any refgene and the bases covered for each key. Probes
+    are merged first, so bases covered by overlapping probes count once."""
+    row_chroms, row_starts, row_ends, row_refgenes = rows
+    intersecting = overlaps_any(*(probes + (row_chroms, row_starts, row_ends)))
+    chroms, starts, ends = merge_intervals(*probes)
 
-    refgene_header = ['chrom','chromStart','chromEnd','name', 'refgene','strand','exonCount','exonStarts','exonEnds'] 
-    genes_header = ['Gene', 'RefSeq']
-    
-    # 1) Read refGene.txt into the refgenes dictionary
-    for line in csv.DictReader(open(args.refgene_bed, 'r'), delimiter='\t', fieldnames=refgene_header):
-        refgene = line['refgene'].split('.')[0]
-        name = line['name']
-        # Dictionary-ize refgene.bed
+    bases_covered = np.zeros(nkeys, dtype=np.int64)
+    for probe_index, row_index in intersect(chroms, starts, ends, row_chroms, row_starts, row_ends):
+        overlap = np.minimum(ends[probe_index], row_ends[row_index]) - \
+                  np.maximum(starts[probe_index], row_starts[row_index])
+        key = row_keys[row_index]
+        known = key >= 0
+        if not known.all():
+            for r in set(np.asarray(row_refgenes, dtype=object)[row_index[~known]]):
+                log.warning('Refseq {} is not an NM_ or NR_ transcript, skipping'.format(r))
+        probe_index, key, overlap = probe_index[known], key[known], overlap[known]
+        if not len(key):
+            continue
+        bases_covered += np.bincount(key, weights=overlap, minlength=nkeys).astype(np.int64)
+        #Insert all of a transcript's probes at once
+        order = np.argsort(key, kind='stable')
+        key, probe_index = key[order], probe_index[order]
+        bounds = np.flatnonzero(np.diff(key)) + 1
+        for k, probes in zip(key[np.concatenate(([0], bounds))], np.split(probe_index, bounds)):
+            trackers[k].insert_many(starts[probes], ends[probes])
+    return intersecting, bases_covered
+
+def _partition_coverage(task):
+    """Run _coverage for one chromosome, with new trackers, returning
+    the per-exon coverage of the trackers instead of the trackers"""
+    probes, rows, row_keys, trackers, nkeys = task
+    trackers = {k: exonTracker(t.exonStarts, t.exonEnds) for k, t in trackers.items()}
+    intersecting, bases_covered = _coverage(probes, rows, row_keys, trackers, nkeys)
+    return intersecting, bases_covered, {k: t.bases for k, t in trackers.items() if t.exons_hit()}
+
+def _partition_digest(task, keys):
+    """Hash the probes, refgene rows and exons of a chromosome partition task"""
+    (chroms, starts, ends), (row_chroms, row_starts, row_ends, row_refgenes), part_keys, trackers, __ = task
+    tracked = sorted(trackers)
+    exons = [np.asarray(trackers[k].exonStarts, dtype=np.int64) for k in tracked] + \
+            [np.asarray(trackers[k].exonEnds, dtype=np.int64) for k in tracked]
+    return cache.array_digest([PARTITION_VERSION], chroms, starts, ends,
+                              row_chroms, row_starts, row_ends, row_refgenes,
+                              [keys[k] if k >= 0 else '' for k in part_keys.tolist()],
+                              [keys[k] for k in tracked], [len(trackers[k]) for k in tracked],
+                              np.concatenate(exons) if exons else [])
+
+def _store_partition(digest, result, keys, chrom):
+    """Cache the result of _partition_coverage, keyed by refgene rather than by key index"""
+    hit, covered, bases = result
+    covered_keys = np.flatnonzero(covered)
+    exon_keys = sorted(bases)
+    cache.store_arrays(PARTITION_KIND, digest, {
+        'intersecting': hit,
+        'covered_refgenes': np.array([keys[k] for k in covered_keys], dtype=str),
+        'covered': covered[covered_keys],
+        'exon_refgenes': np.array([keys[k] for k in exon_keys], dtype=str),
+        'exon_counts': np.array([len(bases[k]) for k in exon_keys], dtype=np.int64),
+        'exon_bases': np.concatenate([bases[k] for k in exon_keys]) if exon_keys else np.array([], dtype=np.int64),
+    }, 'summarize_assay chromosome {}'.format(chrom))
+
+def _load_partition(digest, key_index):
+    """Return a cached result of _partition_coverage, or None"""
+    data = cache.load_arrays(PARTITION_KIND, digest)
+    if data is None:
+        return None
+    covered = np.zeros(len(key_index), dtype=np.int64)
+    covered[[key_index[r] for r in data['covered_refgenes'].tolist()]] = data['covered']
+    bases = np.split(data['exon_bases'], np.cumsum(data['exon_counts'])[:-1]) if len(data['exon_counts']) else []
+    return data['intersecting'], covered, {key_index[r]: b for r, b in zip(data['exon_refgenes'].tolist(), bases)}
+
+def native_coverage(bed, refgenes, rows, jobs=1, regions=None, cached=False):
+    """Annotate the refgenes dictionary with bases covered and exons hit
+    by the probes in `bed`, a path or the probes as returned by
+    read_assay, in a single in-process pass. `rows` holds
+    the chrom, start, end and refgene of each line of the refgene bed.
+    Equivalent to `bedtools intersect -wo`; returns the probe lines that
+    do not intersect any refgene, equivalent to `bedtools intersect -v`.
+    With `jobs` > 1 chromosomes are intersected in parallel processes.
+    With `regions` only the probes overlapping them are read. With
+    `cached`, the results for each chromosome are kept in the on-disk
+    cache, keyed by its probes and refgenes, and reused on later runs.
+    """
+    lines, chroms, starts, ends = read_assay(bed, regions) if isinstance(bed, str) else bed
+    row_chroms, row_starts, row_ends, row_refgenes = rows
+    row_starts = np.asarray(row_starts, dtype=np.int64)
+    row_ends = np.asarray(row_ends, dtype=np.int64)
+    rows = (row_chroms, row_starts, row_ends, row_refgenes)
+
+    # Index each refgene bed line by its entry in the refgenes dictionary,
+    # -1 for lines that have none (not NM_ or NR_)
+    keys = list(refgenes)
+    key_index = {k: i for i, k in enumerate(keys)}
+    row_keys = np.array([key_index.get(r, -1) for r in row_refgenes], dtype=np.int64)
+    trackers = [refgenes[k]['exonTracker'] for k in keys]
+
+    if jobs <= 1 and not cached:
+        intersecting, bases_covered = _coverage((chroms, starts, ends), rows, row_keys, trackers, len(keys))
+    else:
+        intersecting = np.zeros(len(lines), dtype=bool)
+        bases_covered = np.zeros(len(keys), dtype=np.int64)
+        partitions = partition_by_chromosome(chroms, row_chroms)
+        tasks = []
+        for probe_index, row_index in partitions:
+            part_keys = row_keys[row_index]
+            tasks.append(((chroms[probe_index], starts[probe_index], ends[probe_index]),
+                          (np.asarray(row_chroms)[row_index], row_starts[row_index], row_ends[row_index],
+                           [row_refgenes[i] for i in row_index]),
+                          part_keys,
+                          {k: trackers[k] for k in set(part_keys[part_keys >= 0].tolist())},
+                          len(keys)))
+
+        # Reuse the results of chromosomes with unchanged probes and refgenes
+        results = [None] * len(tasks)
+        digests = [None] * len(tasks)
+        if cached:
+            for i, task in enumerate(tasks):
+                digests[i] = _partition_digest(task, keys)
+                results[i] = _load_partition(digests[i], key_index)
+            log.info('reusing cached results for {} of {} chromosomes'.format(
+                sum(r is not None for r in results), len(tasks)))
+        todo = [i for i, result in enumerate(results) if result is None]
+        if jobs <= 1 or len(todo) <= 1:
+            computed = map(_partition_coverage, [tasks[i] for i in todo])
+            for i, result in zip(todo, computed):
+                results[i] = result
+        else:
+            with Pool(min(jobs, len(todo))) as pool:
+                for i, result in zip(todo, pool.imap(_partition_coverage, [tasks[i] for i in todo])):
+                    results[i] = result
+        for i in todo if cached else []:
+            _store_partition(digests[i], results[i], keys, chroms[partitions[i][0][0]])
+
+        for (probe_index, __), (hit, covered, bases) in zip(partitions, results):
+            intersecting[probe_index] = hit
+            bases_covered += covered
+            for k, exon_bases in bases.items():
+                trackers[k].add_bases(exon_bases)
+
+    for k, covered in zip(keys, bases_covered):
+        refgenes[k]['bases_covered'] += int(covered)
+
+    return [line + '\n' for line, hit in zip(lines, intersecting) if not hit]
+
+def exon_table(table):
+    """Return the row, exon number (counted from the 5' end), chrom, start and end of every exon in the table"""
+    counts = table['exonCount'].astype(np.int64)
+    rows = np.repeat(np.arange(len(table)), counts)
+    index = np.arange(counts.sum()) - np.repeat(table.exon_offsets[:-1], counts)
+    numbers = np.where(table['strand'][rows] == '-', counts[rows] - index, index + 1)
+    return rows, numbers, table.chrom[rows], table.exon_starts.astype(np.int64), table.exon_ends.astype(np.int64)
+
+def write_depth(probes, table, out, thresholds=(1,)):
+    """Write the probe depth over every exon of the refgene table, and histograms of
+    the bases at each depth per exon and per transcript, from the unmerged `probes`"""
+    track = CoverageTrack.from_intervals(*probes)
+    rows, numbers, chroms, starts, ends = exon_table(table)
+    genes, refgenes = table['name2'][rows].tolist(), table['name'][rows].tolist()
+
+    summary = track.summarize(chroms, starts, ends, thresholds)
+    with open(os.path.join(out, 'exon_depth_summary.txt'), 'w') as f:
+        writer = csv.writer(f, delimiter='\t', lineterminator='\n')
+        writer.writerow(['gene', 'refgene', 'exon', 'chrom', 'start', 'end', 'min_depth', 'mean_depth'] +
+                        ['fraction_{}x'.format(k) for k in thresholds])
+        writer.writerows(zip(genes, refgenes, numbers.tolist(), chroms.tolist(), starts.tolist(), ends.tolist(),
+                             summary['min'].tolist(), np.round(summary['mean'], 3).tolist(),
+                             *[np.round(summary[k], 3).tolist() for k in thresholds]))
+
+    # per exon, then summed over the exons of each transcript
+    exon, depth, bases = track.histogram(chroms, starts, ends)
+    totals = {}
+    for row, d, b in zip(rows[exon].tolist(), depth.tolist(), bases.tolist()):
+        totals[row, d] = totals.get((row, d), 0) + b
+    with open(os.path.join(out, 'depth_histogram.txt'), 'w') as f:
+        writer = csv.writer(f, delimiter='\t', lineterminator='\n')
+        writer.writerow(['gene', 'refgene', 'exon', 'depth', 'bases'])
+        writer.writerows((genes[i], refgenes[i], numbers[i], d, b)
+                         for i, d, b in zip(exon.tolist(), depth.tolist(), bases.tolist()))
+        names, accessions = table['name2'].tolist(), table['name'].tolist()
+        writer.writerows((names[row], accessions[row], 'all', d, b) for (row, d), b in sorted(totals.items()))
+    return track
+
+def bedtools_coverage(bed, refgene_bed, bedtools, refgenes, assay=None):
+    """Annotate the refgenes dictionary with bases covered and exons hit
+    by the probes in `bed` (parsed by read_assay, unless given as `assay`)
+    using bedtools, returning the probe lines that
+    do not intersect any refgene. As in native_coverage, probes are
+    merged before they are counted, so bases covered by overlapping
+    probes count once. `bedtools intersect -wo` (of the merged probes)
+    and `bedtools intersect -v` run at once, and their output is read
+    from pipes as it is written."""
+    merged = merge_intervals(*(assay or read_assay(bed))[1:])
+    probes = ('{}\t{}\t{}\n'.format(*probe) for probe in zip(*(a.tolist() for a in merged)))
+    with ThreadPoolExecutor(1) as executor, \
+            Pipeline([bedtools_command(bedtools, 'intersect', '-v', '-a', bed, '-b', refgene_bed)]) as non_intersect, \
+            Pipeline([bedtools_command(bedtools, 'intersect', '-wo', '-a', 'stdin', '-b', refgene_bed)],
+                     input=probes) as intersect:
+        non_intersecting = read_lines(non_intersect, executor)
+
+        # Parse the intersection, collecting the number of covered bases per-gene, and annotate refgenes dictionary
+        for line in intersect:
+            ls = line.strip('\n').split('\t')
+            #Find the NM_ column, can be different depending on the input file
+            indices = [i for i, s in enumerate(ls) if 'NM_' in s.upper() or 'NR_' in s.upper()]
+            if len(indices) != 1:
+                log.warning('{} NM_ or NR_ fields in intersection {}, skipping'.format(len(indices), ls))
+                continue
+            refgene = ls[indices[0]].split('.')[0]          # We pick out the refgene of the gene from refGene that was matched
+            if refgene not in refgenes:
+                log.warning('Refseq {} in intersection {} is not in refgene_bed, skipping'.format(refgene, ls))
+                continue
+            overlap = int(ls[-1]) # The '-wo' switch from intersect_args put the amount of overlap here
+            refgenes[refgene]['bases_covered'] += overlap
+            refgenes[refgene]['exonTracker'].insert(int(ls[1]), int(ls[2]))
+        return non_intersecting.result()
+
+def refgene_rows(table):
+    """Return the chrom, start, end and refgene (without version) of each line of the refgene bed"""
+    accessions = [r.split('.')[0] for r in table['name']]
+    return (table.chrom, table['txStart'], table['txEnd'], accessions)
+
+def read_refgenes(table, rows):
+    """Dictionary-ize refgene.bed, returning a new refgenes dictionary with no coverage"""
+    refgenes = {}
+    chroms, chromStarts, chromEnds, accessions = rows
+    names = table['name2']
+    first = {}
+    for i, refgene in enumerate(accessions):
         # Insert unseen refgenes into the dictionary; 
         # We asume that refgene only has ONE line per refgene
-        exonStarts=list(filter(None,[x for x in line['exonStarts'].split(',')]))
-        exonEnds=list(filter(None,[x for x in line['exonEnds'].split(',')]))
-        if refgene not in refgenes and ('NM_' in refgene or 'NR_' in refgene):
-            refgenes[refgene] = dict( [('name', name),
-                                       ('refgene', refgene),
-                                       ('chrom', line['chrom'].strip('chr')),
-                                       ('chromStart', int(line['chromStart'])),
-                                       ('chromEnd', int(line['chromEnd'])),
-                                       ('exonTracker', exonTracker(exonStarts, exonEnds)),
-                                       ('bases_covered', 0)])
-            #Sanity checks
-            assert(len(exonStarts) == len(exonEnds))
-            for start,end in zip(exonStarts, exonEnds):
-                assert(int(start) < int(end))
-                assert(int(line['chromStart']) <= int(start) and int(start) < int(line['chromEnd']))
-                assert(int(line['chromStart']) < int(end) and int(end) <= int(line['chromEnd']))
-        else:
-            pass
-            #sys.stderr.write("RefSeq {} is listed twice in refGene!".format(line['refgene']))
-
-    # 2) Using bedtools, calculate how many bases are actually covered for each gene
-    intersection=os.path.join(out,'intersect_probes_refgene.txt')
-    write_intersect=open(intersection, 'w')
-    intersect_args = [x for x in bedtools.split(' ')]+['bedtools','intersect', '-wo' ,'-a', args.bed, '-b', args.refgene_bed]
-    subprocess.call(intersect_args, stdout=write_intersect)
-    write_intersect.close()
-
-    # Parse that output, collecting the number of covered bases per-gene, and annotate refgenes dictionary
-    # Note: Communicate returns (stdoutdata, stderrdata), stdout is a giant string, not an iterable
-    # Also, the last line is just a newline, which must be skipped
-    for line in open(intersection):
-        ls = line.strip('\n').split('\t')
-        #Find the NM_ column, can be different depending on the input file
-        indices = [i for i, s in enumerate(ls) if 'NM_' in s.upper() or 'NR_' in s.upper()]
-        if len(indices)>1:
-            sys.stderr.write("Refseq {} is listed twice in refGene!".format(line['refgene']))
-        elif len(indices)<1:
-            sys.stderr.write(line)
-        refgene = ls[indices[0]].split('.')[0]          # We pick out the refgene of the gene from refGene that was matched
-        overlap = int(ls[-1]) # The '-wo' switch from intersect_args put the amount of overlap here
-        refgenes[refgene]['bases_covered'] += overlap
-        refgenes[refgene]['exonTracker'].insert(int(ls[1]), int(ls[2]))
+        if refgene not in first and ('NM_' in refgene or 'NR_' in refgene):
+            first[refgene] = i
+    keep = np.array(sorted(first.values()), dtype=np.int64)
 
-    # 4) Print per-refgene summary, one file for preferred genes another file for genes covered but not listed in preferred
-    refgene_header = ['gene','refgene','total_bases_targeted','length_of_gene','fraction_of_gene_covered','exons_with_any_coverage','total_exons_in_gene']
+    #Sanity checks, on every exon of the rows we keep
+    counts = table['exonCount'][keep].astype(np.int64)
+    exon_rows = np.repeat(keep, counts)
+    exon_index = np.repeat(table.exon_offsets[keep] - (np.cumsum(counts) - counts), counts) + np.arange(counts.sum())
+    exonStarts, exonEnds = table.exon_starts[exon_index], table.exon_ends[exon_index]
+    assert((exonStarts < exonEnds).all())
+    assert(((chromStarts[exon_rows] <= exonStarts) & (exonStarts < chromEnds[exon_rows])).all())
+    assert(((chromStarts[exon_rows] < exonEnds) & (exonEnds <= chromEnds[exon_rows])).all())
+
+    names, chroms = names[keep].tolist(), chroms[keep].tolist()
+    chromStarts, chromEnds = chromStarts[keep].tolist(), chromEnds[keep].tolist()
+    offsets = table.exon_offsets.tolist()
+    for j, (refgene, i) in enumerate(first.items()):
+        exonStarts = table.exon_starts[offsets[i]:offsets[i + 1]]
+        exonEnds = table.exon_ends[offsets[i]:offsets[i + 1]]
+        refgenes[refgene] = dict( [('name', names[j]),
+                                   ('refgene', refgene),
+                                   ('chrom', chroms[j].strip('chr')),
+                                   ('chromStart', chromStarts[j]),
+                                   ('chromEnd', chromEnds[j]),
+                                   ('exonTracker', exonTracker(exonStarts, exonEnds)),
+                                   ('bases_covered', 0)])
+    return refgenes
+
+refgene_header = ['gene','refgene','total_bases_targeted','length_of_gene','fraction_of_gene_covered','exons_with_any_coverage','total_exons_in_gene']
+
+def refgene_summary(gene, refgene, data):
+    """Return the per-refgene summary fields of `data`, an entry of the refgenes dictionary"""
+    length = data['chromEnd'] - data['chromStart']
+    return dict([('gene', gene),
+                 ('refgene', refgene),
+                 ('total_bases_targeted', data['bases_covered']),
+                 ('length_of_gene', length),
+                 ('fraction_of_gene_covered', round(float(data['bases_covered']) / float(length), 3)),
+                 ('exons_with_any_coverage', data['exonTracker'].exons_hit()),
+                 ('total_exons_in_gene', len(data['exonTracker']))])
 
-    pref_refgene_writer = csv.DictWriter(open(os.path.join(out, "preferred_refgene_summary.txt"), 'w'), fieldnames=refgene_header,  delimiter='\t', extrasaction='ignore')
+def write_summaries(bed, genes_file, out, refgenes, non_intersecting, regions=None):
+    """Write the per-refgene and overall summaries for the probes in `bed`,
+    a path or the probes as returned by read_assay.
+    `genes_file` is the path to the preferred transcripts, or its lines.
+    With `regions`, `refgenes` holds only the refgenes overlapping them and
+    preferred transcripts outside the regions are left out."""
+    genes = {}
+    genes_header = ['Gene', 'RefSeq']
+
+    # 4) Print per-refgene summary, one file for preferred genes another file for genes covered but not listed in preferred
+    pref_file = open(os.path.join(out, "preferred_refgene_summary.txt"), 'w')
+    pref_refgene_writer = csv.DictWriter(pref_file, fieldnames=refgene_header,  delimiter='\t', extrasaction='ignore')
     pref_refgene_writer.writeheader()
 
-    other_refgene_writer = csv.DictWriter(open(os.path.join(out, "other_refgene_summary.txt"), 'w'), fieldnames=refgene_header,  delimiter='\t', extrasaction='ignore')
+    other_file = open(os.path.join(out, "other_refgene_summary.txt"), 'w')
+    other_refgene_writer = csv.DictWriter(other_file, fieldnames=refgene_header,  delimiter='\t', extrasaction='ignore')
     other_refgene_writer.writeheader()
 
-    # While we're looping through refgenes, count the total bases,and refgenes covered
-    total_coding_bases = 0
+    # While we're looping through refgenes, collect the refgenes counted and count those covered
+    counted = []
     gene_count = 0
 
-    for gene in csv.DictReader(open(args.genes, 'r'), delimiter='\t', fieldnames=genes_header):
+    if isinstance(genes_file, str):
+        with open(genes_file, 'r') as f:
+            genes_lines = f.readlines()
+    else:
+        genes_lines = genes_file
+    for gene in csv.DictReader(genes_lines, delimiter='\t', fieldnames=genes_header):
         transcript = gene['RefSeq'].split('.')[0]
         if transcript.upper()=='REFSEQ':
             continue
+        if regions is not None and transcript not in refgenes:
+            continue
         try:
             #assert that the NM provided in the Pref_Trans is for the Gene they requested
             if refgenes[transcript]['name']!=gene['Gene']:
@@ -144,21 +482,11 @@ def action(args):
                                   ('exons_with_any_coverage','NA'),
                                   ('total_exons_in_gene','NA')])
             else:
-                gene['bases_covered']=refgenes[transcript]['bases_covered']
                 #Only count this as a covered gene if it has coverage
-                if gene['bases_covered'] > 0:
+                if refgenes[transcript]['bases_covered'] > 0:
                     gene_count +=1
-                exons = [exon for exon in refgenes[transcript]['exonTracker'].exons.values()].count(True)
-                    
-                outfields = dict([('gene', gene['Gene']), 
-                                  ('refgene', gene['RefSeq']),
-                                  ('total_bases_targeted', gene['bases_covered']),
-                                  ('length_of_gene',refgenes[transcript]['chromEnd'] - refgenes[transcript]['chromStart']),
-                                  ('fraction_of_gene_covered',round(float(gene['bases_covered']) /
-                                                                    float(refgenes[transcript]['chromEnd'] - refgenes[transcript]['chromStart']),3)),
-                                  ('exons_with_any_coverage',exons),
-                                  ('total_exons_in_gene',len(refgenes[transcript]['exonTracker'].exons))])
-                total_coding_bases += gene['bases_covered']
+                outfields = refgene_summary(gene['Gene'], gene['RefSeq'], refgenes[transcript])
+                counted.append(refgenes[transcript])
 
         #If this refgene isn't found, we should state that, cleanly 
         except KeyError:
@@ -180,16 +508,8 @@ def action(args):
         else:
             if data['bases_covered'] > 0:
                 gene_count +=1
-                exons = [exon for exon in data['exonTracker'].exons.values()].count(True)
-                outfields = dict([('gene', data['name']), 
-                                  ('refgene', transcript),
-                                  ('total_bases_targeted', data['bases_covered']),
-                                  ('length_of_gene',data['chromEnd'] - data['chromStart']),
-                                  ('fraction_of_gene_covered',round(float(data['bases_covered']) /
-                                                                    float(data['chromEnd'] - data['chromStart']),3)),
-                                  ('exons_with_any_coverage',exons),
-                                  ('total_exons_in_gene',len(data['exonTracker'].exons))])
-                total_coding_bases += data['bases_covered']
+                outfields = refgene_summary(data['name'], transcript, data)
+                counted.append(data)
                 genes[data['name']] = outfields
 
     for gene,data in sorted(genes.items()):
@@ -197,31 +517,83 @@ def action(args):
             pref_refgene_writer.writerow(data)
         else:
             other_refgene_writer.writerow(data)
+    pref_file.close()
+    other_file.close()
         
 
 
-    #5)  Calculate total regions covered 
-    total_bases = calculate_total_covered(args.bed)
-    non_intersection=os.path.join(out,'non_intersect_probes_refgene.txt')
-    write_non_intersect=open(non_intersection, 'w')
-    non_intersect_args = [x for x in bedtools.split(' ')]+['bedtools','intersect', '-v' ,'-a', args.bed, '-b', args.refgene_bed]
-    subprocess.call(non_intersect_args, stdout=write_non_intersect)
-    write_non_intersect.close()
+    #5)  Calculate total regions covered, and covered within the counted refgenes. Probes and
+    # refgenes can overlap and share bases, so these are the sizes of the unions, not sums
+    __, chroms, starts, ends = read_assay(bed, regions) if isinstance(bed, str) else bed
+    total_bases = union_length(normalize_chroms(chroms), starts, ends)
+    spans = ([data['chrom'] for data in counted],
+             np.array([data['chromStart'] for data in counted], dtype=np.int64),
+             np.array([data['chromEnd'] for data in counted], dtype=np.int64))
+    total_coding_bases = calculate_coding_covered((chroms, starts, ends), spans)
 
     # 6) Print overall summary
     overall = open(os.path.join(out, "overall_summary.txt"),'w')
 
-    # Note: The total bases and exon counts are probably slightly overestimated, since refgenes can
-    # overlap and share bases.  The number of overlapping bases and exons, however, are neglible
-    # and cumbersome to calculate
     overall.write("{} unique bases were targeted\n".format(total_bases))
     overall.write("{} unique bases within gene boundaries were targeted\n".format(total_coding_bases))
     overall.write("{} unique refgenes had at least one base targeted\n".format(gene_count))
 
-    data=open(non_intersection)
-    if data:
-        overall.write("The following probes did not intersect with transcription region of any gene listed in the preferred transcripts provided.:\n")
-        for line in data:
-            overall.write(line)
+    overall.write("The following probes did not intersect with transcription region of any gene listed in the preferred transcripts provided.:\n")
+    for line in non_intersecting:
+        overall.write(line)
+    overall.close()
 
+def action(args):
 
+    if args.engine == 'bedtools' and not args.bedtools:
+        log.error('Error: --engine bedtools requires the path to bedtools')
+        sys.exit(1)
+
+    if args.engine == 'bedtools' and (args.region or args.region_genes):
+        log.error('Error: --region and --region-genes require --engine native')
+        sys.exit(1)
+
+    try:
+        regions = regions_from_args(args.region, args.region_genes, args.refgene_bed, 'bed')
+        thresholds = [int(k) for k in args.depth_thresholds.split(',') if k]
+    except ValueError as err:
+        log.error('Error: {}'.format(err))
+        sys.exit(1)
+
+    out = args.outdir if args.outdir else ''
+
+    # 1) Read refGene.txt into the refgenes dictionary
+    with metrics.stage('read-refgene') as stage:
+        table = RefGeneTable.read(args.refgene_bed, format='bed', regions=regions)
+        rows = refgene_rows(table)
+        refgenes = read_refgenes(table, rows)
+        stage.rows = len(table)
+
+    with metrics.stage('read-assay') as stage:
+        assay = read_assay(args.bed, regions)
+        stage.rows = len(assay[0])
+
+    # 2) Calculate how many bases are actually covered for each gene, and which probes are outside of all genes
+    with metrics.stage('intersect'):
+        if args.engine == 'bedtools':
+            with Bedtools(args.bedtools) as bedtools:
+                non_intersecting = bedtools_coverage(args.bed, args.refgene_bed, bedtools, refgenes, assay)
+        else:
+            non_intersecting = native_coverage(assay, refgenes, rows, args.jobs, regions, cache.enabled())
+
+    with metrics.stage('write-outputs') as stage:
+        write_summaries(assay, args.genes, out, refgenes, non_intersecting, regions)
+        stage.rows = len(refgenes)
+
+    # 3) Optionally, report probe depth per base
+    if args.depth or args.bedgraph:
+        with metrics.stage('depth') as stage:
+            probes = assay[1:]
+            if args.depth:
+                track = write_depth(probes, table, out, thresholds)
+            else:
+                track = CoverageTrack.from_intervals(*probes)
+            if args.bedgraph:
+                with open(args.bedgraph, 'w') as f:
+                    track.write_bedgraph(f, name=os.path.basename(args.bed))
+            stage.rows = len(probes[0])
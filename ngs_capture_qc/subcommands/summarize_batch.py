@@ -0,0 +1,99 @@
+"""
+Run summarize_assay for many assay designs, reading refgene.bed only once
+
+The manifest is a tab-delimited file with one design per line: the assay
+bed file, the genes file and the output directory, as would be passed to
+summarize_assay as bed, genes and --outdir. Designs are summarized in
+parallel; the refgene table is held in shared memory and attached by each
+worker rather than copied to it.
+
+usage:
+
+ capqc summarize_batch manifest.txt refgene.bed --jobs 8
+"""
+
+import sys
+import csv
+import os
+import logging
+
+from multiprocessing import Pool
+
+from ngs_capture_qc.subcommands.summarize_assay import refgene_rows, read_assay, read_refgenes, native_coverage, write_summaries
+from ngs_capture_qc import cache, metrics
+from ngs_capture_qc.utils import RefGeneTable, mkdir
+
+log = logging.getLogger(__name__)
+
+manifest_header = ['bed', 'genes', 'outdir']
+
+def build_parser(parser):
+    parser.add_argument('manifest', help="Tab-delimited file of assay bed, genes file and output directory, one design per line")
+    parser.add_argument('refgene_bed', help="UCSC Refgene data in bed format")
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count() or 1,
+                        help='Number of designs to summarize at once (default: number of CPUs)')
+
+def read_manifest(manifest):
+    """Return a list of (bed, genes, outdir) for each design in the manifest"""
+    designs = []
+    with open(manifest) as f:
+        for row in csv.reader(f, delimiter='\t'):
+            if not row or row[0].startswith('#') or row[:3] == manifest_header:
+                continue
+            if len(row) < 3:
+                raise ValueError('Manifest lines need bed, genes and outdir columns: {}'.format('\t'.join(row)))
+            designs.append(tuple(row[:3]))
+    return designs
+
+# The refgene table and its rows, set once per worker process
+_table = None
+_rows = None
+
+def _init_worker(table):
+    """Set the table for this process; `table` is a RefGeneTable or a spec from RefGeneTable.share"""
+    global _table, _rows
+    _table = table if isinstance(table, RefGeneTable) else RefGeneTable.attach(table)
+    _rows = refgene_rows(_table)
+
+def summarize(design):
+    """Summarize one (bed, genes, outdir) design against the table set by _init_worker"""
+    bed, genes, out = design
+    mkdir(out)
+    refgenes = read_refgenes(_table, _rows)
+    assay = read_assay(bed)
+    non_intersecting = native_coverage(assay, refgenes, _rows, cached=cache.enabled())
+    write_summaries(assay, genes, out, refgenes, non_intersecting)
+    return out
+
+def summarize_batch(designs, table, jobs=1):
+    """Summarize each design in `designs`, using up to `jobs` processes"""
+    if jobs <= 1 or len(designs) <= 1:
+        _init_worker(table)
+        for design in designs:
+            log.info('summarized {}'.format(summarize(design)))
+        return
+
+    spec, blocks = table.share()
+    try:
+        with Pool(min(jobs, len(designs)), initializer=_init_worker, initargs=(spec,)) as pool:
+            for out in pool.imap_unordered(summarize, designs):
+                log.info('summarized {}'.format(out))
+    finally:
+        for block in blocks:
+            block.close()
+            block.unlink()
+
+def action(args):
+    try:
+        designs = read_manifest(args.manifest)
+    except ValueError as err:
+        log.error('Error: {}'.format(err))
+        sys.exit(1)
+
+    with metrics.stage('read-refgene') as stage:
+        table = RefGeneTable.read(args.refgene_bed, format='bed')
+        stage.rows = len(table)
+
+    with metrics.stage('summarize') as stage:
+        summarize_batch(designs, table, args.jobs)
+        stage.rows = len(designs)
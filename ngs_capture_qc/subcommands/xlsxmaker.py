@@ -1,6 +1,12 @@
 """
 Create xlsx workbook from all output files
 
+Files are streamed into the workbook in batches of rows, with XlsxWriter
+in constant_memory mode, so memory use does not grow with the size of
+the files. Numbers are written as numbers. A file with more rows than
+an Excel sheet holds is continued on further sheets, named "name (2)"
+and so on.
+
 usage:
 
  capqc xlsmaker /path/to/summary/files
@@ -8,9 +14,17 @@ usage:
 """
 import csv
 import os
+from itertools import islice
 
 from xlsxwriter import Workbook
 
+from ngs_capture_qc import metrics
+
+# Rows in an Excel sheet, characters in a sheet name, and rows parsed at once
+MAX_ROWS = 1048576
+MAX_SHEET_NAME = 31
+BATCH_SIZE = 10000
+
 def build_parser(parser):
     parser.add_argument(
         'infiles', action='append', nargs='+',
@@ -19,25 +33,99 @@ def build_parser(parser):
         '-o', '--outfile',
         help='Output file', required=True)
 
-def write_workbook(sheet_name, book, fname):
+def read_batches(fname, batch_size=None):
+    """
+    Yield lists of up to `batch_size` (default BATCH_SIZE) rows, as lists of strings, from a tab-delimited file
+    """
+    batch_size = batch_size or BATCH_SIZE
+    with open(fname, newline='') as f:
+        reader = csv.reader(f, delimiter='\t')
+        while True:
+            batch = list(islice(reader, batch_size))
+            if not batch:
+                return
+            yield batch
+
+def _convert_column(column):
+    """
+    Convert the numeric strings in an array of strings to ints and
+    floats, returning an object array. Integers too long for Excel to
+    hold exactly, or with leading zeros, are left as strings.
+    """
+    import numpy as np
+    values = column.astype(object)
+    lengths = np.char.str_len(column)
+    digits = np.char.lstrip(column, '-')
+    ndigits = np.char.str_len(digits)
+    int_like = np.char.isdecimal(digits) & (lengths - ndigits <= 1)
+    is_int = int_like & (ndigits <= 15) & ((ndigits == 1) | ~np.char.startswith(digits, '0'))
+    if is_int.any():
+        values[is_int] = column[is_int].astype(np.int64).astype(object)
+
+    rest = np.flatnonzero(~int_like & (lengths > 0))
+    if len(rest):
+        try:
+            floats = column[rest].astype(np.float64)
+        except ValueError:
+            # some are not numbers; convert one at a time
+            floats = np.array([_float(v) for v in column[rest].tolist()], dtype=np.float64)
+        finite = np.isfinite(floats)
+        values[rest[finite]] = floats[finite].astype(object)
+    return values
+
+def _float(value):
+    try:
+        return float(value)
+    except ValueError:
+        return float('nan')
+
+def convert_rows(rows):
+    """
+    Convert a batch of rows of strings, column by column, to rows of strings, ints and floats
+    """
+    import numpy as np
+    width = max(len(row) for row in rows)
+    padded = np.array([row + [''] * (width - len(row)) for row in rows], dtype=str).reshape(len(rows), width)
+    columns = [_convert_column(padded[:, colx]) for colx in range(width)]
+    converted = np.column_stack(columns) if columns else np.empty((len(rows), 0), dtype=object)
+    return [values[:len(row)] for values, row in zip(converted.tolist(), rows)]
+
+def sheet_name(name, part):
+    """
+    Name of the `part`th sheet for a file, within Excel's limit on the length of sheet names
+    """
+    suffix = ' ({})'.format(part) if part > 1 else ''
+    return name[:MAX_SHEET_NAME - len(suffix)] + suffix
+
+def write_workbook(sheet_name_, book, fname):
     """
-    Write analysis file as sheet in workbook
+    Write analysis file as sheet in workbook, continuing on new sheets
+    every MAX_ROWS rows. Returns the number of rows written.
     """
-    sheet = book.add_worksheet(sheet_name)    
-    Reader = csv.reader(open(fname, 'rU'), delimiter='\t')
-    for rowx, row in enumerate(Reader):
-        for colx, value in enumerate(row):
-            sheet.write(rowx, colx, value)
+    sheet, rowx, part, total = None, MAX_ROWS, 0, 0
+    for batch in read_batches(fname):
+        for row in convert_rows(batch):
+            if rowx == MAX_ROWS:
+                part += 1
+                sheet = book.add_worksheet(sheet_name(sheet_name_, part))
+                rowx = 0
+            sheet.write_row(rowx, 0, row)
+            rowx += 1
+        total += len(batch)
+    if sheet is None:
+        book.add_worksheet(sheet_name(sheet_name_, 1))
+    return total
 
 def action(args):
 
-    book = Workbook()
+    book = Workbook(args.outfile, {'constant_memory': True})
     (infiles, ) = args.infiles
     for fname in infiles:
         (f_path, f_name) = os.path.split(fname)
         (f_short_name, f_extension) = os.path.splitext(f_name)
         print(fname)
-        write_workbook(f_short_name, book, fname)
-    book.filename=args.outfile
+        with metrics.stage('read-' + f_short_name) as stage:
+            stage.rows = write_workbook(f_short_name, book, fname)
 
-    book.close()
+    with metrics.stage('write-outputs'):
+        book.close()
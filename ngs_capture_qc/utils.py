@@ -1,12 +1,21 @@
 import os
 import gzip
+import json
 import logging
 import shutil
 import sys
 import numpy as np
+from bisect import bisect_right
+from itertools import islice
 from collections import defaultdict
+from collections.abc import Mapping
+from urllib.parse import urlsplit
+from natsort import natsorted
+from multiprocessing import shared_memory
 from intervaltree import Interval, IntervalTree
 
+from ngs_capture_qc import bgzf, cache
+
 try:
     import bz2
 except ImportError as err:
@@ -15,8 +24,22 @@ except ImportError as err:
 else:
     bz2_open = bz2.open if hasattr(bz2, 'open') else bz2.BZ2File
 
+try:
+    import lzma
+except ImportError as err:
+    def lzma_open(filename, mode, *args, **kwargs):
+        sys.exit(err)
+else:
+    lzma_open = lzma.open
+
 log = logging.getLogger(__name__)
 
+# lines of a refGene table parsed at a time
+CHUNK_ROWS = 10000
+
+# version of the arrays RefGeneTable keeps in the cache; bump it when their layout changes
+TABLE_VERSION = 1
+
 
 def cast(val):
     """Attempt to coerce `val` into a numeric type, or a string stripped
@@ -54,7 +77,13 @@ def mkdir(dirpath, clobber=False):
 
 class Opener(object):
     """Factory for creating file objects. Transparenty opens compressed
-    files for reading or writing based on suffix (.gz and .bz2 only).
+    files for reading or writing based on suffix (.gz, .bgz, .bz2 and .xz).
+
+    BGZF (blocked gzip) files, such as those written by bgzip, are
+    detected when reading and decompressed on `threads` threads. Files
+    ending in .bgz, or .gz with ``bgzf=True``, are written as BGZF,
+    compressed on `threads` threads; otherwise .gz files are written by
+    ``gzip.open``.
 
     Example::
 
@@ -64,6 +93,8 @@ class Opener(object):
 
     def __init__(self, mode='r', *args, **kwargs):
         self.mode = mode
+        self.threads = kwargs.pop('threads', None)
+        self.bgzf = kwargs.pop('bgzf', False)
         self.args = args
         self.kwargs = kwargs
         self.writable = 'w' in self.mode
@@ -74,14 +105,18 @@ class Opener(object):
         elif obj == '-':
             return sys.stdout if self.writable else sys.stdin
         else:
-            openers = {'bz2': bz2_open, 'gz': gzip.open}
-            __, suffix = obj.rsplit('.', 1)
+            openers = {'bz2': bz2_open, 'gz': gzip.open, 'bgz': bgzf.open_bgzf, 'xz': lzma_open}
+            suffix = obj.rsplit('.', 1)[-1]
             # in python3, both bz2 and gz libraries default to binary input and output
             mode = self.mode
             if sys.version_info.major == 3 and suffix in openers \
                and mode in {'w', 'r'}:
                 mode += 't'
             opener = openers.get(suffix, open)
+            if suffix == 'gz' and (bgzf.is_bgzf(obj) if not self.writable else self.bgzf):
+                opener = bgzf.open_bgzf
+            if opener is bgzf.open_bgzf:
+                return opener(obj, mode, self.threads, **self.kwargs)
             return opener(obj, mode=mode, *self.args, **self.kwargs)
 
 def check_probe_format(probes):
@@ -89,13 +124,13 @@ def check_probe_format(probes):
     Remove 'chr' if present"""
     assert len(probes.columns)>=5, "Five columns expected. Please format input file as chrm|start|stop|annotation|strand, without a header"
     #assert that chrm is in chromosome dictionary (ie, there is no header)
-    if probes.iloc[0][0] not in chromosomes.keys():
+    if probes.iloc[0, 0] not in chromosomes.keys():
         raise ValueError("Column 1 is not an obvious chromosome. Please format input file as chrm|start|stop|annotation|strand, without a header")
-    elif not isinstance(probes.iloc[0][3], str):
+    elif not isinstance(probes.iloc[0, 3], str):
         raise ValueError("Column 4 is not an obvious annotation. Please format input file as chrm|start|stop|annotation|strand, without a header")
-    elif probes.iloc[0][4] not in ['-','+']:
+    elif probes.iloc[0, 4] not in ['-','+']:
         raise ValueError("Column 5 is not an obvious strand (-,+). Please format input file as chrm|start|stop|annotation|strand, without a header")
-    elif isinstance(probes.iloc[0][1],str) or isinstance(probes.iloc[0][2],str) :
+    elif isinstance(probes.iloc[0, 1],str) or isinstance(probes.iloc[0, 2],str) :
         raise ValueError("Column 2 and/or 3 is not an obvious start|stop position. Please format input file as chrm|start|stop|annotation|strand, without a header")
 
     #Drop all other columns
@@ -116,6 +151,51 @@ chromosomes = {'chr{}'.format(c): c for c in chrnums}
 chromosomes.update({str(c): c for c in chrnums})
 chromosomes.update({c: c for c in chrnums})
 
+def chrom_rank(chroms):
+    '''
+    Return an integer array ranking each chromosome name in natural genomic order: the
+    chromosomes in `chrnums` in order, however they are named (see `chromosomes`), then any
+    other names in natural order.
+    '''
+    chroms = np.asarray(chroms)
+    if not len(chroms):
+        return np.array([], dtype=np.int64)
+    names, codes = np.unique(chroms.astype(str), return_inverse=True)
+    rank = {n: len(chrnums) + i for i, n in enumerate(natsorted(n for n in names if n not in chromosomes))}
+    rank.update((n, chrnums.index(chromosomes[n])) for n in names if n in chromosomes)
+    return np.array([rank[n] for n in names], dtype=np.int64)[codes.ravel()]
+
+def genomic_order(chroms, starts=None, ends=None):
+    '''
+    Return the indices sorting rows by chromosome (ranked by `chrom_rank`), then by start
+    and end as integers if given, with a single numpy lexsort. Ties keep their order.
+    '''
+    keys = [np.asarray(k, dtype=np.int64) for k in (ends, starts) if k is not None]
+    return np.lexsort(keys + [chrom_rank(chroms)])
+
+def partition_by_chromosome(*chrom_arrays):
+    '''
+    Split rows into per-chromosome partitions, eg for processing in parallel.
+
+    Each argument is a sequence of chromosome names, such as the probe and refgene
+    chromosomes. Names that `chromosomes` maps to the same chromosome ('chr1', '1') share a
+    partition. Returns a list of tuples of row index arrays, one per argument, for each
+    chromosome with rows in the first argument, in natural chromosome order.
+    '''
+    groups = defaultdict(lambda: [[] for __ in chrom_arrays])
+    for i, chroms in enumerate(chrom_arrays):
+        chroms = np.asarray(chroms)
+        names, codes = np.unique(chroms, return_inverse=True) if len(chroms) else ([], chroms)
+        for code, name in enumerate(names):
+            groups[chromosomes.get(name, name)][i].append(np.flatnonzero(codes == code))
+
+    def rank(chrom):
+        return (0, chrnums.index(chrom), '') if chrom in chrnums else (1, 0, str(chrom))
+
+    return [tuple(np.sort(np.concatenate(rows)) if rows else np.array([], dtype=np.int64)
+                  for rows in groups[chrom])
+            for chrom in sorted(groups, key=rank) if groups[chrom][0]]
+
 class UCSCTable(object):
     '''A container class for the parsing functions, used in GenomeIntervalTree.from_table``.'''
     REF_GENE_FIELDS = ['bin', 'name', 'chrom', 'strand', 'txStart', 'txEnd', 'cdsStart', 'cdsEnd', 'exonCount', 'exonStarts', 'exonEnds', 'score', 'name2', 'cdsStartStat', 'cdsEndStat', 'exonFrames']
@@ -123,6 +203,328 @@ class UCSCTable(object):
     def REF_GENE(line):
         return dict(zip(UCSCTable.REF_GENE_FIELDS, line.split(b'\t')))
 
+def _parse_list(values, counts):
+    """Parse comma-separated integer lists (with or without a trailing
+    comma) into one flat int32 array, checking each row against `counts`."""
+    joined = ','.join(v.rstrip(',') for v in values if v.rstrip(','))
+    flat = np.fromstring(joined, dtype=np.int64, sep=',') if joined else np.zeros(0, dtype=np.int64)
+    if len(flat) != counts.sum():
+        raise ValueError('Exon lists do not match the exon counts')
+    return flat.astype(np.int32)
+
+def _count_list(value):
+    value = value.rstrip(',')
+    return value.count(',') + 1 if value else 0
+
+def _attach_shared_memory(name):
+    '''Open an existing shared memory block; the process that created it unlinks it'''
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        # Python < 3.13 has no `track`, and registers the block with the resource tracker,
+        # which is shared with the (parent) process that created it, so this is harmless
+        return shared_memory.SharedMemory(name=name)
+
+class RefGeneTable(object):
+    '''
+    Compact, column-oriented copy of a UCSC refGene table (or a refGene BED file).
+
+    Each field is a typed NumPy array with one element per row. Chromosomes are int-coded
+    (``chrom_codes`` indexes ``chrom_names``), coordinates are int32, and the per-exon lists
+    are stored as flat arrays, the exons of row ``i`` being ``exon_starts[exon_offsets[i]:exon_offsets[i+1]]``.
+    '''
+    FIELDS = UCSCTable.REF_GENE_FIELDS
+    INT_FIELDS = ['bin', 'txStart', 'txEnd', 'cdsStart', 'cdsEnd', 'exonCount', 'score']
+    STR_FIELDS = ['name', 'strand', 'name2', 'cdsStartStat', 'cdsEndStat']
+    LIST_FIELDS = {'exonStarts': 'exon_starts', 'exonEnds': 'exon_ends', 'exonFrames': 'exon_frames'}
+
+    def __init__(self, columns, chrom_names, chrom_codes, exon_offsets, exon_starts, exon_ends,
+                 exon_frames, trailing_comma=True):
+        self.columns = columns
+        self.chrom_names = chrom_names
+        self.chrom_codes = chrom_codes
+        self.exon_offsets = exon_offsets
+        self.exon_starts = exon_starts
+        self.exon_ends = exon_ends
+        self.exon_frames = exon_frames
+        self.trailing_comma = trailing_comma
+
+    def __len__(self):
+        return len(self.chrom_codes)
+
+    def __getitem__(self, field):
+        return self.columns[field]
+
+    @property
+    def chrom(self):
+        '''Chromosome name of each row'''
+        return self.chrom_names[self.chrom_codes]
+
+    @classmethod
+    def _build(cls, records, exon_columns, trailing_comma):
+        '''Convert lists of string fields into a table'''
+        records = dict(records)
+        chroms = records.pop('chrom')
+        names = list(dict.fromkeys(chroms))
+        index = {c: i for i, c in enumerate(names)}
+        counts = np.array(records['exonCount'], dtype=np.int32)
+        offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+        exon_starts, exon_ends, exon_frames = (_parse_list(exon_columns[f], counts)
+                                               for f in ['exonStarts', 'exonEnds', 'exonFrames'])
+        columns = {}
+        for field in cls.INT_FIELDS:
+            columns[field] = np.array(records[field], dtype=np.int32)
+        for field in cls.STR_FIELDS:
+            columns[field] = np.array(records[field], dtype=str)
+        return cls(columns, np.array(names, dtype=str),
+                   np.array([index[c] for c in chroms], dtype=np.int16),
+                   offsets, exon_starts, exon_ends, exon_frames, trailing_comma)
+
+    @staticmethod
+    def _lines(fileobj):
+        if isinstance(fileobj, str):
+            with Opener()(fileobj) as f:
+                for fields in RefGeneTable._lines(f):
+                    yield fields
+            return
+        for ln in fileobj:
+            if isinstance(ln, bytes):
+                ln = ln.decode()
+            if not ln.strip() or ln.startswith('#'):
+                continue
+            yield ln.rstrip('\r\n').split('\t')
+
+    @classmethod
+    def _read_chunks(cls, fileobj, build):
+        '''Parse the lines of `fileobj` CHUNK_ROWS at a time with `build`, joining the tables'''
+        lines = cls._lines(fileobj)
+        tables = []
+        while True:
+            chunk = list(islice(lines, CHUNK_ROWS))
+            if not chunk and tables:
+                return cls.concat(tables)
+            tables.append(build(chunk))
+            if not chunk:
+                return tables[0]
+
+    @classmethod
+    def concat(cls, tables):
+        '''Return a table with the rows of each of `tables` in turn'''
+        if len(tables) == 1:
+            return tables[0]
+        names = list(dict.fromkeys(n for t in tables for n in t.chrom_names.tolist()))
+        index = {n: i for i, n in enumerate(names)}
+        codes = [np.array([index[n] for n in t.chrom_names.tolist()], dtype=np.int16)[t.chrom_codes]
+                 for t in tables]
+        counts = np.concatenate([t['exonCount'] for t in tables]).astype(np.int64)
+        offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+        return cls({f: np.concatenate([t[f] for t in tables]) for f in tables[0].columns},
+                   np.array(names, dtype=str), np.concatenate(codes).astype(np.int16), offsets,
+                   *[np.concatenate([getattr(t, a) for t in tables])
+                     for a in ['exon_starts', 'exon_ends', 'exon_frames']],
+                   trailing_comma=tables[0].trailing_comma)
+
+    @classmethod
+    def from_refgene(cls, fileobj):
+        '''
+        Read a UCSC refGene table from a path or an open file (text or binary), skipping the header
+        (which starts with #bin) if present. The file is parsed CHUNK_ROWS lines at a time.
+
+        The table is available from the UCSC Genome Browser website:
+        http://hgdownload.soe.ucsc.edu/goldenPath/hg19/database/refGene.txt.gz
+        '''
+        return cls._read_chunks(fileobj, cls._build_refgene)
+
+    @classmethod
+    def _build_refgene(cls, lines):
+        records = {f: [] for f in cls.FIELDS}
+        columns = [records[f] for f in cls.FIELDS]
+        for fields in lines:
+            if len(fields) < len(cls.FIELDS):
+                raise ValueError('Expected {} refGene fields, found {}'.format(len(cls.FIELDS), len(fields)))
+            for column, value in zip(columns, fields):
+                column.append(value)
+        exon_columns = {f: records.pop(f) for f in cls.LIST_FIELDS}
+        trailing_comma = any(v.endswith(',') for v in exon_columns['exonStarts'][:1])
+        return cls._build(records, exon_columns, trailing_comma)
+
+    @classmethod
+    def from_bed(cls, fileobj):
+        '''
+        Read refGene data in BED format from a path or an open file: chrom|txStart|txEnd|name2|name,
+        optionally followed by strand and exonCount, with exonStarts and exonEnds in the 8th and 9th
+        columns. Fields that are not present in the BED file are left empty.
+        '''
+        return cls._read_chunks(fileobj, cls._build_bed)
+
+    @classmethod
+    def _build_bed(cls, lines):
+        records = {f: [] for f in cls.FIELDS}
+        exon_columns = {f: [] for f in cls.LIST_FIELDS}
+        for fields in lines:
+            records['chrom'].append(fields[0])
+            records['txStart'].append(fields[1])
+            records['txEnd'].append(fields[2])
+            records['name2'].append(fields[3] if len(fields) > 3 else '')
+            records['name'].append(fields[4] if len(fields) > 4 else '')
+            records['strand'].append(fields[5] if len(fields) > 5 and fields[5] in ('+', '-') else '.')
+            starts, ends = (fields[7], fields[8]) if len(fields) > 8 else ('', '')
+            count = _count_list(starts)
+            records['exonCount'].append(count)
+            exon_columns['exonStarts'].append(starts)
+            exon_columns['exonEnds'].append(ends)
+            exon_columns['exonFrames'].append(','.join(['-1'] * count))
+        n = len(records['chrom'])
+        for field in ['bin', 'score']:
+            records[field] = [0] * n
+        records['cdsStart'], records['cdsEnd'] = records['txStart'], records['txEnd']
+        records['cdsStartStat'] = records['cdsEndStat'] = [''] * n
+        trailing_comma = any(v.endswith(',') for v in exon_columns['exonStarts'][:1])
+        return cls._build(records, exon_columns, trailing_comma)
+
+    @classmethod
+    def read(cls, path, format='refgene', regions=None):
+        '''
+        Read a refGene table (``format='refgene'``) or refGene BED file (``format='bed'``) from `path`.
+
+        The parsed table is kept in the on-disk cache (see ``ngs_capture_qc.cache``), so later reads
+        of the same file are memory-mapped from the cache instead of parsed again.
+
+        With a list of `regions` (see ``ngs_capture_qc.regions``) only the rows overlapping them are
+        returned; BGZF-compressed files are then read through their index rather than parsed in full.
+        '''
+        parse = {'refgene': cls.from_refgene, 'bed': cls.from_bed}[format]
+        if regions is not None:
+            from ngs_capture_qc.regions import fetch, overlapping
+            if isinstance(path, str) and os.path.isfile(path) and bgzf.is_bgzf(path):
+                return parse(fetch(path, regions, format))
+            table = cls.read(path, format)
+            return table.take(overlapping(table.chrom, table['txStart'], table['txEnd'], regions))
+        if not isinstance(path, str) or not os.path.isfile(path) or not cache.enabled():
+            return parse(path)
+
+        kind = '{}-v{}'.format('refgene_table' if format == 'refgene' else 'refgene_bed', TABLE_VERSION)
+        entry = cache.lookup(path, kind)
+        if entry is not None:
+            try:
+                return cls.load(entry)
+            except (IOError, ValueError, KeyError) as err:
+                log.warning('Ignoring unreadable cache entry {}: {}'.format(entry, err))
+        table = parse(path)
+        cache.store(path, kind, table.save)
+        return table
+
+    def _arrays(self):
+        arrays = dict(('column_' + f, c) for f, c in self.columns.items())
+        arrays.update(chrom_names=self.chrom_names, chrom_codes=self.chrom_codes,
+                      exon_offsets=self.exon_offsets, exon_starts=self.exon_starts,
+                      exon_ends=self.exon_ends, exon_frames=self.exon_frames)
+        return arrays
+
+    @classmethod
+    def _from_arrays(cls, arrays, meta):
+        return cls(dict((f, arrays['column_' + f]) for f in meta['columns']),
+                   arrays['chrom_names'], arrays['chrom_codes'], arrays['exon_offsets'],
+                   arrays['exon_starts'], arrays['exon_ends'], arrays['exon_frames'],
+                   meta['trailing_comma'])
+
+    def _meta(self):
+        return {'columns': list(self.columns), 'trailing_comma': self.trailing_comma}
+
+    def save(self, dirpath):
+        '''Write the table to `dirpath` as one .npy file per column'''
+        for name, array in self._arrays().items():
+            np.save(os.path.join(dirpath, name + '.npy'), array, allow_pickle=False)
+        with open(os.path.join(dirpath, 'table.json'), 'w') as f:
+            json.dump(self._meta(), f)
+
+    @classmethod
+    def load(cls, dirpath, mmap_mode='r'):
+        '''Load a table written by ``save``, memory-mapping the columns by default'''
+        with open(os.path.join(dirpath, 'table.json')) as f:
+            meta = json.load(f)
+        arrays = {}
+        for name in os.listdir(dirpath):
+            if name.endswith('.npy'):
+                # plain ndarray views of the memory map index much faster than np.memmap
+                arrays[name[:-4]] = np.asarray(np.load(os.path.join(dirpath, name), mmap_mode=mmap_mode,
+                                                       allow_pickle=False))
+        return cls._from_arrays(arrays, meta)
+
+    def share(self):
+        '''
+        Copy the table into shared memory, so that worker processes can use it without pickling.
+
+        Returns a picklable spec to pass to ``attach`` in the workers, and the list of
+        ``SharedMemory`` blocks, which the caller must ``close`` and ``unlink`` when done.
+        '''
+        spec, blocks = {'meta': self._meta(), 'arrays': {}}, []
+        for name, array in self._arrays().items():
+            block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+            blocks.append(block)
+            np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)[...] = array
+            spec['arrays'][name] = (block.name, array.dtype.str, array.shape)
+        return spec, blocks
+
+    @classmethod
+    def attach(cls, spec):
+        '''Return a table backed by the shared memory described by `spec` (see ``share``)'''
+        arrays, blocks = {}, []
+        for name, (block_name, dtype, shape) in spec['arrays'].items():
+            block = _attach_shared_memory(block_name)
+            blocks.append(block)
+            arrays[name] = np.ndarray(shape, dtype=np.dtype(dtype), buffer=block.buf)
+        table = cls._from_arrays(arrays, spec['meta'])
+        # keep the blocks open for as long as the table is in use
+        table.shared_blocks = blocks
+        return table
+
+    def exons(self, i):
+        '''Return arrays of the exon starts and ends of row `i`'''
+        first, last = self.exon_offsets[i], self.exon_offsets[i + 1]
+        return self.exon_starts[first:last], self.exon_ends[first:last]
+
+    def take(self, indices):
+        '''Return a new table with the rows at `indices` (an integer array or boolean mask), in that order'''
+        indices = np.arange(len(self))[indices]
+        counts = self.columns['exonCount'][indices].astype(np.int64)
+        offsets = np.zeros(len(indices) + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+        flat = np.repeat(self.exon_offsets[indices] - offsets[:-1], counts) + np.arange(offsets[-1])
+        return RefGeneTable({f: c[indices] for f, c in self.columns.items()},
+                            self.chrom_names, self.chrom_codes[indices], offsets,
+                            self.exon_starts[flat], self.exon_ends[flat], self.exon_frames[flat],
+                            self.trailing_comma)
+
+    def in_chromosomes(self):
+        '''Boolean mask of the rows on chromosomes listed in ``chromosomes``'''
+        known = np.array([c in chromosomes for c in self.chrom_names], dtype=bool)
+        return known[self.chrom_codes]
+
+    def _format_list(self, values):
+        text = ','.join(map(str, values))
+        return text + ',' if self.trailing_comma and text else text
+
+    def row(self, i, fieldnames=None):
+        '''Return row `i` as a dict of strings formatted as in the UCSC table, keyed by `fieldnames`
+        (by default ``UCSCTable.REF_GENE_FIELDS``; other names are matched to fields by position).'''
+        return next(self.rows([i], fieldnames))
+
+    def rows(self, indices=None, fieldnames=None):
+        '''Iterate over rows (all rows, or those at `indices`) as dicts; see ``row``'''
+        table = self if indices is None else self.take(indices)
+        columns = [table.chrom if f == 'chrom' else table.columns.get(f) for f in self.FIELDS]
+        columns = [c.astype(str).tolist() if c is not None else None for c in columns]
+        lists = {self.FIELDS.index(f): getattr(table, a).tolist() for f, a in self.LIST_FIELDS.items()}
+        offsets = table.exon_offsets.tolist()
+        for i in range(len(table)):
+            values = [c[i] if c is not None else None for c in columns]
+            for position, flat in lists.items():
+                values[position] = self._format_list(flat[offsets[i]:offsets[i + 1]])
+            yield dict(zip(fieldnames or self.FIELDS, values))
+
 class IntervalMakers(object):
     '''A container class for interval-making functions, used in GenomeIntervalTree.from_table and GenomeIntervalTree.from_bed.'''
 
@@ -137,31 +539,69 @@ class IntervalMakers(object):
 
     @staticmethod
     def EXONS(d):
-        exStarts = d['exonStarts'].split(b',')
-        exEnds = d['exonEnds'].split(b',')
+        sep = b',' if isinstance(d['exonStarts'], bytes) else ','
+        exStarts = d['exonStarts'].split(sep)
+        exEnds = d['exonEnds'].split(sep)
         intron_count=int(d['exonCount'])-1
         exon_count=int(d['exonCount'])
         strand = d['strand']
         for i in range(exon_count):
-            exon_d = d.copy()
             if strand == '+':
-                exon_d['exonNum']=str(i+1)
+                exon_num = i+1
             elif strand == '-':
-                exon_d['exonNum']=str(exon_count-i)
+                exon_num = exon_count-i
+            else:
+                exon_num = None
             #Since interval trees are not inclusive of upper limit, add one to the exon end boundary
-            yield Interval(int(exStarts[i]), int(exEnds[i])+1, exon_d)
+            yield Interval(int(exStarts[i]), int(exEnds[i])+1, Feature(d, 'exon', exon_num))
 
             #Setup the intron info
             if i < intron_count:
             #Since interval trees are not inclsive of upper limit, add one to the intron start boundary and not to the end boundary
                 intron_start=int(exEnds[i])+1
                 intron_end=int(exStarts[i+1])
-                new_d=d.copy()
-                if new_d['strand']=='-':
-                    new_d['intronNum']=str(intron_count - i)
-                elif new_d['strand']=='+':
-                    new_d['intronNum']=str(i+1)
-                yield Interval(intron_start, intron_end, new_d)
+                if strand=='-':
+                    intron_num = intron_count - i
+                elif strand=='+':
+                    intron_num = i+1
+                else:
+                    intron_num = None
+                yield Interval(intron_start, intron_end, Feature(d, 'intron', intron_num))
+
+class Feature(Mapping):
+    '''
+    The data of an exon or intron interval made by ``IntervalMakers.EXONS``: the row of its
+    transcript, shared by all of the transcript's exons and introns rather than copied, the
+    kind of feature ('exon' or 'intron') and its number, counted from the 5' end. Reads as
+    the transcript row with an ``exonNum`` or ``intronNum`` field holding the number as a string.
+    '''
+    __slots__ = ('parent', 'kind', 'number')
+
+    def __init__(self, parent, kind, number):
+        self.parent = parent
+        self.kind = kind
+        self.number = number
+
+    def _field(self):
+        return 'exonNum' if self.kind == 'exon' else 'intronNum'
+
+    def __getitem__(self, key):
+        if key == self._field() and self.number is not None:
+            return str(self.number)
+        return self.parent[key]
+
+    def __iter__(self):
+        for key in self.parent:
+            if key != self._field():
+                yield key
+        if self.number is not None:
+            yield self._field()
+
+    def __len__(self):
+        return sum(1 for __ in self)
+
+    def __repr__(self):
+        return 'Feature({!r}, {!r}, {!r})'.format(self.parent.get('name'), self.kind, self.number)
 
 def _fix(interval):
     '''
@@ -176,6 +616,88 @@ def _fix(interval):
     else:
         return interval
 
+def _parse_lines(fileobj, parser):
+    '''Helper function for ``GenomeIntervalTree.from_table``, apply `parser` to each non-header line'''
+    for ln in fileobj:
+        if not isinstance(ln, bytes):
+           ln = ln.encode()
+        if ln.startswith(b'#'): #python2 needs:or ln.startswith('#'):
+            continue
+        yield parser(ln.strip())
+
+REFGENE_URL = 'http://hgdownload.soe.ucsc.edu/goldenPath/hg19/database/refGene.txt.gz'
+
+def _interval_maker(mode):
+    '''Helper function for ``from_table``, return the function making the intervals of a row in `mode`'''
+    if mode == 'tx':
+        return IntervalMakers.TX
+    elif mode == 'cds':
+        return IntervalMakers.CDS
+    elif mode == 'exons':
+        return IntervalMakers.EXONS
+    elif not callable(mode):
+        raise Exception("Parameter `mode` may only be 'tx', 'cds', 'exons' or a callable")
+    return mode
+
+def _read_table(fileobj, url, parser, decompress, regions, genes):
+    '''
+    Helper function for ``from_table``, read the table given by `fileobj` or `url`. With the default
+    parser, returns the ``RefGeneTable`` and None, otherwise None and an iterator over the parsed rows.
+    '''
+    fileobj, opened = open_table(url, decompress) if fileobj is None else (fileobj, False)
+
+    #Parse the genome data
+    if parser is UCSCTable.REF_GENE:
+        #Read refGene through the columnar table, row values are strings
+        try:
+            if not genes:
+                return RefGeneTable.read(fileobj, regions=regions), None
+            from ngs_capture_qc.regions import gene_regions, overlapping
+            table = RefGeneTable.read(fileobj)
+        finally:
+            if opened:
+                fileobj.close()
+        regions = list(regions or []) + gene_regions(table, genes)
+        return table.take(overlapping(table.chrom, table['txStart'], table['txEnd'], regions)), None
+    elif genes:
+        raise ValueError('Parameter `genes` is only supported with the default parser')
+    if isinstance(fileobj, str):
+        fileobj, opened = Opener()(fileobj), True
+    rows = _parse_lines(_closing_lines(fileobj) if opened else fileobj, parser)
+    if regions is not None:
+        rows = (d for d in rows if any(r.overlaps(d['chrom'], int(d['txStart']), int(d['txEnd']))
+                                       for r in regions))
+    return None, rows
+
+def _closing_lines(fileobj):
+    with fileobj:
+        for ln in fileobj:
+            yield ln
+
+def open_table(url, decompress=None):
+    '''
+    Return a local path or an open binary file for the table at `url`, and whether a file was opened.
+    Local paths and ``file://`` URLs are returned as paths. Other URLs are fetched into the on-disk cache
+    (see ``ngs_capture_qc.cache.fetch``) and the cached copy returned, or, with the cache disabled,
+    streamed. Data is decompressed if `decompress` is true, or if it is None and `url` ends with .gz.
+    '''
+    parts = urlsplit(url)
+    if parts.scheme == 'file':
+        from urllib.request import url2pathname
+        url = url2pathname(parts.path)
+    elif len(parts.scheme) > 1:
+        path = cache.fetch(url) if cache.enabled() else None
+        if path is None:
+            from urllib.request import urlopen
+            stream = urlopen(url)
+            if decompress or (decompress is None and url.endswith('.gz')):
+                stream = gzip.GzipFile(fileobj=stream)
+            return stream, True
+        url = path
+    if decompress is None or decompress == url.endswith('.gz'):
+        return url, False
+    return (gzip.open(url) if decompress else open(url, 'rb')), True
+
 class GenomeIntervalTree(defaultdict):
     '''
     The data structure maintains a set of IntervalTrees, one for each chromosome.
@@ -192,8 +714,8 @@ class GenomeIntervalTree(defaultdict):
         return sum([len(tree) for tree in self.values()])
 
     @staticmethod
-    def from_table(fileobj=None, url='http://hgdownload.soe.ucsc.edu/goldenPath/hg19/database/refGene.txt.gz',
-                    parser=UCSCTable.REF_GENE, mode='tx', decompress=None):
+    def from_table(fileobj=None, url=REFGENE_URL,
+                    parser=UCSCTable.REF_GENE, mode='tx', decompress=None, regions=None, genes=None):
         '''
         Index the rows of UCSC tables into a ``GenomeIntervalTree`` 
 
@@ -206,7 +728,8 @@ class GenomeIntervalTree(defaultdict):
         Finally, there are different ways genes can be mapped into intervals for the sake of indexing as an interval tree.
         One way is to represent each gene via its transcribed region (``txStart``..``txEnd``). Another is to represent using
         coding region (``cdsStart``..``cdsEnd``). Finally, the third possibility is to map each gene into several intervals,
-        corresponding to its exons (``exonStarts``..``exonEnds``).
+        corresponding to its exons (``exonStarts``..``exonEnds``), and its introns between them. The data of these
+        intervals is a ``Feature``, which reads as the row with its ``exonNum`` or ``intronNum`` without copying it.
 
         The mode, in which genes are mapped to intervals is specified via the ``mode`` parameter. The value can be ``tx``, ``cds`` and
         ``exons``, corresponding to the three mentioned possibilities.
@@ -218,36 +741,23 @@ class GenomeIntervalTree(defaultdict):
         This only applies to the situation when the url is given (no decompression is made if fileobj is provided in any case).
         If decompress is None, data is decompressed if the url ends with .gz, otherwise decompress = True forces decompression.
 
-        '''
-        #Read in data from URL if file not provided
-        if fileobj is None:
-            data = urlopen(url).read()
-            if (decompress is None and url.endswith('.gz')) or decompress:
-                data = zlib.decompress(data, 16+zlib.MAX_WBITS)
-            fileobj = BytesIO(data)
+        Other than local paths and ``file://`` URLs, tables are downloaded once into the on-disk cache (or copied from
+        the CAPQC_MIRROR directory) and read from there; see ``open_table``.
 
-        interval_lists = defaultdict(list)
+        ``fileobj`` (or ``url``) may also be the path to a local refGene file. With the default parser, such files
+        are read with ``RefGeneTable.read``, which loads previously parsed files from the on-disk cache.
 
-        #Setup the interval type
-        if mode == 'tx':
-            interval_maker = IntervalMakers.TX
-        elif mode == 'cds':
-            interval_maker = IntervalMakers.CDS
-        elif mode == 'exons':
-            interval_maker = IntervalMakers.EXONS
-        elif getattr(mode, __call__, None) is None:
-            raise Exception("Parameter `mode` may only be 'tx', 'cds', 'exons' or a callable")
-        else:
-            interval_maker = mode
+        Only rows overlapping ``regions``, a list of ``ngs_capture_qc.regions.Region``, or the transcribed
+        regions of the named ``genes`` (default parser only) are indexed. BGZF-compressed local files are
+        then read through their region index, decompressing only the blocks holding those rows.
 
-        #Parse the genome data
-        for ln in fileobj:
-            if not isinstance(ln, bytes):
-               ln = ln.encode()
-            if ln.startswith(b'#'): #python2 needs:or ln.startswith('#'):
-                continue
-            ln = ln.strip()
-            d = parser(ln)
+        '''
+        interval_maker = _interval_maker(mode)
+        table, rows = _read_table(fileobj, url, parser, decompress, regions, genes)
+        if table is not None:
+            rows = table.rows()
+        interval_lists = defaultdict(list)
+        for d in rows:
             for interval in interval_maker(d):
                 interval_lists[d['chrom']].append(_fix(interval))
                 
@@ -261,3 +771,176 @@ class GenomeIntervalTree(defaultdict):
         t = defaultdict.__reduce__(self)
         return (t[0], ()) + t[2:]
 
+class _TableData(object):
+    '''
+    The data of intervals made from rows of a ``RefGeneTable``: the row as a dict, or for exons and
+    introns (`kinds` 0 and 1) a ``Feature`` of it, made when asked for.
+    '''
+    def __init__(self, table, rows, kinds=None, numbers=None):
+        self.table = table
+        self.rows = rows
+        self.kinds = kinds
+        self.numbers = numbers
+        self._dicts = {}
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __getitem__(self, i):
+        row = int(self.rows[i])
+        d = self._dicts.get(row)
+        if d is None:
+            d = self._dicts[row] = self.table.row(row)
+        if self.kinds is None:
+            return d
+        number = int(self.numbers[i])
+        return Feature(d, 'intron' if self.kinds[i] else 'exon', number if number > 0 else None)
+
+class GenomeIntervalArray(object):
+    '''
+    An array-backed alternative to ``GenomeIntervalTree``, with the same ``addi`` and ``from_table``.
+
+    Each chromosome's intervals are kept as NumPy arrays, indexed with an ``intervals.IntervalIndex``
+    when first queried, and queried in batches with ``overlap_many``, which returns pairs of indices.
+    Intervals are numbered in the order they were added; ``interval`` returns one as an ``Interval``
+    with its data, which for tables is only made when asked for.
+    '''
+    def __init__(self):
+        self._ids = defaultdict(list)
+        self._indexes = {}
+        self._begins = np.zeros(0, dtype=np.int64)
+        self._ends = np.zeros(0, dtype=np.int64)
+        self._pending = []
+        self._firsts = []
+        self._data = []
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def keys(self):
+        return list(self._ids)
+
+    def _add(self, chroms, begins, ends, data):
+        '''
+        Add intervals, with a sequence of their data, on the chromosome named `chroms` or, if it is
+        a tuple (names, codes), on the chromosome ``names[code]`` of each interval
+        '''
+        begins = np.asarray(begins, dtype=np.int64)
+        ends = np.asarray(ends, dtype=np.int64)
+        # as _fix, intervals with begin >= end become [begin, begin+1)
+        ends = np.where(begins >= ends, begins + 1, ends)
+        ids = np.arange(self._size, self._size + len(begins))
+        if isinstance(chroms, tuple):
+            names, codes = chroms
+            order = np.argsort(codes, kind='stable')
+            bounds = np.searchsorted(codes[order], np.arange(len(names) + 1))
+            groups = [(names[i], ids[order[bounds[i]:bounds[i + 1]]]) for i in range(len(names))]
+        else:
+            groups = [(chroms, ids)]
+        for chrom, chrom_ids in groups:
+            if len(chrom_ids):
+                self._ids[str(chrom)].append(chrom_ids)
+                self._indexes.pop(str(chrom), None)
+        self._pending.append((begins, ends))
+        if isinstance(data, list) and self._data and isinstance(self._data[-1], list):
+            self._data[-1].extend(data)
+        else:
+            self._firsts.append(self._size)
+            self._data.append(data)
+        self._size += len(begins)
+
+    def addi(self, chrom, begin, end, data=None):
+        self._add(chrom, [begin], [end], [data])
+
+    def _flush(self):
+        if self._pending:
+            self._begins = np.concatenate([self._begins] + [b for b, __ in self._pending])
+            self._ends = np.concatenate([self._ends] + [e for __, e in self._pending])
+            self._pending = []
+
+    def _index(self, chrom):
+        index = self._indexes.get(chrom)
+        if index is None and chrom in self._ids:
+            from ngs_capture_qc.intervals import IntervalIndex
+            self._flush()
+            ids = np.concatenate(self._ids[chrom])
+            self._ids[chrom] = [ids]
+            index = self._indexes[chrom] = (ids, IntervalIndex(self._begins[ids], self._ends[ids]))
+        return index
+
+    def overlap_many(self, chrom, starts, ends):
+        '''
+        Find the intervals on `chrom` overlapping each of the half-open query intervals given by the
+        arrays `starts` and `ends`. Returns (query_index, interval_index) arrays, ordered by query and
+        then by interval start; see ``interval``.
+        '''
+        index = self._index(chrom)
+        if index is None:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        ids, intervals = index
+        query, position = intervals.overlaps(starts, ends)
+        return query, ids[position]
+
+    def overlap(self, chrom, begin, end):
+        '''Return the list of ``Interval`` on `chrom` overlapping [begin, end), ordered by start'''
+        return [self.interval(i) for i in self.overlap_many(chrom, [begin], [end])[1].tolist()]
+
+    def data(self, i):
+        '''Return the data of interval `i`'''
+        chunk = bisect_right(self._firsts, i) - 1
+        return self._data[chunk][i - self._firsts[chunk]]
+
+    def interval(self, i):
+        '''Return interval `i` as an ``Interval``'''
+        self._flush()
+        return Interval(int(self._begins[i]), int(self._ends[i]), self.data(i))
+
+    @staticmethod
+    def from_table(fileobj=None, url=REFGENE_URL, parser=UCSCTable.REF_GENE, mode='tx', decompress=None,
+                   regions=None, genes=None):
+        '''
+        Index the rows of UCSC tables; the arguments are those of ``GenomeIntervalTree.from_table``.
+        With the default parser and `mode` 'tx', 'cds' or 'exons', the intervals are made from the
+        columns of the ``RefGeneTable`` at once, without a dict per row.
+        '''
+        interval_maker = _interval_maker(mode)
+        table, rows = _read_table(fileobj, url, parser, decompress, regions, genes)
+        garray = GenomeIntervalArray()
+        if table is None or not isinstance(mode, str):
+            for d in rows if table is None else table.rows():
+                for interval in interval_maker(d):
+                    interval = _fix(interval)
+                    garray.addi(d['chrom'], interval.begin, interval.end, interval.data)
+            return garray
+
+        if mode != 'exons':
+            begin, end = ('txStart', 'txEnd') if mode == 'tx' else ('cdsStart', 'cdsEnd')
+            garray._add((table.chrom_names, table.chrom_codes), table[begin], table[end],
+                        _TableData(table, np.arange(len(table))))
+            return garray
+
+        counts = table['exonCount'].astype(np.int64)
+        offsets = np.asarray(table.exon_offsets, dtype=np.int64)
+        rows = np.repeat(np.arange(len(table)), counts)
+        local = np.arange(len(rows)) - offsets[:-1][rows]
+        strands = table['strand'][rows]
+        plus, minus = strands == '+', strands == '-'
+        exon_starts = np.asarray(table.exon_starts, dtype=np.int64)
+        exon_ends = np.asarray(table.exon_ends, dtype=np.int64)
+        # introns follow every exon but the last of each row
+        intron = np.flatnonzero(local < counts[rows] - 1)
+        # numbered from the 5' end, 0 without a strand
+        exon_numbers = np.where(plus, local + 1, np.where(minus, counts[rows] - local, 0))
+        intron_numbers = np.where(plus[intron], local[intron] + 1,
+                                  np.where(minus[intron], counts[rows[intron]] - 1 - local[intron], 0))
+        #Since interval trees are not inclusive of upper limit, add one to exon ends and intron starts
+        begins = np.concatenate((exon_starts, exon_ends[intron] + 1))
+        ends = np.concatenate((exon_ends + 1, exon_starts[intron + 1]))
+        all_rows = np.concatenate((rows, rows[intron]))
+        kinds = np.concatenate((np.zeros(len(rows), dtype=np.int8), np.ones(len(intron), dtype=np.int8)))
+        numbers = np.concatenate((exon_numbers, intron_numbers))
+        garray._add((table.chrom_names, table.chrom_codes[all_rows]), begins, ends,
+                    _TableData(table, all_rows, kinds, numbers))
+        return garray
+
@@ -30,6 +30,9 @@ outputdir = 'test_output'
 
 mkdir(outputdir)
 
+# keep parsed-file caches out of the user's cache directory
+os.environ['CAPQC_CACHE_DIR'] = path.abspath(path.join(outputdir, 'cache'))
+
 
 def get_testfile(fn):
     pth = path.join(datadir, fn)
@@ -7,6 +7,7 @@ import filecmp
 import logging
 import os
 import pandas as pd
+from argparse import Namespace
 from ngs_capture_qc.subcommands import create_files
 from ngs_capture_qc.utils import check_probe_format
 from __init__ import TestBase
@@ -96,6 +97,14 @@ class TestCreateFiles(TestBase):
         create_files.write_merged_bed(self.probes_temp, self.bedtools, testing_output)
         self.assertTrue(filecmp.cmp(expected_output, testing_output))
 
+    def testMergeProbes(self):
+        """Test in-process merge matches bedtools merge output"""
+        expected_output=os.path.join(testfiles, 'expected-TEMP.bed')
+        testing_output=os.path.join(self.outdir,'testoutput.bed')
+        merged=create_files.merge_probes(self.probes_df)
+        merged.to_csv(testing_output, header=False, sep='\t', index=False)
+        self.assertTrue(filecmp.cmp(expected_output, testing_output))
+
         
     def testWriteAnnotatedBed(self):
         #Write merged, annotated bed file
@@ -105,7 +114,54 @@ class TestCreateFiles(TestBase):
         create_files.write_annotated_bed(input_bed, self.bedtools, self.refgene_bed, anno_bed)
         self.assertTrue(filecmp.cmp(expected_output, anno_bed))
 
+    def testAnnotateMerged(self):
+        """Test in-process annotation matches bedtools intersect -loj output"""
+        expected_output=os.path.join(testfiles,'expected-ANNO.bed')
+        merged=pd.read_csv(os.path.join(testfiles, 'expected-TEMP.bed'), sep='\t', header=None,
+                           names=['chrom','start','stop'], dtype={'chrom': str})
+        anno_bed=os.path.join(self.outdir,'testoutput.anno.bed')
+        annotated=create_files.annotate_merged(merged, self.refgene_bed)
+        annotated.to_csv(anno_bed, header=None, index=False, sep='\t')
+        self.assertTrue(filecmp.cmp(expected_output, anno_bed))
+
+    def testAnnotateProbesJobs(self):
+        """Test merging and annotating chromosomes in parallel matches the serial output"""
+        expected_output=os.path.join(testfiles,'expected-ANNO.bed')
+        anno_bed=os.path.join(self.outdir,'testoutput.anno.bed')
+        annotated=create_files.annotate_probes(self.probes_df, self.refgene_bed, jobs=2)
+        annotated.to_csv(anno_bed, header=None, index=False, sep='\t')
+        self.assertTrue(filecmp.cmp(expected_output, anno_bed))
+
+    def testAnnotateProbesCached(self):
+        """Test reusing the cached annotation of unchanged chromosomes"""
+        expected = create_files.annotate_probes(self.probes_df, self.refgene_bed)
+        for i in range(2):
+            cached = create_files.annotate_probes(self.probes_df, self.refgene_bed, cached=True)
+            self.assertEqual(expected.values.tolist(), cached.values.tolist())
+        #Move one probe, so only its chromosome is annotated again
+        probes = self.probes_df.copy()
+        probes.loc[probes.index[0], 'stop'] += 1000
+        self.assertEqual(create_files.annotate_probes(probes, self.refgene_bed).values.tolist(),
+                         create_files.annotate_probes(probes, self.refgene_bed, cached=True).values.tolist())
+
         
+    def testRegionEdge(self):
+        """A merged probe crossing the edge of a region keeps the genes outside it"""
+        probefile = os.path.join(self.outdir, 'edge.probes')
+        refgene = os.path.join(self.outdir, 'edge.refGene.bed')
+        with open(probefile, 'w') as f:
+            f.write('1\t1500\t2800\tp1\t+\n1\t2700\t3000\tp2\t+\n')
+        with open(refgene, 'w') as f:
+            for gene, name, start, end in [('GENEA', 'NM_1', 1000, 2000), ('GENEB', 'NM_2', 2500, 4000)]:
+                f.write('1\t{0}\t{1}\t{2}\t{3}\t1\t{4}\t{0}\t{1}\n'.format(start, end, gene, name, end - start))
+
+        # only the probes overlapping the region are merged, but all of the genes under them are kept
+        for region, expected in [(None, '1\t1500\t3000\tGENEA;GENEB'), (['1:1001-2000'], '1\t1500\t2800\tGENEA;GENEB')]:
+            create_files.action(Namespace(probefile=probefile, refgene_bed=refgene, bedtools='', outdir=self.outdir,
+                                          engine='native', jobs=1, region=region, region_genes=None))
+            with open(os.path.join(self.outdir, 'edge.anno.bed')) as f:
+                self.assertEqual([expected], f.read().splitlines())
+
     def testCreateFiles(self):
         #Test running of whole script
         cmd=["/mnt/disk10/users/sheenams/ngs_capture_qc/capqc", "create_files", self.probe_file,  self.refgene_bed,self.bedtools_image, self.outdir]
@@ -3,6 +3,7 @@ Test the filter_refgene script
 """
 
 import subprocess
+from argparse import Namespace
 import filecmp
 import logging
 import os
@@ -40,6 +41,33 @@ class TestFilterRefGene(TestBase):
         #Overlap in second list, returns overlap
         self.assertRaises(ValueError, filter_refgene.check_overlapping, feature2)
 
+    def testFindOverlapping(self):
+        """Every overlapping pair is reported, not only neighbours"""
+        features=[('STAT6', 57489186, 57505196), ('NAB2', 57482676, 57489259), ('LRP1', 57522276, 57607134),
+                  ('TSPAN31', 57504000, 57522276)]
+        self.assertListEqual([(('NAB2', 57482676, 57489259), ('STAT6', 57489186, 57505196)),
+                              (('STAT6', 57489186, 57505196), ('TSPAN31', 57504000, 57522276)),
+                              (('TSPAN31', 57504000, 57522276), ('LRP1', 57522276, 57607134))],
+                             filter_refgene.find_overlapping(features))
+
+    def testInterleavedGenes(self):
+        """A gene's transcripts are grouped together with another gene between them"""
+        refgene = os.path.join(self.outdir, 'interleaved.refGene')
+        genes = os.path.join(self.outdir, 'genes')
+        outfile = os.path.join(self.outdir, 'filtered.refGene')
+        template = '0\t{}\t14\t+\t{}\t{}\t{}\t{}\t1\t{},\t{},\t0\t{}\tcmpl\tcmpl\t0,\n'
+        with open(refgene, 'w') as f:
+            for name, gene, start, end in [('NM_1', 'GENEA', 1000, 2000), ('NM_3', 'GENEB', 3000, 4000),
+                                           ('NM_2', 'GENEA', 5000, 6000)]:
+                f.write(template.format(name, start, end, start, end, start, end, gene))
+        with open(genes, 'w') as f:
+            f.write('Gene\tRefSeq\nGENEA\tNM_2.1\nGENEB\tNM_3\n')
+
+        filter_refgene.action(Namespace(refgene=refgene, genes=genes, outfile=outfile, conflicts=None))
+        with open(outfile) as f:
+            rows = [line.split('\t') for line in f]
+        self.assertEqual([('NM_3', 'GENEB'), ('NM_2', 'GENEA')], [(r[1], r[12]) for r in rows])
+
     def testFilterRefGene(self):
         refgene=os.path.join(config.datadir, 'test.refGene')
         genes=os.path.join(config.datadir, 'test.genes_for_filter')
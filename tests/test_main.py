@@ -0,0 +1,83 @@
+"""
+Test the capqc script startup and global options
+"""
+
+import json
+import logging
+import os
+import subprocess
+import sys
+
+from ngs_capture_qc.scripts.main import main
+
+from __init__ import TestBase
+import __init__ as config
+
+log = logging.getLogger(__name__)
+
+HEAVY = ['pandas', 'numpy', 'natsort', 'intervaltree', 'xlsxwriter']
+
+SCRIPT = """
+import sys, json
+from ngs_capture_qc.scripts.main import parse_arguments
+try:
+    parse_arguments(sys.argv[1:])
+except SystemExit:
+    pass
+print(json.dumps(sorted(m for m in sys.modules if m.startswith(('ngs_capture_qc.subcommands.',) + tuple(%r)))))
+""" % (HEAVY,)
+
+
+class TestStartup(TestBase):
+    """
+    Only the selected subcommand, and its dependencies, are imported
+    """
+
+    def imported(self, argv):
+        output = subprocess.check_output([sys.executable, '-c', SCRIPT] + argv)
+        return set(m.split('.')[0] if not m.startswith('ngs_capture_qc') else m
+                   for m in json.loads(output.decode().splitlines()[-1]))
+
+    def testHelp(self):
+        self.assertEqual(set(), self.imported(['-h']))
+
+    def testSubcommandHelp(self):
+        self.assertEqual({'ngs_capture_qc.subcommands.cache'}, self.imported(['help', 'cache']))
+
+    def testSelectedSubcommand(self):
+        imported = self.imported(['-v', 'xlsxmaker', '-o', 'out.xlsx', 'infile'])
+        self.assertEqual({'ngs_capture_qc.subcommands.xlsxmaker', 'xlsxwriter'}, imported)
+
+    def testClient(self):
+        self.assertEqual({'ngs_capture_qc.subcommands.client'},
+                         self.imported(['client', 'coverage', 'assay.bed', 'EGFR']))
+
+
+class TestMetrics(TestBase):
+    """
+    --metrics and --profile record each stage of a subcommand
+    """
+
+    def setUp(self):
+        self.outdir = self.mkoutdir()
+        self.refgene = os.path.join(config.datadir, 'test.refGene')
+
+    def testMetrics(self):
+        metrics_file = os.path.join(self.outdir, 'metrics.json')
+        main(['--metrics', metrics_file, 'refgene_to_bed', self.refgene, os.path.join(self.outdir, 'refgene.bed')])
+        with open(metrics_file) as f:
+            report = json.load(f)
+        self.assertEqual('refgene_to_bed', report['command'])
+        stages = dict((s['stage'], s) for s in report['stages'])
+        self.assertListEqual(['read-refgene', 'write-outputs', 'refgene_to_bed'], [s['stage'] for s in report['stages']])
+        self.assertEqual(19, stages['read-refgene']['rows'])
+        for stage in report['stages']:
+            self.assertGreaterEqual(stage['wall_seconds'], 0)
+            self.assertIn('cpu_seconds', stage)
+            self.assertIn('peak_rss_mb', stage)
+
+    def testProfile(self):
+        profile = os.path.join(self.outdir, 'read.prof')
+        main(['--profile', 'read-refgene', '--profile-output', profile,
+              'parse_refgene_positions', self.refgene, os.path.join(self.outdir, 'positions.txt')])
+        self.assertTrue(os.path.getsize(profile) > 0)
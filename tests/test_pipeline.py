@@ -0,0 +1,80 @@
+"""
+Test running processes connected by pipes
+"""
+
+import logging
+import os
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from ngs_capture_qc.pipeline import Bedtools, Pipeline, bedtools_command, read_lines
+
+from __init__ import TestBase
+
+log = logging.getLogger(__name__)
+
+
+class TestPipeline(TestBase):
+    """
+    Test pipelines of processes, as used to run bedtools
+    """
+
+    def testBedtoolsCommand(self):
+        self.assertEqual(['singularity', 'exec', 'bedtools.img', 'bedtools', 'merge', '-i', 'stdin'],
+                         bedtools_command('singularity exec bedtools.img', 'merge', '-i', 'stdin'))
+
+    def testChained(self):
+        """Input is streamed through every process"""
+        lines = ['{}\t{}\n'.format(i % 7, i) for i in range(100000)]
+        with Pipeline([['sort', '-k1,1n'], ['cut', '-f1'], ['uniq', '-c']], input=lines) as pipeline:
+            counts = [line.split() for line in pipeline]
+        self.assertEqual([[str(len(range(i, 100000, 7))), str(i)] for i in range(7)], counts)
+
+    def testBedtoolsInstance(self):
+        """Commands for a singularity image run in one instance, started on the first command"""
+        outdir = self.mkoutdir()
+        calls = os.path.join(outdir, 'calls')
+        singularity = os.path.join(outdir, 'singularity')
+        with open(singularity, 'w') as f:
+            f.write('#!/bin/sh\necho "$@" >> {}\n'.format(calls))
+        os.chmod(singularity, 0o755)
+        path = os.environ['PATH']
+        os.environ['PATH'] = outdir + os.pathsep + path
+        try:
+            with Bedtools('bedtools.img') as bedtools:
+                commands = [bedtools_command(bedtools, 'merge', '-i', 'stdin'), bedtools.command('intersect')]
+                instance = bedtools.instance
+        finally:
+            os.environ['PATH'] = path
+        self.assertEqual(['singularity', 'exec', '--pwd', os.getcwd(), 'instance://' + instance, 'bedtools', 'intersect'],
+                         commands[1])
+        with open(calls) as f:
+            self.assertEqual(['instance start --bind {} bedtools.img {}'.format(os.getcwd(), instance),
+                              'instance stop {}'.format(instance)], f.read().splitlines())
+
+    def testBedtoolsPath(self):
+        """Without an image, or if no instance can be started, commands are run directly"""
+        self.assertEqual(['/opt/bin/bedtools', 'bedtools', 'sort'], Bedtools('/opt/bin/bedtools').command('sort'))
+        path = os.environ['PATH']
+        os.environ['PATH'] = self.mkoutdir()
+        try:
+            bedtools = Bedtools('bedtools.img')
+            self.assertEqual(['singularity', 'exec', '--bind', os.getcwd(), '--pwd', os.getcwd(), 'bedtools.img',
+                              'bedtools', 'sort'], bedtools.command('sort'))
+            self.assertIsNone(bedtools.instance)
+        finally:
+            os.environ['PATH'] = path
+
+    def testConcurrent(self):
+        """One pipeline is read on a thread while another is read"""
+        first = Pipeline([['seq', '1', '200000']])
+        second = Pipeline([['seq', '1', '100000']])
+        with ThreadPoolExecutor(1) as executor:
+            lines = read_lines(second, executor)
+            with first:
+                self.assertEqual(200000, sum(1 for __ in first))
+            self.assertEqual(100000, len(lines.result()))
+
+    def testFailure(self):
+        with self.assertRaises(subprocess.CalledProcessError):
+            with Pipeline([['seq', '1', '10'], ['false']]) as pipeline:
+                list(pipeline)
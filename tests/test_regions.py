@@ -0,0 +1,103 @@
+"""
+Test region queries and the BGZF region index
+"""
+
+import logging
+import os
+from unittest import mock
+from ngs_capture_qc import bgzf
+from ngs_capture_qc.regions import (Region, RegionIndex, cached_index_path, parse_region, fetch, index_path,
+                                   reg2bin, reg2bins)
+from ngs_capture_qc.utils import Opener, RefGeneTable, GenomeIntervalTree
+
+from __init__ import TestBase
+import __init__ as config
+
+log = logging.getLogger(__name__)
+
+
+class TestRegions(TestBase):
+    """
+    Test fetching the lines of bed and refGene files in a region
+    """
+
+    def setUp(self):
+        self.outdir = self.mkoutdir()
+        # unsorted, and enough lines for several BGZF blocks
+        self.lines = ['{}\t{}\t{}\tline {}\n'.format(i % 3 + 1, (i * 7919) % 5000000, (i * 7919) % 5000000 + 120, i)
+                      for i in range(20000)]
+        self.bed = os.path.join(self.outdir, 'test.bed.gz')
+        with Opener('w', bgzf=True)(self.bed) as f:
+            f.writelines(self.lines)
+
+    def expected(self, regions):
+        return [line for line in self.lines
+                if any(r.overlaps(*(line.split('\t')[0], int(line.split('\t')[1]), int(line.split('\t')[2])))
+                       for r in regions)]
+
+    def testParseRegion(self):
+        self.assertEqual(Region('chr7', 99, 200), parse_region('chr7:100-200'))
+        self.assertEqual(Region('7', 999, 2000), parse_region('7:1,000-2,000'))
+        self.assertEqual(Region('X', 0, None), parse_region('X'))
+        self.assertEqual('chr7:100-200', str(parse_region('chr7:100-200')))
+        for text in ['', ':1-2', '7:a-b', '7:0-10', '7:20-10']:
+            self.assertRaises(ValueError, parse_region, text)
+
+    def testBins(self):
+        """Bins match the binning scheme of the SAM specification"""
+        self.assertEqual(4681, reg2bin(0, 1))
+        self.assertEqual(585, reg2bin(0, 1 << 15))
+        self.assertEqual(0, reg2bin(0, 1 << 29))
+        self.assertIn(reg2bin(100000, 300000), reg2bins(250000, 250001))
+
+    def testFetch(self):
+        """BGZF files are read through an index, with the same lines as a scan of the file"""
+        plain = os.path.join(self.outdir, 'test.bed')
+        with open(plain, 'w') as f:
+            f.writelines(self.lines)
+        for regions in [[Region('2', 1000000, 1100000)], [Region('chr1', 0, 5000)],
+                        [Region('3', 0, None), Region('1', 4999000, 5000000)], [Region('4', 0, None)]]:
+            expected = self.expected(regions)
+            self.assertEqual(expected, fetch(self.bed, regions))
+            self.assertEqual(expected, fetch(plain, regions))
+        self.assertTrue(os.path.exists(index_path(self.bed)))
+        self.assertFalse(os.path.exists(index_path(plain)))
+
+    def testStaleIndex(self):
+        """The index is rebuilt when the file changes"""
+        regions = [Region('1', 0, 100000)]
+        fetch(self.bed, regions)
+        self.lines = self.lines[::-1]
+        with Opener('w', bgzf=True)(self.bed) as f:
+            f.writelines(self.lines)
+        self.assertEqual(self.expected(regions), fetch(self.bed, regions))
+        self.assertTrue(RegionIndex.load(index_path(self.bed)).is_current(self.bed, 'bed'))
+
+    def testReadOnlyDirectory(self):
+        """The index of a file in a directory that can't be written is kept in the cache directory"""
+        save = RegionIndex.save
+
+        def read_only(index, path):
+            if path == index_path(self.bed):
+                raise PermissionError(13, 'Permission denied', path)
+            save(index, path)
+        regions = [Region('2', 1000000, 1100000)]
+        with mock.patch.object(RegionIndex, 'save', read_only):
+            self.assertEqual(self.expected(regions), fetch(self.bed, regions))
+        self.assertFalse(os.path.exists(index_path(self.bed)))
+        self.assertTrue(RegionIndex.load(cached_index_path(self.bed)).is_current(self.bed, 'bed'))
+        with mock.patch.object(RegionIndex, 'build') as build:
+            self.assertEqual(self.expected(regions), fetch(self.bed, regions))
+        build.assert_not_called()
+
+    def testRefGene(self):
+        """Tables and interval trees are limited to the rows in the regions"""
+        refgene = os.path.join(self.outdir, 'test.refGene.gz')
+        with open(os.path.join(config.datadir, 'test.refGene')) as f, Opener('w', bgzf=True)(refgene) as out:
+            out.write(f.read())
+        self.assertTrue(bgzf.is_bgzf(refgene))
+        table = RefGeneTable.read(refgene, regions=[Region('chr1', 0, None)])
+        self.assertEqual({'1'}, set(table.chrom))
+        self.assertEqual(len(table), len(RefGeneTable.read(refgene).take(RefGeneTable.read(refgene).chrom == '1')))
+        tree = GenomeIntervalTree.from_table(refgene, genes=['FOXA1'])
+        self.assertEqual({'FOXA1'}, set(i.data['name2'] for t in tree.values() for i in t))
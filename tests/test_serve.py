@@ -0,0 +1,68 @@
+"""
+Test the summarize service and its client
+"""
+
+import logging
+import os
+import shutil
+import tempfile
+import threading
+
+from ngs_capture_qc.subcommands import client, serve
+
+from __init__ import TestBase
+import __init__ as config
+
+log = logging.getLogger(__name__)
+
+
+class TestServe(TestBase):
+    """
+    Queries to the service give the same results as summarize_assay
+    """
+
+    def setUp(self):
+        self.outdir = self.mkoutdir()
+        self.assay = os.path.join(config.datadir, 'expected-ANNO.bed')
+        self.genes = os.path.abspath(os.path.join(config.datadir, 'test.genes_for_summarize'))
+        # Unix socket paths are limited to about 100 characters
+        self.sockdir = tempfile.mkdtemp()
+        self.socket = os.path.join(self.sockdir, 'capqc.sock')
+        service = serve.Service(os.path.join(config.datadir, 'test.refGene.bed'))
+        self.server = serve.make_server(service, self.socket)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.sockdir)
+
+    def testSummarize(self):
+        """Concurrent requests return the summarize_assay output files"""
+        payload = {'bed': os.path.abspath(self.assay), 'genes': self.genes}
+        results = [None] * 4
+
+        def query(i):
+            results[i] = client.request('/summarize', payload, self.socket)
+        threads = [threading.Thread(target=query, args=(i, )) for i in range(len(results))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        for result in results:
+            for name, expected in [('overall_summary.txt', 'expected-overall_summary.txt'),
+                                   ('preferred_refgene_summary.txt', 'expected-pref_refgene_summary.txt'),
+                                   ('other_refgene_summary.txt', 'expected-other_refgene_summary.txt')]:
+                with open(os.path.join(config.datadir, expected), newline='') as f:
+                    self.assertEqual(f.read(), result['files'][name])
+        self.assertEqual([self.genes], client.request('/status', socket_path=self.socket)['preferred'])
+
+    def testCoverage(self):
+        """Per-gene coverage, and errors reported to the client"""
+        result = client.request('/coverage', {'bed': os.path.abspath(self.assay), 'genes': ['RPL10', 'FOXA1']},
+                                self.socket)
+        self.assertEqual(['FOXA1', 'NM_004496', 360, 5569, 0.065, 2, 2], result['rows'][0])
+        self.assertEqual(['RPL10', 'NM_006013', 480, 4275, 0.112, 2, 7], result['rows'][1])
+        with self.assertRaises(ValueError):
+            client.request('/coverage', {'bed': os.path.abspath(self.assay), 'genes': ['NOPE']}, self.socket)
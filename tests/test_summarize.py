@@ -4,10 +4,16 @@ Test the summarize_assay script
 
 import subprocess
 import filecmp
+import shutil
+import stat
+import sys
 import logging
 import os
 import pandas as pd
-from ngs_capture_qc.subcommands import summarize_assay
+from ngs_capture_qc import cache
+from ngs_capture_qc.subcommands import summarize_assay, summarize_batch
+from ngs_capture_qc.coverage import CoverageTrack
+from ngs_capture_qc.utils import RefGeneTable
 from ngs_capture_qc.utils import mkdir
 #from __init__ import TestCaseSuppressOutput, TestBase,
 #from __init__ import datadir as datadir
@@ -20,6 +26,21 @@ testfiles = 'testfiles'
 outputdir = 'test_output'
 mkdir(outputdir)
 
+FAKE_BEDTOOLS = """#!{}
+import sys
+command, mode, __, a, __, b = sys.argv[1:7]
+a = [line.rstrip('\\n').split('\\t') for line in (sys.stdin if a == 'stdin' else open(a))]
+b = [line.rstrip('\\n').split('\\t') for line in open(b)]
+for x in a:
+    hits = [(y, min(int(x[2]), int(y[2])) - max(int(x[1]), int(y[1]))) for y in b if x[0] == y[0]]
+    hits = [(y, overlap) for y, overlap in hits if overlap > 0]
+    if mode == '-wo':
+        for y, overlap in hits:
+            print('\\t'.join(x + y + [str(overlap)]))
+    elif not hits:
+        print('\\t'.join(x))
+"""
+
 class TestSummarizeAssay(unittest.TestCase): #TestBase):
     """
     Test the create files script, which writes files based on probes and 
@@ -45,6 +66,152 @@ class TestSummarizeAssay(unittest.TestCase): #TestBase):
         """Test calculation of probe coverage"""
         self.assertEqual(1504, summarize_assay.calculate_total_covered(self.assay))
 
+    def testOverlapsCountedOnce(self):
+        """Bases under overlapping probes and overlapping genes are counted once"""
+        assay = os.path.join(self.outdir, 'overlapping.bed')
+        with open(assay, 'w') as f:
+            f.write('1\t100\t200\n1\t150\t250\n1\t240\t300\nchr2\t0\t50\n')
+        self.assertEqual(250, summarize_assay.calculate_total_covered(assay))
+        # chr1 and 1 name the same chromosome
+        mixed = os.path.join(self.outdir, 'mixed.bed')
+        with open(assay) as f, open(mixed, 'w') as out:
+            out.write(f.read() + 'chr1\t120\t220\n2\t40\t60\n')
+        self.assertEqual(260, summarize_assay.calculate_total_covered(mixed))
+        probes = summarize_assay.read_assay(assay)[1:]
+        # genes 1:120-180 and 1:160-260 overlap, as do genes on chr2 and 2
+        spans = (['1', '1', '2', 'chr2'], [120, 160, 10, 20], [180, 260, 30, 60])
+        self.assertEqual(140 + 40, summarize_assay.calculate_coding_covered(probes, spans))
+
+        refgenes = {'NM_1': {'name': 'A', 'chromStart': 120, 'chromEnd': 260, 'bases_covered': 0,
+                             'exonTracker': summarize_assay.exonTracker([120, 200], [180, 260])}}
+        rows = (['1'], [120], [260], ['NM_1'])
+        summarize_assay.native_coverage(assay, refgenes, rows)
+        self.assertEqual(140, refgenes['NM_1']['bases_covered'])
+        self.assertEqual([60, 60], refgenes['NM_1']['exonTracker'].bases.tolist())
+
+    def testCoverageTrack(self):
+        """Test depth summaries of a run-length encoded probe track"""
+        track = CoverageTrack.from_intervals(['1', '1', '1', 'chr2'], [100, 150, 150, 0], [200, 250, 160, 10])
+        summary = track.summarize(['chr1', '1', '2', '3'], [90, 150, 5, 0], [160, 160, 15, 10], thresholds=(1, 3))
+        self.assertEqual([0, 3, 0, 0], summary['min'].tolist())
+        self.assertEqual([(50 + 3 * 10) / 70.0, 3, 0.5, 0], summary['mean'].tolist())
+        self.assertEqual([10 / 70.0, 1, 0, 0], summary[3].tolist())
+        interval, depth, bases = track.histogram(['1'], [90], [260])
+        self.assertEqual(([0, 1, 2, 3], [20, 100, 40, 10]), (depth.tolist(), bases.tolist()))
+
+    def testWriteDepth(self):
+        """Test writing the depth over every exon"""
+        table = RefGeneTable.read(os.path.join(testfiles, 'test.refGene.bed'), format='bed')
+        probes = summarize_assay.read_assay(self.assay)[1:]
+        summarize_assay.write_depth(probes, table, self.outdir, thresholds=(1, 2))
+        exons = pd.read_csv(os.path.join(self.outdir, 'exon_depth_summary.txt'), sep='\t')
+        self.assertEqual(table['exonCount'].sum(), len(exons))
+        foxa1 = exons[exons['gene'] == 'FOXA1']
+        self.assertEqual([(1, 38058756, 38061916), (2, 38064105, 38064325)],
+                         list(zip(foxa1['exon'], foxa1['start'], foxa1['end'])))
+        histogram = pd.read_csv(os.path.join(self.outdir, 'depth_histogram.txt'), sep='\t', dtype={'exon': str})
+        totals = histogram[(histogram['gene'] == 'FOXA1') & (histogram['exon'] == 'all')]
+        self.assertEqual(3160 + 220, totals['bases'].sum())
+        self.assertEqual(360, totals[totals['depth'] == 1]['bases'].sum())
+
+    def testNativeCoverage(self):
+        """Test in-process intersection of probes and refgenes"""
+        refgenes = {}
+        for refgene, name, start, end in [('NM_001409', 'MEGF6', 3404505, 3528059),
+                                          ('NM_004496', 'FOXA1', 38058756, 38064325)]:
+            refgenes[refgene] = {'name': name, 'chromStart': start, 'chromEnd': end, 'bases_covered': 0,
+                                 'exonTracker': summarize_assay.exonTracker([str(start)], [str(end)])}
+        rows = (['1', '14'], [3404505, 38058756], [3528059, 38064325], ['NM_001409', 'NM_004496'])
+        non_intersecting = summarize_assay.native_coverage(self.assay, refgenes, rows)
+        self.assertEqual(544, refgenes['NM_001409']['bases_covered'])
+        self.assertEqual(360, refgenes['NM_004496']['bases_covered'])
+        self.assertEqual(['2\t47617462\t47617582\tintergenic\n',
+                          'X\t153628886\t153629006\tRPL10\n',
+                          'X\t153629023\t153629383\tRPL10\n'], non_intersecting)
+
+    def bedtools(self):
+        """Return the bedtools argument running bedtools, or a stand-in for it in outdir"""
+        bindir = self.outdir
+        if shutil.which('bedtools') is None:
+            # intersect -wo and -v, as bedtools does, for lack of the real thing
+            with open(os.path.join(bindir, 'bedtools'), 'w') as f:
+                f.write(FAKE_BEDTOOLS.format(sys.executable))
+            os.chmod(os.path.join(bindir, 'bedtools'), stat.S_IRWXU)
+        return 'env PATH={}:{}'.format(os.path.abspath(bindir), os.environ['PATH'])
+
+    def testEnginesAgree(self):
+        """Both engines count bases under overlapping probes once"""
+        assay = os.path.join(self.outdir, 'overlapping.bed')
+        with open(self.assay) as f, open(assay, 'w') as out:
+            for line in f:
+                chrom, start, end, name = line.rstrip('\n').split('\t')[:4]
+                out.write(line)
+                out.write('\t'.join([chrom, str(int(start) + 50), str(int(end) + 50), name]) + '\n')
+        refgene = os.path.join(testfiles, 'test.refGene.bed')
+        table = RefGeneTable.read(refgene, format='bed')
+        rows = summarize_assay.refgene_rows(table)
+        native = summarize_assay.read_refgenes(table, rows)
+        native_lines = summarize_assay.native_coverage(assay, native, rows)
+
+        external = summarize_assay.read_refgenes(table, rows)
+        external_lines = summarize_assay.bedtools_coverage(assay, refgene, self.bedtools(), external)
+
+        self.assertEqual(native_lines, external_lines)
+        self.assertEqual(544 + 50, native['NM_001409']['bases_covered'])
+        for refgene, data in native.items():
+            self.assertEqual(data['bases_covered'], external[refgene]['bases_covered'])
+            self.assertListEqual(data['exonTracker'].bases.tolist(), external[refgene]['exonTracker'].bases.tolist())
+
+    def testEnginesSkipRows(self):
+        """Both engines skip refgene lines that are not NM_ or NR_, and count a transcript listed twice"""
+        refgene = os.path.join(self.outdir, 'refGene.bed')
+        with open(os.path.join(testfiles, 'test.refGene.bed')) as f:
+            lines = f.readlines()
+        with open(refgene, 'w') as out:
+            out.writelines(lines)
+            out.write(lines[1])
+            out.write(lines[-1].replace('\tNM_', '\tXM_', 1))
+        table = RefGeneTable.read(refgene, format='bed')
+        rows = summarize_assay.refgene_rows(table)
+        native = summarize_assay.read_refgenes(table, rows)
+        native_lines = summarize_assay.native_coverage(self.assay, native, rows)
+        external = summarize_assay.read_refgenes(table, rows)
+        with self.assertLogs(summarize_assay.log, 'WARNING') as logs:
+            external_lines = summarize_assay.bedtools_coverage(self.assay, refgene, self.bedtools(), external)
+
+        self.assertTrue(any('XM_' in message for message in logs.output))
+        self.assertEqual(native_lines, external_lines)
+        self.assertEqual(2 * 360, native['NM_004496']['bases_covered'])
+        for refgene, data in native.items():
+            self.assertEqual(data['bases_covered'], external[refgene]['bases_covered'])
+            self.assertListEqual(data['exonTracker'].bases.tolist(), external[refgene]['exonTracker'].bases.tolist())
+
+    def testNativeCoverageJobs(self):
+        """Test intersecting chromosomes in parallel matches the serial results"""
+        table = RefGeneTable.read(os.path.join(testfiles, 'test.refGene.bed'), format='bed')
+        rows = summarize_assay.refgene_rows(table)
+        serial = summarize_assay.read_refgenes(table, rows)
+        parallel = summarize_assay.read_refgenes(table, rows)
+        self.assertEqual(summarize_assay.native_coverage(self.assay, serial, rows),
+                         summarize_assay.native_coverage(self.assay, parallel, rows, jobs=2))
+        for refgene, data in serial.items():
+            self.assertEqual(data['bases_covered'], parallel[refgene]['bases_covered'])
+            self.assertListEqual(data['exonTracker'].bases.tolist(), parallel[refgene]['exonTracker'].bases.tolist())
+
+    def testNativeCoverageCached(self):
+        """Test reusing the cached coverage of unchanged chromosomes matches the uncached results"""
+        table = RefGeneTable.read(os.path.join(testfiles, 'test.refGene.bed'), format='bed')
+        rows = summarize_assay.refgene_rows(table)
+        expected = summarize_assay.read_refgenes(table, rows)
+        non_intersecting = summarize_assay.native_coverage(self.assay, expected, rows)
+        for i in range(2):
+            cached = summarize_assay.read_refgenes(table, rows)
+            self.assertEqual(non_intersecting, summarize_assay.native_coverage(self.assay, cached, rows, cached=True))
+            self.assertIn(summarize_assay.PARTITION_KIND, [e['kind'] for e in cache.entries()])
+            for refgene, data in expected.items():
+                self.assertEqual(data['bases_covered'], cached[refgene]['bases_covered'])
+                self.assertListEqual(data['exonTracker'].bases.tolist(), cached[refgene]['exonTracker'].bases.tolist())
+
     def testExonTracker1(self):
         """Test exon parsing when interval completely within exon"""
         ES=['100','300','500','700']
@@ -93,6 +260,15 @@ class TestSummarizeAssay(unittest.TestCase): #TestBase):
         expected_exons={('100', '200'): True, ('300', '400'): True, ('500', '600'): True, ('700', '800'): True}
         self.assertDictEqual(exons.exons, expected_exons)
 
+    def testExonTrackerBases(self):
+        """Test covered base counts when inserting many intervals at once"""
+        ES=['100','300','500','700']
+        EE=['200','400','600','800']
+        exons=summarize_assay.exonTracker(ES, EE)
+        exons.insert_many([150, 250, 550, 675], [200, 350, 650, 850])
+        self.assertListEqual([50, 50, 50, 100], exons.bases.tolist())
+        self.assertEqual(4, exons.exons_hit())
+
 
 
     def testSummarizeAssay(self):
@@ -117,3 +293,14 @@ class TestSummarizeAssay(unittest.TestCase): #TestBase):
         self.assertTrue(filecmp.cmp(expected_pref_refgene, os.path.join(self.outdir, "preferred_refgene_summary.txt")))
         self.assertTrue(filecmp.cmp(expected_other_refgene, os.path.join(self.outdir, "other_refgene_summary.txt")))
 
+
+    def testSummarizeBatch(self):
+        """Summarize several designs in worker processes sharing one refgene table"""
+        pref_trans = os.path.join(testfiles, 'test.genes_for_summarize')
+        refgene = os.path.join(testfiles, 'test.refGene.bed')
+        designs = [(self.assay, pref_trans, os.path.join(self.outdir, str(i))) for i in range(3)]
+        summarize_batch.summarize_batch(designs, RefGeneTable.read(refgene, format='bed'), jobs=2)
+        for __, __, out in designs:
+            self.assertTrue(filecmp.cmp(os.path.join(testfiles, "expected-overall_summary.txt"), os.path.join(out, "overall_summary.txt")))
+            self.assertTrue(filecmp.cmp(os.path.join(testfiles, "expected-pref_refgene_summary.txt"), os.path.join(out, "preferred_refgene_summary.txt")))
+            self.assertTrue(filecmp.cmp(os.path.join(testfiles, "expected-other_refgene_summary.txt"), os.path.join(out, "other_refgene_summary.txt")))
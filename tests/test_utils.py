@@ -0,0 +1,259 @@
+"""
+Test the shared utilities
+"""
+
+import gzip
+import io
+import logging
+import os
+import shutil
+import numpy as np
+from argparse import Namespace
+from unittest import mock
+from ngs_capture_qc import bgzf, cache, utils
+from ngs_capture_qc.subcommands import cache as cache_command
+from ngs_capture_qc.utils import GenomeIntervalArray, GenomeIntervalTree, Opener, RefGeneTable, partition_by_chromosome, chrom_rank, genomic_order
+
+from __init__ import TestBase
+import __init__ as config
+
+log = logging.getLogger(__name__)
+
+
+class TestRefGeneTable(TestBase):
+    """
+    Test the columnar refGene table
+    """
+
+    def setUp(self):
+        self.refgene = os.path.join(config.datadir, 'test.refGene')
+
+    def testRoundTrip(self):
+        """Rows are reproduced exactly as they appear in the refGene file"""
+        table = RefGeneTable.from_refgene(self.refgene)
+        with open(self.refgene) as f:
+            lines = [line.rstrip('\n') for line in f if not line.startswith('#')]
+        self.assertEqual(len(lines), len(table))
+        for row, line in zip(table.rows(), lines):
+            self.assertEqual(line, '\t'.join(row[f] for f in RefGeneTable.FIELDS))
+
+    def testTake(self):
+        """Filter to known chromosomes, keeping exons with their rows"""
+        table = RefGeneTable.from_refgene(self.refgene)
+        primary = table.take(table.in_chromosomes())
+        self.assertEqual(len(table) - 1, len(primary))
+        self.assertNotIn('7_gl000195_random', primary.chrom)
+        starts, ends = primary.exons(len(primary) - 1)
+        self.assertListEqual([38058756, 38064105], starts.tolist())
+        self.assertListEqual([38061916, 38064325], ends.tolist())
+
+    def testFromBed(self):
+        """Read refgene data in BED format"""
+        table = RefGeneTable.from_bed(os.path.join(config.datadir, 'test.refGene.bed'))
+        self.assertListEqual(['1', '14', '7', 'X'], table.chrom.tolist())
+        self.assertListEqual(['MEGF6', 'FOXA1', 'GPR146', 'RPL10'], table['name2'].tolist())
+        self.assertListEqual([37, 2, 2, 7], table['exonCount'].tolist())
+
+    def testChunks(self):
+        """Parsing a few rows at a time gives the same table"""
+        table = RefGeneTable.from_refgene(self.refgene)
+        with mock.patch.object(utils, 'CHUNK_ROWS', 2):
+            chunked = RefGeneTable.from_refgene(self.refgene)
+        self.assertEqual(list(table.rows()), list(chunked.rows()))
+        self.assertListEqual(table.chrom.tolist(), chunked.chrom.tolist())
+
+    def testUrls(self):
+        """Tables are read from file:// URLs, and from a mirror into the cache"""
+        outdir = self.mkoutdir()
+        url = 'http://example.invalid/goldenPath/refGene.txt.gz'
+        mirror = os.path.join(outdir, 'mirror')
+        os.makedirs(os.path.join(mirror, 'example.invalid', 'goldenPath'))
+        with open(self.refgene, 'rb') as f, gzip.open(os.path.join(mirror, 'example.invalid', 'goldenPath',
+                                                                   'refGene.txt.gz'), 'wb') as out:
+            shutil.copyfileobj(f, out)
+        expected = len(GenomeIntervalTree.from_table(self.refgene))
+        tree = GenomeIntervalTree.from_table(url='file://' + os.path.abspath(self.refgene))
+        self.assertEqual(expected, len(tree))
+
+        with mock.patch.dict(os.environ, {'CAPQC_CACHE_DIR': os.path.join(outdir, 'cache')}):
+            path = cache.fetch(url, mirror)
+            self.assertTrue(path.endswith('refGene.txt.gz'))
+            # later reads come from the cache, without the mirror
+            self.assertEqual(path, cache.fetch(url))
+            self.assertEqual(expected, len(GenomeIntervalArray.from_table(url=url)))
+            self.assertEqual(['download', 'refgene_table-v{}'.format(utils.TABLE_VERSION)], sorted(e['kind'] for e in cache.entries()))
+
+    def testExonIntervals(self):
+        """Exons and introns are numbered from the 5' end and share their transcript's row"""
+        tree = GenomeIntervalTree.from_table(self.refgene, genes=['FOXA1'], mode='exons')
+        exon2, intron1, exon1 = sorted(tree['14'])
+        self.assertEqual((38058756, 38061917, '2'), (exon2.begin, exon2.end, exon2.data['exonNum']))
+        self.assertEqual((38061917, 38064105, '1'), (intron1.begin, intron1.end, intron1.data['intronNum']))
+        self.assertEqual('1', exon1.data['exonNum'])
+        self.assertNotIn('intronNum', exon1.data)
+        self.assertIs(exon1.data.parent, intron1.data.parent)
+        self.assertEqual(dict(exon1.data.parent, exonNum='1'), dict(exon1.data))
+
+
+class TestGenomeIntervalArray(TestBase):
+    """
+    Test the array-backed alternative to GenomeIntervalTree
+    """
+
+    def testMatchesTree(self):
+        """Overlap queries find the same intervals and data as the interval trees"""
+        refgene = os.path.join(config.datadir, 'test.refGene')
+        for mode in ['tx', 'cds', 'exons']:
+            tree = GenomeIntervalTree.from_table(refgene, mode=mode)
+            intervals = GenomeIntervalArray.from_table(refgene, mode=mode)
+            self.assertEqual(len(tree), len(intervals))
+            for chrom in tree:
+                begin = min(i.begin for i in tree[chrom])
+                starts = list(range(begin - 1000, max(i.end for i in tree[chrom]) + 1000, 997))
+                query, found = intervals.overlap_many(chrom, starts, [s + 5000 for s in starts])
+                self.assertEqual(sorted((q, i.begin, i.end, sorted(i.data.items())) for q, s in enumerate(starts)
+                                        for i in tree[chrom].overlap(s, s + 5000)),
+                                 sorted((q, i.begin, i.end, sorted(i.data.items()))
+                                        for q, i in zip(query.tolist(), map(intervals.interval, found.tolist()))))
+
+    def testAddi(self):
+        """Pairs are ordered by query, then interval start"""
+        intervals = GenomeIntervalArray()
+        intervals.addi('1', 100, 200, 'a')
+        intervals.addi('1', 50, 150, 'b')
+        intervals.addi('2', 100, 200, 'c')
+        intervals.addi('1', 300, 300, 'd')
+        query, found = intervals.overlap_many('1', [0, 120, 300], [60, 130, 301])
+        self.assertListEqual([0, 1, 1, 2], query.tolist())
+        self.assertListEqual([1, 1, 0, 3], found.tolist())
+        self.assertListEqual(['b', 'a'], [i.data for i in intervals.overlap('1', 120, 130)])
+        self.assertEqual((300, 301, 'd'), tuple(intervals.interval(3)))
+        self.assertEqual(0, len(intervals.overlap_many('3', [0], [1000])[0]))
+
+
+class TestPartitionByChromosome(TestBase):
+    """
+    Test splitting rows by chromosome
+    """
+
+    def testPartitions(self):
+        """Chromosome names are matched with and without the chr prefix, in natural order"""
+        partitions = partition_by_chromosome(['10', 'chr2', 'X', '2'], ['chr2', '2', '10', 'Y'])
+        self.assertListEqual([([1, 3], [0, 1]), ([0], [2]), ([2], [])],
+                             [tuple(p.tolist() for p in part) for part in partitions])
+
+    def testGenomicOrder(self):
+        """Rows sort by chromosome in natural order, then by start and end as integers"""
+        self.assertListEqual([1, 1, 9, 22, 23, 24, 25], chrom_rank(['chr2', '2', '10', 'chrX', 'Y', 'Un_2', 'Un_10']).tolist())
+        chroms = ['10', 'chr2', '2', 'X', '2', 'chr2']
+        starts = [5, 1000, 200, 1, 200, 30]
+        ends = [10, 1100, 300, 2, 250, 40]
+        self.assertListEqual([5, 4, 2, 1, 0, 3], genomic_order(chroms, starts, ends).tolist())
+        self.assertListEqual([1, 2, 4, 5, 0, 3], genomic_order(chroms).tolist())
+
+
+class TestCache(TestBase):
+    """
+    Test keeping the cache under its size cap
+    """
+
+    def setUp(self):
+        self.outdir = self.mkoutdir()
+        self.env = mock.patch.dict(os.environ, {'CAPQC_CACHE_DIR': os.path.join(self.outdir, 'cache'),
+                                                'CAPQC_CACHE_SIZE': '100K'})
+        self.env.start()
+
+    def tearDown(self):
+        cache.clear()
+        self.env.stop()
+
+    def testRunningSize(self):
+        """The cache is walked once, then again only when a store goes over the cap"""
+        arrays = {'a': np.zeros(5000, dtype=np.int64)}
+        with mock.patch.object(cache, 'entries', wraps=cache.entries) as walked:
+            for i in range(2):
+                cache.store_arrays('test', str(i), arrays, 'test')
+            self.assertEqual(1, walked.call_count)
+            for i in range(2, 4):
+                cache.store_arrays('test', str(i), arrays, 'test')
+            self.assertGreater(walked.call_count, 1)
+        self.assertEqual(['test-2', 'test-3'], sorted(e['name'] for e in cache.entries()))
+
+    def testKeepNewEntry(self):
+        """A download bigger than the cap is not evicted as it is stored, and stat files are pruned"""
+        source = os.path.join(self.outdir, 'big.txt')
+        with open(source, 'w') as f:
+            f.write('x' * 200000)
+        cache.source_digest(source)
+        self.assertEqual(1, len(os.listdir(os.path.join(self.outdir, 'cache', 'stat'))))
+        path = cache.fetch('http://example.invalid/big.txt', self.outdir)
+        self.assertTrue(os.path.exists(path))
+        self.assertEqual([], os.listdir(os.path.join(self.outdir, 'cache', 'stat')))
+        self.assertEqual(['download', 'urls'], sorted(e['kind'] for e in cache.prune(0)))
+
+    def testCommandOutput(self):
+        """cache fetch and prune report the fetched and removed files on stdout"""
+        with open(os.path.join(self.outdir, 'small.txt'), 'w') as f:
+            f.write('small\n')
+        url = 'http://example.invalid/small.txt'
+        with mock.patch('sys.stdout', new_callable=io.StringIO) as stdout:
+            cache_command.action(Namespace(command='fetch', urls=[url], mirror=self.outdir, max_size=None))
+        path = cache.fetch(url)
+        self.assertEqual('{}\t{}'.format(url, path), stdout.getvalue().splitlines()[0])
+        with mock.patch('sys.stdout', new_callable=io.StringIO) as stdout:
+            cache_command.action(Namespace(command='prune', urls=None, mirror=None, max_size='0'))
+        self.assertIn('removed\t{}\t{}'.format(os.path.basename(os.path.dirname(path)), url),
+                      stdout.getvalue().splitlines())
+
+
+class TestOpener(TestBase):
+    """
+    Test reading and writing compressed files
+    """
+
+    def setUp(self):
+        self.outdir = self.mkoutdir()
+        # enough lines for several BGZF blocks
+        self.text = ''.join('{}\t{}\t{}\tline {}\n'.format(i % 22 + 1, i * 100, i * 100 + 120, i)
+                            for i in range(20000))
+
+    def testBgzfRoundTrip(self):
+        """BGZF is written in blocks, readable by gzip and by Opener"""
+        for fname, opener in [('out.bgz', Opener('w', threads=2)), ('out.gz', Opener('w', bgzf=True))]:
+            path = os.path.join(self.outdir, fname)
+            with opener(path) as f:
+                f.write(self.text)
+            self.assertTrue(bgzf.is_bgzf(path))
+            with gzip.open(path, 'rt') as f:
+                self.assertEqual(self.text, f.read())
+            with Opener(threads=2)(path) as f:
+                self.assertEqual(self.text.splitlines(True), list(f))
+
+    def testGzip(self):
+        """Plain .gz files are still written by gzip"""
+        path = os.path.join(self.outdir, 'out.gz')
+        with Opener('w')(path) as f:
+            f.write(self.text)
+        self.assertFalse(bgzf.is_bgzf(path))
+        with Opener()(path) as f:
+            self.assertEqual(self.text, f.read())
+
+    def testXz(self):
+        path = os.path.join(self.outdir, 'out.xz')
+        with Opener('w')(path) as f:
+            f.write(self.text)
+        with Opener()(path) as f:
+            self.assertEqual(self.text, f.read())
+
+    def testSeekVirtual(self):
+        """Reading resumes from a virtual offset"""
+        path = os.path.join(self.outdir, 'out.bgz')
+        with Opener('w')(path) as f:
+            f.write(self.text)
+        with open(path, 'rb') as f:
+            blocks = list(bgzf.iter_blocks(f))
+        offset, data = blocks[1]
+        reader = bgzf.BgzfReader(path)
+        reader.seek_virtual((offset << 16) | 10)
+        self.assertEqual(data[10:20], reader.read(10))
+        reader.close()
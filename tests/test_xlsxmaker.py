@@ -0,0 +1,51 @@
+"""
+Test the xlsxmaker script
+"""
+
+import logging
+import os
+import re
+import zipfile
+from argparse import Namespace
+from ngs_capture_qc.subcommands import xlsxmaker
+
+from __init__ import TestBase
+
+log = logging.getLogger(__name__)
+
+
+class TestXlsxMaker(TestBase):
+    """
+    Test writing tab-delimited files as sheets of a workbook
+    """
+
+    def setUp(self):
+        self.outdir = self.mkoutdir()
+
+    def testConvertRows(self):
+        """Numbers become numbers, except integers with leading zeros or too long for Excel"""
+        rows = [['gene', '12', '-2.5', '007'], ['x'], ['', 'nan', '1e3', '9999999999999999']]
+        self.assertEqual([['gene', 12, -2.5, '007'], ['x'], ['', 'nan', 1000.0, '9999999999999999']],
+                         xlsxmaker.convert_rows(rows))
+
+    def testSplitSheets(self):
+        """Files longer than a sheet continue on further sheets"""
+        infile = os.path.join(self.outdir, 'a_long_file_name_for_a_summary.txt')
+        with open(infile, 'w') as f:
+            f.writelines('row {}\t{}\n'.format(i, i) for i in range(25))
+        outfile = os.path.join(self.outdir, 'out.xlsx')
+        max_rows, batch_size = xlsxmaker.MAX_ROWS, xlsxmaker.BATCH_SIZE
+        xlsxmaker.MAX_ROWS, xlsxmaker.BATCH_SIZE = 10, 4
+        try:
+            xlsxmaker.action(Namespace(infiles=[[infile]], outfile=outfile))
+        finally:
+            xlsxmaker.MAX_ROWS, xlsxmaker.BATCH_SIZE = max_rows, batch_size
+
+        with zipfile.ZipFile(outfile) as book:
+            names = re.findall(r'<sheet name="([^"]+)"', book.read('xl/workbook.xml').decode())
+            sheets = [book.read('xl/worksheets/sheet{}.xml'.format(i + 1)).decode() for i in range(len(names))]
+        self.assertEqual(['a_long_file_name_for_a_summary',
+                          'a_long_file_name_for_a_summ (2)',
+                          'a_long_file_name_for_a_summ (3)'], names)
+        self.assertEqual([10, 10, 5], [s.count('<row ') for s in sheets])
+        self.assertIn('<v>24</v>', sheets[2])